@@ -0,0 +1,361 @@
+"""Download pipeline benchmark.
+
+Runs batches of download jobs against the synthetic media server
+(benchmarks/media_server.py) at several concurrency levels and reports
+jobs/s, MB/s, CPU seconds per job and peak RSS. Two modes:
+    
+    downloader  MediaDownloader.download_video/download_audio on a thread
+                pool, like the scheduler's executors
+    pipeline    bot.download_and_send end to end (extract, staging, download,
+                upload, cache and history writes) against the fake Bot API
+                in benchmarks/mock_bot_api.py
+
+Both servers run in child processes, so the CPU and memory figures are the
+bot's own. Everything is written to a temporary directory (database, staging
+area); results are saved as JSON under benchmarks/results/.
+    
+    python -m benchmarks.bench_download --concurrency 1,2,4,8 --jobs 16 --size-mb 20
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_FOLDER = os.path.join(REPO_ROOT, 'benchmarks', 'results')
+
+BENCH_USER_ID = 424242
+BENCH_TOKEN = '123456:BENCH'
+
+# Kind -> (media type, URL path of a unique media item)
+KINDS = {
+    'mp4': ('video', '/video/{name}.mp4'),
+    'hls': ('video', '/hls/{name}.m3u8'),
+    'dash': ('video', '/dash/{name}.mpd'),
+    'm4a': ('audio', '/audio/{name}.m4a'),
+    'mp3': ('audio', '/audio/{name}.mp3'),
+}
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f"Server on port {port} didn't start")
+
+
+def start_server(target, **kwargs):
+    """Run a server's serve() in a child process and wait until it listens"""
+    process = multiprocessing.Process(target=target, kwargs=kwargs, daemon=True)
+    process.start()
+    wait_for_port(kwargs['port'])
+    return process
+
+
+def cpu_seconds():
+    """User + system CPU time of this process and its reaped children (ffmpeg)"""
+    total = 0.0
+    for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN):
+        usage = resource.getrusage(who)
+        total += usage.ru_utime + usage.ru_stime
+    return total
+
+
+def current_rss():
+    """Resident set size in bytes, or None where /proc isn't available"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+class PeakRSS:
+    """Samples the RSS in a background thread while a run is in progress"""
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = None
+    
+    def __enter__(self):
+        self.peak = current_rss() or 0
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+    
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        if not self.peak:
+            # Lifetime peak (KB on Linux), the best we can do without /proc
+            self.peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, current_rss() or 0)
+
+
+def make_urls(media_base, kind, jobs):
+    path = KINDS[kind][1]
+    run = uuid.uuid4().hex[:8]
+    return [media_base + path.format(name=f"bench-{run}-{index}") for index in range(jobs)]
+
+
+def run_downloader_jobs(downloader, kind, urls, concurrency, workdir):
+    """Download every URL with MediaDownloader on a thread pool. Returns (ok, bytes)."""
+    media_type = KINDS[kind][0]
+    download = downloader.download_video if media_type == 'video' else downloader.download_audio
+    
+    def one(index, url):
+        job_dir = os.path.join(workdir, 'jobs', f"direct-{uuid.uuid4().hex}")
+        os.makedirs(job_dir)
+        try:
+            result = download(url, None, None, job_dir)
+            if not result.get('success'):
+                print(f"  {url}: {result.get('error')}", file=sys.stderr)
+                return 0
+            downloader.release_file(result['file_path'])
+            return result['file_size']
+        finally:
+            shutil.rmtree(job_dir, ignore_errors=True)
+    
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        sizes = list(executor.map(one, range(len(urls)), urls))
+    return sum(1 for size in sizes if size), sum(sizes)
+
+
+async def run_pipeline_jobs(bot_module, api_bot, kind, urls, concurrency):
+    """Push every URL through bot.download_and_send, concurrency jobs at a time. Returns (ok, bytes)."""
+    from download_queue import StatusMessage, cancel_markup
+    from progress import ProgressReporter
+    from tracing import JobTrace
+    
+    media_type = KINDS[kind][0]
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(concurrency)
+    executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='bench-download')
+    
+    async def one(url):
+        async with semaphore:
+            message = await api_bot.send_message(BENCH_USER_ID, "⬇️ Starting download...")
+            job_id = await bot_module.db.add_job(BENCH_USER_ID, BENCH_USER_ID, message.message_id, url, media_type)
+            trace = JobTrace(BENCH_USER_ID, url, media_type)
+            trace.submit()
+            job = {
+                'id': job_id, 'user_id': BENCH_USER_ID, 'chat_id': BENCH_USER_ID,
+                'message_id': message.message_id, 'url': url, 'media_type': media_type, 'trace': trace,
+            }
+            status_message = StatusMessage(api_bot, BENCH_USER_ID, message.message_id)
+            reporter = ProgressReporter(loop, status_message, reply_markup=cancel_markup(job_id))
+            try:
+                await bot_module.download_and_send(api_bot, job, reporter, executor)
+            finally:
+                await reporter.close()
+            if trace.outcome != 'done':
+                print(f"  {url}: {trace.outcome} {trace.error or ''}", file=sys.stderr)
+                return 0
+            return trace.bytes or 0
+    
+    try:
+        sizes = await asyncio.gather(*(one(url) for url in urls))
+    finally:
+        executor.shutdown(wait=False)
+    return sum(1 for size in sizes if size), sum(sizes)
+
+
+def summarize(mode, kind, concurrency, jobs, ok, total_bytes, seconds, cpu, peak_rss):
+    return {
+        'mode': mode,
+        'kind': kind,
+        'media_type': KINDS[kind][0],
+        'concurrency': concurrency,
+        'jobs': jobs,
+        'ok': ok,
+        'failed': jobs - ok,
+        'seconds': round(seconds, 3),
+        'jobs_per_sec': round(ok / seconds, 3) if seconds else None,
+        'mb_per_sec': round(total_bytes / (1024 * 1024) / seconds, 2) if seconds else None,
+        'cpu_seconds_per_job': round(cpu / ok, 4) if ok else None,
+        'cpu_utilization': round(cpu / seconds, 3) if seconds else None,
+        'peak_rss_mb': round(peak_rss / (1024 * 1024), 1),
+    }
+
+
+def print_row(row, out):
+    print(
+        f"{row['mode']:<10} {row['kind']:<5} c={row['concurrency']:<3} "
+        f"{row['ok']}/{row['jobs']} ok  {row['jobs_per_sec'] or 0:7.2f} jobs/s  {row['mb_per_sec'] or 0:8.1f} MB/s  "
+        f"{row['cpu_seconds_per_job'] or 0:6.3f} CPU s/job  {row['peak_rss_mb']:7.1f} MB peak RSS",
+        file=out, flush=True
+    )
+
+
+async def run_benchmark(args, media_base, api_base, workdir, out):
+    # Imported here: the bot reads its configuration from the environment set up in main()
+    import bot as bot_module
+    from telegram import Bot
+    from telegram.request import HTTPXRequest
+    
+    await bot_module.db.connect()
+    api_bot = Bot(BENCH_TOKEN, base_url=api_base, request=HTTPXRequest(connection_pool_size=64))
+    await api_bot.initialize()
+    
+    quiet = not args.verbose
+    devnull = open(os.devnull, 'w')
+    results = []
+    try:
+        for mode in args.modes:
+            for kind in args.kinds:
+                for concurrency in args.concurrency:
+                    urls = make_urls(media_base, kind, args.jobs)
+                    cpu_before = cpu_seconds()
+                    started = time.monotonic()
+                    with PeakRSS() as rss:
+                        with contextlib.redirect_stdout(devnull) if quiet else contextlib.nullcontext():
+                            if mode == 'downloader':
+                                ok, total_bytes = await asyncio.to_thread(
+                                    run_downloader_jobs, bot_module.downloader, kind, urls, concurrency, workdir
+                                )
+                            else:
+                                ok, total_bytes = await run_pipeline_jobs(
+                                    bot_module, api_bot, kind, urls, concurrency
+                                )
+                    row = summarize(
+                        mode, kind, concurrency, len(urls), ok, total_bytes,
+                        time.monotonic() - started, cpu_seconds() - cpu_before, rss.peak
+                    )
+                    results.append(row)
+                    print_row(row, out)
+    finally:
+        devnull.close()
+        await bot_module.trace_writer.flush()
+        await bot_module.uploader.close()
+        await api_bot.shutdown()
+        await bot_module.db.close()
+    return results
+
+
+def metadata(args):
+    import yt_dlp
+    import config
+    return {
+        'started': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'yt_dlp': yt_dlp.version.__version__,
+        'ffmpeg': shutil.which('ffmpeg') is not None,
+        'size_mb': args.size_mb,
+        'segment_mb': args.segment_mb,
+        'jobs': args.jobs,
+        'api_latency_ms': args.api_latency_ms,
+        'config': {
+            name: getattr(config, name) for name in (
+                'FRAGMENT_DOWNLOADS_SHORT', 'FRAGMENT_DOWNLOADS_LONG', 'HTTP_CHUNK_SIZE_MB_SHORT',
+                'HTTP_CHUNK_SIZE_MB_LONG', 'EXTERNAL_DOWNLOADER', 'UPLOAD_CHUNK_SIZE_KB', 'AUDIO_DOWNLOAD_WORKERS',
+            )
+        },
+    }
+
+
+def comma_list(convert=str):
+    return lambda value: [convert(item) for item in value.split(',') if item]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--modes', type=comma_list(), default=['downloader', 'pipeline'],
+                        help='Comma-separated: downloader, pipeline')
+    parser.add_argument('--kinds', type=comma_list(), default=['mp4', 'hls', 'dash', 'm4a'],
+                        help=f"Comma-separated: {', '.join(KINDS)}")
+    parser.add_argument('--concurrency', type=comma_list(int), default=[1, 2, 4, 8],
+                        help='Comma-separated concurrency levels')
+    parser.add_argument('--jobs', type=int, default=16, help='Jobs per run')
+    parser.add_argument('--size-mb', type=float, default=20, help='Size of each media item')
+    parser.add_argument('--segment-mb', type=float, default=1, help='HLS/DASH fragment size')
+    parser.add_argument('--api-latency-ms', type=float, default=0, help='Delay the fake Bot API adds to every call')
+    parser.add_argument('--output', help='Results file (default: benchmarks/results/download-<time>.json)')
+    parser.add_argument('--verbose', action='store_true', help="Show yt-dlp's and the bot's output")
+    args = parser.parse_args()
+    
+    unknown = set(args.modes) - {'downloader', 'pipeline'} or set(args.kinds) - set(KINDS)
+    if unknown:
+        parser.error(f"unknown mode or kind: {', '.join(sorted(unknown))}")
+    
+    from benchmarks import media_server, mock_bot_api
+    
+    out = sys.stdout
+    output = os.path.abspath(
+        args.output or os.path.join(RESULTS_FOLDER, f"download-{datetime.now():%Y%m%d-%H%M%S}.json")
+    )
+    cwd = os.getcwd()
+    workdir = tempfile.mkdtemp(prefix='bot-bench-')
+    media_port, api_port = free_port(), free_port()
+    servers = [
+        start_server(media_server.serve, port=media_port, size_mb=args.size_mb, segment_mb=args.segment_mb),
+        start_server(mock_bot_api.serve, port=api_port, latency=args.api_latency_ms / 1000),
+    ]
+    
+    # The bot's configuration is read at import time, and DOWNLOAD_FOLDER is relative to the working directory
+    os.environ.update({
+        'BOT_TOKEN': BENCH_TOKEN,
+        'ADMIN_USER_ID': str(BENCH_USER_ID),  # Admins have no quota
+        'DATABASE_PATH': os.path.join(workdir, 'bench.db'),
+        'STORAGE_BACKEND': 'sqlite',
+        'METRICS_PORT': '0',
+    })
+    os.environ.setdefault('STAGING_MIN_FREE_MB', '256')
+    sys.path.insert(0, REPO_ROOT)
+    os.chdir(workdir)
+    
+    try:
+        meta = metadata(args)
+        if not args.verbose:
+            import logging
+            logging.disable(logging.WARNING)
+        results = asyncio.run(run_benchmark(
+            args, f"http://127.0.0.1:{media_port}", f"http://127.0.0.1:{api_port}/bot", workdir, out
+        ))
+    finally:
+        for server in servers:
+            server.terminate()
+            server.join()
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+    
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump({'metadata': meta, 'results': results}, f, indent=2)
+    print(f"Results saved to {output}", file=out)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,528 @@
+"""Update handling load test.
+
+Runs the bot's real Application (handlers, update processor, storage,
+scheduler) polling the fake Bot API in benchmarks/mock_bot_api.py, and
+replays a scripted mix of updates at increasing rates:
+    
+    start          approved user sends /start
+    help           approved user presses the Help button (callback)
+    menu_button    approved user sends the "❓ Help" reply keyboard text
+    link           approved user sends a link (media info extraction, info cache)
+    download       approved user picks Video for a link (queues a real download)
+    stranger_link  unknown user sends a link (refused)
+    request        unknown user sends /request (access request written)
+    admin_list     admin sends /listusers
+    admin_pending  admin sends /pending
+    admin_stats    admin sends /stats
+    admin_add      admin sends /adduser <new id>
+    admin_panel    admin presses the Admin Panel button (callback)
+
+For each rate it reports handler latency percentiles (from pushing the update
+to the API until the update processor is done with it), per action and
+overall, event loop lag, CPU, and database contention: storage calls, their
+latency (which includes waiting for a reader thread or the writer), the peak
+number in flight and errors. Results are saved as JSON under
+benchmarks/results/.
+    
+    python -m benchmarks.load_test --rates 20,50,100,200 --duration 20 --mix mixed
+    python -m benchmarks.load_test --mix start=5,link=3,admin_stats=1
+"""
+import argparse
+import asyncio
+import contextlib
+import functools
+import inspect
+import itertools
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+from datetime import datetime
+
+from benchmarks.bench_download import REPO_ROOT, RESULTS_FOLDER, cpu_seconds, free_port, start_server
+
+BOT_TOKEN = '123456:LOADTEST'
+ADMIN_ID = 1000
+APPROVED_BASE = 100000
+STRANGER_BASE = 5000000
+
+MIXES = {
+    'browse': {'start': 5, 'help': 3, 'menu_button': 2},
+    'links': {'link': 6, 'start': 1, 'stranger_link': 1},
+    'admin': {'admin_list': 2, 'admin_pending': 2, 'admin_stats': 1, 'admin_add': 1, 'admin_panel': 2, 'start': 2},
+    'mixed': {
+        'start': 3, 'help': 2, 'menu_button': 1, 'link': 3, 'stranger_link': 1, 'request': 1,
+        'admin_list': 0.3, 'admin_pending': 0.3, 'admin_stats': 0.2, 'admin_add': 0.2, 'admin_panel': 0.2,
+    },
+}
+MIXES['full'] = {**MIXES['mixed'], 'download': 0.5}
+
+
+def latency_summary(values):
+    from tracing import percentile
+    values = sorted(values)
+    ms = lambda value: round(value * 1000, 1) if value is not None else None
+    return {
+        'count': len(values),
+        'p50_ms': ms(percentile(values, 50)),
+        'p95_ms': ms(percentile(values, 95)),
+        'p99_ms': ms(percentile(values, 99)),
+        'max_ms': ms(values[-1] if values else None),
+    }
+
+
+def parse_mix(value):
+    """A named mix, or action=weight pairs separated by commas"""
+    if value in MIXES:
+        return MIXES[value]
+    mix = {}
+    for item in value.split(','):
+        action, _, weight = item.partition('=')
+        if action not in Scenario.ACTIONS:
+            raise argparse.ArgumentTypeError(f"unknown action {action!r}")
+        mix[action] = float(weight or 1)
+    return mix
+
+
+class Scenario:
+    """Builds the Update dicts of the scripted actions"""
+    ACTIONS = (
+        'start', 'help', 'menu_button', 'link', 'download', 'stranger_link', 'request',
+        'admin_list', 'admin_pending', 'admin_stats', 'admin_add', 'admin_panel',
+    )
+    
+    def __init__(self, mix, users, links, seed=0):
+        self.random = random.Random(seed)
+        self.actions = list(mix)
+        self.weights = [mix[action] for action in self.actions]
+        self.users = users
+        self.links = links
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1000000)
+        self.strangers = itertools.count(STRANGER_BASE)
+    
+    def pick(self):
+        return self.random.choices(self.actions, self.weights)[0]
+    
+    def approved_user(self):
+        return APPROVED_BASE + self.random.randrange(self.users)
+    
+    @staticmethod
+    def user(user_id):
+        return {'id': user_id, 'is_bot': False, 'first_name': f"User{user_id}", 'username': f"user{user_id}"}
+    
+    def message(self, user_id, text):
+        message = {
+            'message_id': next(self.message_ids),
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private', 'first_name': f"User{user_id}"},
+            'from': self.user(user_id),
+            'text': text,
+        }
+        if text.startswith('/'):
+            command = text.split()[0]
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(command)}]
+        return {'update_id': next(self.update_ids), 'message': message}
+    
+    def callback(self, user_id, data):
+        update_id = next(self.update_ids)
+        return {'update_id': update_id, 'callback_query': {
+            'id': str(update_id),
+            'from': self.user(user_id),
+            'chat_instance': str(user_id),
+            'data': data,
+            'message': {
+                'message_id': next(self.message_ids),
+                'date': int(time.time()),
+                'chat': {'id': user_id, 'type': 'private', 'first_name': f"User{user_id}"},
+                'text': 'Menu',
+            },
+        }}
+    
+    def make(self, action):
+        link = self.random.choice(self.links)
+        if action == 'start':
+            return self.message(self.approved_user(), '/start')
+        if action == 'help':
+            return self.callback(self.approved_user(), 'help')
+        if action == 'menu_button':
+            return self.message(self.approved_user(), '❓ Help')
+        if action == 'link':
+            return self.message(self.approved_user(), link)
+        if action == 'download':
+            return self.callback(self.approved_user(), f"download_video:{link}")
+        if action == 'stranger_link':
+            return self.message(next(self.strangers), link)
+        if action == 'request':
+            return self.message(next(self.strangers), '/request Load test, please let me in')
+        if action == 'admin_list':
+            return self.message(ADMIN_ID, '/listusers')
+        if action == 'admin_pending':
+            return self.message(ADMIN_ID, '/pending')
+        if action == 'admin_stats':
+            return self.message(ADMIN_ID, '/stats')
+        if action == 'admin_add':
+            return self.message(ADMIN_ID, f"/adduser {next(self.strangers)}")
+        if action == 'admin_panel':
+            return self.callback(ADMIN_ID, 'admin_panel')
+        raise ValueError(f"Unknown action {action}")
+
+
+class Recorder:
+    """Latency of each pushed update, and the bot's storage calls, for the current step"""
+    def __init__(self):
+        self.pushed = {}
+        self.db_in_flight = 0
+        self.reset()
+    
+    def reset(self):
+        self.latencies = defaultdict(list)
+        self.errors = Counter()
+        self.db_calls = defaultdict(list)
+        self.db_errors = Counter()
+        self.db_peak_in_flight = self.db_in_flight
+        self.completed = 0
+        self.last_completed = None
+    
+    def push(self, update_id, action):
+        self.pushed[update_id] = (action, time.monotonic())
+    
+    def done(self, update):
+        entry = self.pushed.pop(getattr(update, 'update_id', None), None)
+        if entry:
+            action, pushed = entry
+            self.last_completed = time.monotonic()
+            self.latencies[action].append(self.last_completed - pushed)
+            self.completed += 1
+    
+    async def error(self, update, context):
+        entry = self.pushed.get(getattr(update, 'update_id', None))
+        self.errors[entry[0] if entry else 'unknown'] += 1
+        if sum(self.errors.values()) <= 3:
+            print(f"  Handler error: {context.error!r}", file=sys.stderr)
+    
+    def wrap_update_processor(self, processor):
+        """Time every update from its push until the update processor is done with it"""
+        process_update = processor.process_update
+        
+        async def timed(update, coroutine):
+            try:
+                await process_update(update, coroutine)
+            finally:
+                self.done(update)
+        
+        processor.process_update = timed
+    
+    def wrap_storage(self, db):
+        """Time the public coroutine methods of a storage instance"""
+        for name, method in inspect.getmembers(db, inspect.iscoroutinefunction):
+            if name.startswith('_') or name in ('connect', 'close'):
+                continue
+            setattr(db, name, self._timed(name, method))
+    
+    def _timed(self, name, method):
+        @functools.wraps(method)
+        async def wrapper(*args, **kwargs):
+            self.db_in_flight += 1
+            self.db_peak_in_flight = max(self.db_peak_in_flight, self.db_in_flight)
+            started = time.monotonic()
+            try:
+                return await method(*args, **kwargs)
+            except Exception:
+                self.db_errors[name] += 1
+                raise
+            finally:
+                self.db_in_flight -= 1
+                self.db_calls[name].append(time.monotonic() - started)
+        return wrapper
+    
+    def db_summary(self, seconds, top=8):
+        calls = sum(len(values) for values in self.db_calls.values())
+        methods = sorted(self.db_calls.items(), key=lambda item: sum(item[1]), reverse=True)[:top]
+        return {
+            'calls': calls,
+            'calls_per_sec': round(calls / seconds, 1) if seconds else None,
+            'peak_in_flight': self.db_peak_in_flight,
+            'errors': dict(self.db_errors),
+            'latency': latency_summary([value for values in self.db_calls.values() for value in values]),
+            'methods': {
+                name: {**latency_summary(values), 'total_seconds': round(sum(values), 3)} for name, values in methods
+            },
+        }
+
+
+async def loop_lag(samples, interval=0.05):
+    """Record how late the event loop wakes up a sleeping task"""
+    while True:
+        started = time.monotonic()
+        await asyncio.sleep(interval)
+        samples.append(max(0.0, time.monotonic() - started - interval))
+
+
+async def api_stats(session, api_root):
+    async with session.get(f"{api_root}/stats") as response:
+        return await response.json()
+
+
+async def run_step(session, api_root, scenario, recorder, rate, duration, drain_timeout, out):
+    """Push rate updates/s for duration seconds and wait for the bot to work through them"""
+    recorder.reset()
+    lag = []
+    lag_task = asyncio.create_task(loop_lag(lag))
+    api_before = await api_stats(session, api_root)
+    cpu_before = cpu_seconds()
+    started = time.monotonic()
+    total = int(rate * duration)
+    sent = Counter()
+    
+    pushed = 0
+    while pushed < total:
+        due = min(total, int((time.monotonic() - started) * rate) + 1)
+        batch = []
+        for _ in range(due - pushed):
+            action = scenario.pick()
+            update = scenario.make(action)
+            recorder.push(update['update_id'], action)
+            sent[action] += 1
+            batch.append(update)
+        if batch:
+            async with session.post(f"{api_root}/updates", json=batch) as response:
+                await response.read()
+            pushed += len(batch)
+        await asyncio.sleep(0.01)
+    push_seconds = time.monotonic() - started
+    
+    deadline = time.monotonic() + drain_timeout
+    while recorder.completed < total and time.monotonic() < deadline:
+        await asyncio.sleep(0.05)
+    elapsed = (recorder.last_completed or time.monotonic()) - started
+    cpu = cpu_seconds() - cpu_before
+    lag_task.cancel()
+    api_after = await api_stats(session, api_root)
+    
+    all_latencies = [value for values in recorder.latencies.values() for value in values]
+    api_calls = {
+        method: count - api_before['calls'].get(method, 0) for method, count in api_after['calls'].items()
+        if count - api_before['calls'].get(method, 0)
+    }
+    row = {
+        'offered_rate': rate,
+        'sent': total,
+        'completed': recorder.completed,
+        'timed_out': total - recorder.completed,
+        'handler_errors': dict(recorder.errors),
+        'push_seconds': round(push_seconds, 3),
+        'seconds': round(elapsed, 3),
+        'throughput': round(recorder.completed / elapsed, 2) if elapsed else None,
+        'latency': latency_summary(all_latencies),
+        'actions': {
+            action: latency_summary(recorder.latencies[action]) for action in sorted(sent)
+        },
+        'event_loop_lag': latency_summary(lag),
+        'cpu_seconds': round(cpu, 3),
+        'cpu_utilization': round(cpu / elapsed, 3) if elapsed else None,
+        'db': recorder.db_summary(elapsed),
+        'api_calls': api_calls,
+    }
+    # Whatever is still running counts against the next step otherwise
+    recorder.pushed.clear()
+    print_step(row, out)
+    return row
+
+
+def print_step(row, out):
+    latency = row['latency']
+    db = row['db']
+    print(
+        f"{row['offered_rate']:>7g}/s offered  {row['throughput'] or 0:7.1f}/s handled  "
+        f"{row['completed']}/{row['sent']} done  "
+        f"p50 {latency['p50_ms'] or 0:7.1f} ms  p95 {latency['p95_ms'] or 0:7.1f} ms  "
+        f"p99 {latency['p99_ms'] or 0:7.1f} ms  loop lag p99 {row['event_loop_lag']['p99_ms'] or 0:6.1f} ms  "
+        f"CPU {row['cpu_utilization'] or 0:4.0%}",
+        file=out
+    )
+    print(
+        f"{'':>9} DB {db['calls']} calls ({db['calls_per_sec'] or 0:.0f}/s), "
+        f"p95 {db['latency']['p95_ms'] or 0:.1f} ms, peak {db['peak_in_flight']} in flight, "
+        f"{sum(db['errors'].values())} errors; slowest: "
+        + ', '.join(f"{name} p95 {stats['p95_ms']} ms" for name, stats in list(db['methods'].items())[:3]),
+        file=out, flush=True
+    )
+    for action, stats in row['actions'].items():
+        print(
+            f"{'':>9} {action:<14} {stats['count']:>6}  p50 {stats['p50_ms'] or 0:7.1f}  "
+            f"p95 {stats['p95_ms'] or 0:7.1f}  p99 {stats['p99_ms'] or 0:7.1f} ms",
+            file=out
+        )
+
+
+async def seed(db, users, pending):
+    """Approved users for the scripted traffic and pending access requests for the admin views"""
+    await db.bulk_approve_users(range(APPROVED_BASE, APPROVED_BASE + users))
+    for index in range(pending):
+        user_id = STRANGER_BASE - 1 - index
+        await db.create_access_request(user_id, f"pending{user_id}", f"Pending{user_id}", "Please")
+
+
+async def run_load_test(args, api_root, links, out):
+    # Imported here: the bot reads its configuration from the environment set up in main()
+    import aiohttp
+    import bot as bot_module
+    from config import ALLOWED_UPDATES
+    
+    recorder = Recorder()
+    application = bot_module.build_application()
+    application.add_error_handler(recorder.error)
+    recorder.wrap_update_processor(application.update_processor)
+    
+    await application.initialize()
+    await bot_module.post_init(application)
+    await seed(bot_module.db, args.users, args.pending)
+    recorder.wrap_storage(bot_module.db)
+    await application.updater.start_polling(poll_interval=0, timeout=10, allowed_updates=ALLOWED_UPDATES)
+    await application.start()
+    
+    scenario = Scenario(args.mix, args.users, links, args.seed)
+    results = []
+    try:
+        async with aiohttp.ClientSession() as session:
+            if args.warmup:
+                with open(os.devnull, 'w') as devnull:
+                    await run_step(
+                        session, api_root, scenario, recorder, args.rates[0], args.warmup, args.drain_timeout, devnull
+                    )
+            for rate in args.rates:
+                row = await run_step(
+                    session, api_root, scenario, recorder, rate, args.duration, args.drain_timeout, out
+                )
+                results.append(row)
+    finally:
+        await application.updater.stop()
+        await application.stop()
+        await bot_module.post_shutdown(application)
+        await application.shutdown()
+    return results
+
+
+def max_sustainable_rate(results, slo_ms):
+    """Highest offered rate with every update handled and p95 latency within the SLO"""
+    best = None
+    for row in results:
+        if row['timed_out'] == 0 and (row['latency']['p95_ms'] or 0) <= slo_ms:
+            best = row['offered_rate']
+        else:
+            break
+    return best
+
+
+def metadata(args):
+    import config
+    return {
+        'started': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'mix': args.mix,
+        'rates': args.rates,
+        'duration': args.duration,
+        'users': args.users,
+        'links': args.links,
+        'api_latency_ms': args.api_latency_ms,
+        'config': {
+            name: getattr(config, name) for name in (
+                'STORAGE_BACKEND', 'CONCURRENT_UPDATES', 'MAX_PENDING_UPDATES', 'DB_THREADS',
+                'DB_GROUP_COMMIT_MS', 'DB_GROUP_COMMIT_MAX',
+            )
+        },
+    }
+
+
+def comma_list(convert):
+    return lambda value: [convert(item) for item in value.split(',') if item]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--mix', type=parse_mix, default=MIXES['mixed'],
+                        help=f"{', '.join(MIXES)} or action=weight,... (actions: {', '.join(Scenario.ACTIONS)})")
+    parser.add_argument('--rates', type=comma_list(float), default=[10, 25, 50, 100, 200],
+                        help='Comma-separated update rates (updates/s), one step each')
+    parser.add_argument('--duration', type=float, default=15, help='Seconds per step')
+    parser.add_argument('--warmup', type=float, default=3, help='Unreported seconds at the first rate')
+    parser.add_argument('--drain-timeout', type=float, default=30, help='Seconds to wait for a step to finish')
+    parser.add_argument('--users', type=int, default=500, help='Approved users sending the traffic')
+    parser.add_argument('--pending', type=int, default=50, help='Pending access requests to seed')
+    parser.add_argument('--links', type=int, default=20, help='Distinct links sent')
+    parser.add_argument('--media-mb', type=float, default=2, help='Size of the linked media (downloads)')
+    parser.add_argument('--api-latency-ms', type=float, default=0, help='Delay the fake Bot API adds to every call')
+    parser.add_argument('--slo-ms', type=float, default=500, help='p95 latency target for the summary')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='Results file (default: benchmarks/results/load-<time>.json)')
+    parser.add_argument('--verbose', action='store_true', help="Show the bot's log")
+    args = parser.parse_args()
+    
+    from benchmarks import media_server, mock_bot_api
+    
+    out = sys.stdout
+    output = os.path.abspath(
+        args.output or os.path.join(RESULTS_FOLDER, f"load-{datetime.now():%Y%m%d-%H%M%S}.json")
+    )
+    cwd = os.getcwd()
+    workdir = tempfile.mkdtemp(prefix='bot-load-')
+    media_port, api_port = free_port(), free_port()
+    servers = [
+        start_server(media_server.serve, port=media_port, size_mb=args.media_mb),
+        start_server(mock_bot_api.serve, port=api_port, latency=args.api_latency_ms / 1000),
+    ]
+    api_root = f"http://127.0.0.1:{api_port}"
+    links = [f"http://127.0.0.1:{media_port}/video/load-{index}.mp4" for index in range(args.links)]
+    
+    # The bot's configuration is read at import time, and DOWNLOAD_FOLDER is relative to the working directory
+    os.environ.update({
+        'BOT_TOKEN': BOT_TOKEN,
+        'BOT_API_URL': f"{api_root}/bot",
+        'BOT_MODE': 'polling',
+        'ADMIN_USER_ID': str(ADMIN_ID),
+        'DATABASE_PATH': os.path.join(workdir, 'load.db'),
+        'METRICS_PORT': '0',
+    })
+    os.environ.setdefault('STORAGE_BACKEND', 'sqlite')
+    os.environ.setdefault('STAGING_MIN_FREE_MB', '256')
+    sys.path.insert(0, REPO_ROOT)
+    os.chdir(workdir)
+    
+    try:
+        meta = metadata(args)
+        if not args.verbose:
+            import logging
+            logging.disable(logging.WARNING)
+        # yt-dlp prints to stdout from the download threads
+        with open(os.devnull, 'w') as devnull:
+            with contextlib.redirect_stdout(devnull) if not args.verbose else contextlib.nullcontext():
+                results = asyncio.run(run_load_test(args, api_root, links, out))
+    finally:
+        for server in servers:
+            server.terminate()
+            server.join()
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+    
+    best = max_sustainable_rate(results, args.slo_ms)
+    print(
+        f"Highest rate with p95 <= {args.slo_ms:g} ms and nothing dropped: "
+        f"{f'{best:g} updates/s' if best is not None else 'none of the tested rates'}",
+        file=out
+    )
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump({'metadata': meta, 'max_sustainable_rate': best, 'results': results}, f, indent=2)
+    print(f"Results saved to {output}", file=out)
+
+
+if __name__ == '__main__':
+    main()
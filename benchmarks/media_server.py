@@ -0,0 +1,172 @@
+"""Synthetic media origin for download benchmarks.
+
+Serves the same number of bytes in each delivery style yt-dlp handles:
+    
+    /video/<name>.mp4     progressive download (Range requests supported)
+    /audio/<name>.m4a     audio only, also .mp3
+    /hls/<name>.m3u8      HLS media playlist of <name>/seg-N.ts segments
+    /dash/<name>.mpd      DASH manifest (one muxed representation) of <name>/seg-N.m4s
+
+The payload is random filler, not playable media, so anything that decodes
+it (ffmpeg remuxes and transcodes) fails; downloads, fragment handling and
+uploads are exercised for real. <name> only makes URLs unique, so every job
+misses the media info, single-flight and file_id caches.
+    
+    python -m benchmarks.media_server --port 8782 --size-mb 20
+"""
+import argparse
+import math
+import os
+
+from aiohttp import web
+
+BLOCK_SIZE = 1024 * 1024
+CONTENT_TYPES = {
+    'mp4': 'video/mp4',
+    'm4a': 'audio/mp4',
+    'mp3': 'audio/mpeg',
+    'ts': 'video/mp2t',
+    'm4s': 'video/iso.segment',
+}
+
+
+class MediaServer:
+    """aiohttp app serving size_mb of filler per media item, split into segment_mb fragments for HLS/DASH"""
+    def __init__(self, size_mb=20, segment_mb=1, duration=60):
+        self.size = int(size_mb * 1024 * 1024)
+        self.segment_size = int(segment_mb * 1024 * 1024)
+        self.duration = duration
+        self.block = os.urandom(BLOCK_SIZE)
+    
+    @property
+    def segments(self):
+        return max(1, math.ceil(self.size / self.segment_size))
+    
+    def segment_length(self, index):
+        return min(self.segment_size, self.size - index * self.segment_size)
+    
+    async def _send(self, request, length, content_type):
+        """Stream `length` bytes of filler, honouring a single byte Range"""
+        start, end = 0, length - 1
+        status = 200
+        range_header = request.headers.get('Range', '')
+        if range_header.startswith('bytes='):
+            first, _, last = range_header[6:].split(',')[0].partition('-')
+            if first:
+                start = int(first)
+                end = min(int(last), end) if last else end
+            elif last:
+                start = max(0, length - int(last))
+            if start > end:
+                return web.Response(status=416, headers={'Content-Range': f'bytes */{length}'})
+            status = 206
+        
+        response = web.StreamResponse(status=status, headers={
+            'Content-Type': content_type,
+            'Content-Length': str(end - start + 1),
+            'Accept-Ranges': 'bytes',
+        })
+        if status == 206:
+            response.headers['Content-Range'] = f'bytes {start}-{end}/{length}'
+        await response.prepare(request)
+        if request.method == 'HEAD':
+            return response
+        
+        position = start
+        try:
+            while position <= end:
+                offset = position % BLOCK_SIZE
+                chunk = self.block[offset:offset + min(BLOCK_SIZE - offset, end - position + 1)]
+                await response.write(chunk)
+                position += len(chunk)
+            await response.write_eof()
+        except ConnectionError:
+            # yt-dlp's generic extractor hangs up after reading the headers
+            pass
+        return response
+    
+    async def handle_file(self, request):
+        ext = request.match_info['ext']
+        if ext not in CONTENT_TYPES:
+            raise web.HTTPNotFound()
+        return await self._send(request, self.size, CONTENT_TYPES[ext])
+    
+    async def handle_segment(self, request):
+        index = int(request.match_info['index'])
+        if index >= self.segments:
+            raise web.HTTPNotFound()
+        return await self._send(request, self.segment_length(index), CONTENT_TYPES[request.match_info['ext']])
+    
+    async def handle_init(self, request):
+        return await self._send(request, 1024, CONTENT_TYPES['mp4'])
+    
+    async def handle_hls(self, request):
+        name = request.match_info['name']
+        seconds = self.duration / self.segments
+        lines = [
+            '#EXTM3U',
+            '#EXT-X-VERSION:3',
+            f'#EXT-X-TARGETDURATION:{math.ceil(seconds)}',
+            '#EXT-X-MEDIA-SEQUENCE:0',
+        ]
+        for index in range(self.segments):
+            lines += [f'#EXTINF:{seconds:.3f},', f'{name}/seg-{index}.ts']
+        lines.append('#EXT-X-ENDLIST')
+        return web.Response(text='\n'.join(lines) + '\n', content_type='application/vnd.apple.mpegurl')
+    
+    async def handle_dash(self, request):
+        name = request.match_info['name']
+        seconds = self.duration / self.segments
+        bandwidth = int(self.size * 8 / self.duration)
+        segment_urls = '\n'.join(
+            f'          <SegmentURL media="{name}/seg-{index}.m4s"/>' for index in range(self.segments)
+        )
+        manifest = f'''<?xml version="1.0" encoding="UTF-8"?>
+<MPD xmlns="urn:mpeg:dash:schema:mpd:2011" type="static" profiles="urn:mpeg:dash:profile:isoff-main:2011"
+     mediaPresentationDuration="PT{self.duration}S" minBufferTime="PT2S">
+  <Period>
+    <AdaptationSet mimeType="video/mp4">
+      <Representation id="muxed" bandwidth="{bandwidth}" width="1280" height="720" codecs="avc1.4d401f,mp4a.40.2">
+        <SegmentList timescale="1000" duration="{int(seconds * 1000)}">
+          <Initialization sourceURL="{name}/init.mp4"/>
+{segment_urls}
+        </SegmentList>
+      </Representation>
+    </AdaptationSet>
+  </Period>
+</MPD>
+'''
+        return web.Response(text=manifest, content_type='application/dash+xml')
+    
+    def make_app(self):
+        app = web.Application()
+        app.router.add_get('/video/{name}.{ext}', self.handle_file)
+        app.router.add_get('/audio/{name}.{ext}', self.handle_file)
+        app.router.add_get('/hls/{name}.m3u8', self.handle_hls)
+        app.router.add_get('/hls/{name}/seg-{index:\\d+}.{ext:ts}', self.handle_segment)
+        app.router.add_get('/dash/{name}.mpd', self.handle_dash)
+        app.router.add_get('/dash/{name}/init.mp4', self.handle_init)
+        app.router.add_get('/dash/{name}/seg-{index:\\d+}.{ext:m4s}', self.handle_segment)
+        return app
+
+
+def serve(host='127.0.0.1', port=8782, size_mb=20, segment_mb=1, duration=60):
+    """Run the media server until interrupted (blocking)"""
+    app = MediaServer(size_mb, segment_mb, duration).make_app()
+    web.run_app(app, host=host, port=port, print=None, access_log=None)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8782)
+    parser.add_argument('--size-mb', type=float, default=20, help='Size of every media item')
+    parser.add_argument('--segment-mb', type=float, default=1, help='HLS/DASH fragment size')
+    parser.add_argument('--duration', type=int, default=60, help='Duration the playlists claim, in seconds')
+    args = parser.parse_args()
+    print(f"Serving synthetic media on http://{args.host}:{args.port}/")
+    serve(args.host, args.port, args.size_mb, args.segment_mb, args.duration)
+
+
+if __name__ == '__main__':
+    main()
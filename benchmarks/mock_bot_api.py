@@ -0,0 +1,185 @@
+"""Local stand-in for the Telegram Bot API, for benchmarks and load tests.
+
+Point a bot at it with base_url=f"http://{host}:{port}/bot" (BOT_API_URL).
+Send methods answer with plausible Message objects (uploads are read and
+counted, not stored), other methods answer True. Updates POSTed to /updates
+(an Update dict or a list of them) are handed out by getUpdates, long
+polling included. GET /stats returns call counts, latency and uploaded bytes
+as JSON; POST /reset clears them.
+    
+    python -m benchmarks.mock_bot_api --port 8781 --latency-ms 50
+"""
+import argparse
+import asyncio
+import itertools
+import sys
+import time
+from collections import Counter
+
+from aiohttp import web
+
+BOT_USER = {
+    'id': 100000,
+    'is_bot': True,
+    'first_name': 'Mock Bot',
+    'username': 'mock_bot',
+    'can_join_groups': True,
+    'can_read_all_group_messages': False,
+    'supports_inline_queries': False,
+}
+
+# Send method -> (message field, extra fields of the sent media)
+MEDIA_METHODS = {
+    'sendVideo': ('video', {'width': 1280, 'height': 720, 'duration': 60}),
+    'sendAudio': ('audio', {'duration': 60}),
+    'sendDocument': ('document', {}),
+}
+
+
+class MockBotAPI:
+    """aiohttp app answering Bot API calls like Telegram would"""
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.message_ids = itertools.count(1)
+        self.file_ids = itertools.count(1)
+        # Updates not confirmed by a getUpdates offset yet, in update_id order
+        self.updates = []
+        self.new_updates = asyncio.Event()
+        self.reset()
+    
+    def reset(self):
+        self.calls = Counter()
+        self.uploaded_bytes = 0
+        self.seconds = Counter()
+        self.started = time.monotonic()
+    
+    def stats(self):
+        return {
+            'calls': dict(self.calls),
+            'seconds': {method: round(total, 4) for method, total in self.seconds.items()},
+            'uploaded_bytes': self.uploaded_bytes,
+            'pending_updates': len(self.updates),
+            'elapsed': round(time.monotonic() - self.started, 3),
+        }
+    
+    async def _params(self, request):
+        """Request parameters, whatever the encoding. Uploaded files are counted and dropped."""
+        content_type = request.content_type
+        if content_type == 'application/json':
+            return await request.json()
+        if content_type == 'multipart/form-data':
+            params = {}
+            reader = await request.multipart()
+            async for part in reader:
+                if part.filename:
+                    size = 0
+                    while True:
+                        chunk = await part.read_chunk(256 * 1024)
+                        if not chunk:
+                            break
+                        size += len(chunk)
+                    self.uploaded_bytes += size
+                    params[part.name] = {'filename': part.filename, 'size': size}
+                else:
+                    params[part.name] = await part.text()
+            return params
+        return dict(await request.post())
+    
+    def _message(self, params, **fields):
+        chat_id = params.get('chat_id', 0)
+        try:
+            chat_id = int(chat_id)
+        except (TypeError, ValueError):
+            pass
+        message = {
+            'message_id': int(params.get('message_id') or next(self.message_ids)),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': BOT_USER,
+        }
+        message.update(fields)
+        return message
+    
+    def push_updates(self, updates):
+        self.updates.extend(updates)
+        self.new_updates.set()
+    
+    async def get_updates(self, params):
+        """getUpdates: confirm updates below offset, then wait up to timeout for new ones"""
+        offset = int(params.get('offset') or 0)
+        limit = int(params.get('limit') or 100)
+        timeout = float(params.get('timeout') or 0)
+        self.updates = [update for update in self.updates if update['update_id'] >= offset]
+        if not self.updates and timeout:
+            self.new_updates.clear()
+            try:
+                await asyncio.wait_for(self.new_updates.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return self.updates[:limit]
+    
+    def answer(self, method, params):
+        """The result of a Bot API method call"""
+        if method == 'getMe':
+            return BOT_USER
+        if method in ('sendMessage', 'editMessageText'):
+            return self._message(params, text=params.get('text', ''))
+        if method in MEDIA_METHODS:
+            field, extra = MEDIA_METHODS[method]
+            file_id = next(self.file_ids)
+            media = {'file_id': f"mock-file-{file_id}", 'file_unique_id': f"mock-unique-{file_id}", **extra}
+            return self._message(params, caption=params.get('caption'), **{field: media})
+        return True
+    
+    async def handle(self, request):
+        method = request.match_info['method']
+        started = time.monotonic()
+        params = await self._params(request)
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if method == 'getUpdates':
+            result = await self.get_updates(params)
+        else:
+            result = self.answer(method, params)
+        self.calls[method] += 1
+        self.seconds[method] += time.monotonic() - started
+        return web.json_response({'ok': True, 'result': result})
+    
+    async def handle_stats(self, request):
+        return web.json_response(self.stats())
+    
+    async def handle_push_updates(self, request):
+        updates = await request.json()
+        self.push_updates(updates if isinstance(updates, list) else [updates])
+        return web.json_response({'ok': True})
+    
+    async def handle_reset(self, request):
+        self.reset()
+        return web.json_response({'ok': True})
+    
+    def make_app(self):
+        app = web.Application(client_max_size=sys.maxsize)
+        app.router.add_get('/stats', self.handle_stats)
+        app.router.add_post('/reset', self.handle_reset)
+        app.router.add_post('/updates', self.handle_push_updates)
+        app.router.add_route('*', '/bot{token}/{method}', self.handle)
+        return app
+
+
+def serve(host='127.0.0.1', port=8781, latency=0.0):
+    """Run the mock API until interrupted (blocking)"""
+    web.run_app(MockBotAPI(latency).make_app(), host=host, port=port, print=None, access_log=None)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8781)
+    parser.add_argument('--latency-ms', type=float, default=0, help='Delay added to every call')
+    args = parser.parse_args()
+    print(f"Mock Bot API on http://{args.host}:{args.port}/bot<token>/")
+    serve(args.host, args.port, args.latency_ms / 1000)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,6 +2,7 @@ import asyncio
 import logging
 import os
 import re
+import time
 from telegram import (
     Update, 
     InlineKeyboardButton, 
@@ -19,10 +20,23 @@ from telegram.ext import (
 )
 from telegram.constants import ParseMode
 
-from config import BOT_TOKEN, ADMIN_USER_ID
-from database import Database
+from config import (
+    BOT_TOKEN, BOT_API_URL, ADMIN_USER_ID, BOT_MODE, ALLOWED_UPDATES, CONCURRENT_UPDATES, MAX_FILE_SIZE_MB
+)
+from storage import create_storage
 from user_manager import UserManager
 from downloader import MediaDownloader
+from download_queue import DownloadScheduler
+from media_cache import MediaCache
+from uploader import StreamingUploader
+from rate_limit import RateLimitedSender
+from progress import format_bytes
+from broadcast import BroadcastEngine
+from update_processor import PerUserUpdateProcessor
+from quota import QuotaManager
+from staging import StagingArea
+from metrics import MetricsServer, UPLOAD_SECONDS, UPLOADED_BYTES, ERRORS
+from tracing import JobTrace, TraceWriter, PHASES, phase_stats
 
 # Enable logging
 logging.basicConfig(
@@ -32,9 +46,18 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 # Initialize components
-db = Database()
+db = create_storage()
 user_manager = UserManager(db)
 downloader = MediaDownloader()
+scheduler = DownloadScheduler(db)
+media_cache = MediaCache(db)
+uploader = StreamingUploader()
+sender = RateLimitedSender()
+broadcast_engine = BroadcastEngine(db, sender)
+quota = QuotaManager(db)
+staging = StagingArea(in_use=downloader.files_in_use, media_cache=media_cache)
+metrics_server = MetricsServer()
+trace_writer = TraceWriter(db)
 
 # Store user download context
 user_download_context = {}
@@ -46,9 +69,12 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = user.id
     
     # Add or update user in database
-    db_user = db.get_user(user_id)
-    if not db_user:
-        db.add_user(user_id, user.username, user.first_name, status='pending')
+    if await db.get_user_status(user_id) is None:
+        await db.add_user(user_id, user.username, user.first_name, status='pending')
+    
+    # A user who blocked the bot and comes back can receive broadcasts again
+    if await db.is_user_blocked(user_id):
+        await db.unblock_user(user_id)
     
     welcome_message = f"""
 🎬 <b>Video/Audio Downloader Bot</b>
@@ -76,7 +102,7 @@ You can download video and audio from various platforms using this bot.
 """
     
     # Check authorization
-    is_authorized = db.is_user_authorized(user_id)
+    is_authorized = await db.is_user_authorized(user_id)
     if is_authorized:
         welcome_message += "\n✅ You are authorized! Send a link now.\n"
     else:
@@ -91,12 +117,14 @@ You can download video and audio from various platforms using this bot.
     keyboard.append([InlineKeyboardButton("❓ Help", callback_data="help")])
     
     # Add admin button if user is admin
-    if db.is_admin(user_id):
+    if await db.is_admin(user_id):
         welcome_message += """
 
 <b>👑 Admin Commands (Copy):</b>
 <code>/adduser user_id</code>
 <code>/removeuser user_id</code>
+<code>/setquota user_id</code>
+<code>/stats</code>
 """
         keyboard.append([InlineKeyboardButton("👑 Admin Panel", callback_data="admin_panel")])
     
@@ -109,10 +137,10 @@ You can download video and audio from various platforms using this bot.
     
     if not is_authorized:
          reply_keyboard.insert(0, [KeyboardButton("📝 Request Access")])
-         
-    if db.is_admin(user_id):
+    
+    if await db.is_admin(user_id):
         reply_keyboard.append([KeyboardButton("👑 Admin Panel")])
-        
+    
     reply_markup_persistent = ReplyKeyboardMarkup(reply_keyboard, resize_keyboard=True)
     
     if update.callback_query:
@@ -163,7 +191,7 @@ async def request_access(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = user.id
     
     # Check if already authorized
-    if db.is_user_authorized(user_id):
+    if await db.is_user_authorized(user_id):
         await update.message.reply_text(
             "✅ You are already authorized! You can use the bot."
         )
@@ -172,7 +200,7 @@ async def request_access(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Get message if provided
     message = " ".join(context.args) if context.args else ""
     
-    result = user_manager.request_access(
+    result = await user_manager.request_access(
         user_id,
         user.username,
         user.first_name,
@@ -194,7 +222,7 @@ async def request_access(update: Update, context: ContextTypes.DEFAULT_TYPE):
             admin_message += f"<b>Message:</b> {message}\n"
         
         # Get the request ID
-        requests = db.get_pending_requests()
+        requests = await db.get_pending_requests()
         if requests:
             target_req = None
             for req in requests:
@@ -224,23 +252,52 @@ async def request_access(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     logger.error(f"Error sending admin notification: {e}")
 
 
-async def list_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def get_users_page(context, cursors_key, page, status=None, per_page=5):
+    """Fetch one page of users for a paginated admin view.
+    
+    The keyset cursor each page starts after is kept in context.user_data, so
+    callback data only has to carry the page number. A page whose cursor is
+    unknown (e.g. after a restart) falls back to the first page.
+    Returns (page, rows, has_next, total).
+    """
+    cursors = context.user_data.setdefault(cursors_key, {0: None})
+    if page not in cursors:
+        page = 0
+    
+    rows = await db.get_users_page(status, cursors[page], per_page)
+    if rows:
+        cursors[page + 1] = (rows[-1][4], rows[-1][0])  # (created_at, user_id)
+    
+    total = await db.count_users(status)
+    return page, rows, (page + 1) * per_page < total, total
+
+
+async def list_users(update: Update, context: ContextTypes.DEFAULT_TYPE, page=0):
     """Handle /listusers command (admin only)"""
     user_id = update.effective_user.id if update.effective_user else update.callback_query.from_user.id
     
-    if not db.is_admin(user_id):
+    if not await db.is_admin(user_id):
         await context.bot.send_message(chat_id=user_id, text="❌ This command is for admins only.")
         return
     
-    users_list = user_manager.get_all_users_formatted()
+    PER_PAGE = 10
+    page, users, has_next, total = await get_users_page(context, 'list_users_cursors', page, per_page=PER_PAGE)
+    users_list = await user_manager.get_all_users_formatted(users, page, max(1, -(-total // PER_PAGE)))
     
     # Split if too long (basic handling)
     if len(users_list) > 4000:
         users_list = users_list[:4000] + "\n... (more)"
-
-    keyboard = [[InlineKeyboardButton("🔙 Back", callback_data="admin_panel")]]
+    
+    nav_row = []
+    if page > 0:
+        nav_row.append(InlineKeyboardButton("⬅️ Prev", callback_data=f"admin_list_users:{page-1}"))
+    if has_next:
+        nav_row.append(InlineKeyboardButton("Next ➡️", callback_data=f"admin_list_users:{page+1}"))
+    
+    keyboard = [nav_row] if nav_row else []
+    keyboard.append([InlineKeyboardButton("🔙 Back", callback_data="admin_panel")])
     reply_markup = InlineKeyboardMarkup(keyboard)
-
+    
     if update.callback_query:
         await update.callback_query.edit_message_text(users_list, reply_markup=reply_markup, parse_mode=ParseMode.HTML)
     else:
@@ -251,11 +308,11 @@ async def pending_requests(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /pending command (admin only)"""
     user_id = update.effective_user.id if update.effective_user else update.callback_query.from_user.id
     
-    if not db.is_admin(user_id):
+    if not await db.is_admin(user_id):
         await context.bot.send_message(chat_id=user_id, text="❌ This command is for admins only.")
         return
     
-    requests_list = user_manager.get_pending_requests_formatted()
+    requests_list = await user_manager.get_pending_requests_formatted()
     
     keyboard = [
         [InlineKeyboardButton("✅ Bulk Manage", callback_data="admin_pending_select:0")],
@@ -273,7 +330,7 @@ async def add_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /adduser command (admin only)"""
     user_id = update.effective_user.id
     
-    if not db.is_admin(user_id):
+    if not await db.is_admin(user_id):
         await update.message.reply_text("❌ This command is for admins only.")
         return
     
@@ -283,7 +340,7 @@ async def add_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     try:
         target_user_id = int(context.args[0])
-        result = user_manager.add_user_directly(target_user_id)
+        result = await user_manager.add_user_directly(target_user_id)
         
         await update.message.reply_text(result['message'])
         
@@ -305,7 +362,7 @@ async def remove_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle /removeuser command (admin only)"""
     user_id = update.effective_user.id
     
-    if not db.is_admin(user_id):
+    if not await db.is_admin(user_id):
         await update.message.reply_text("❌ This command is for admins only.")
         return
     
@@ -315,24 +372,94 @@ async def remove_user(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     try:
         target_user_id = int(context.args[0])
-        result = user_manager.remove_user(target_user_id)
+        result = await user_manager.remove_user(target_user_id)
         await update.message.reply_text(result['message'])
     except ValueError:
         await update.message.reply_text("❌ Invalid user ID. Using number.")
 
 
+async def set_quota(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle /setquota command (admin only)"""
+    user_id = update.effective_user.id
+    
+    if not await db.is_admin(user_id):
+        await update.message.reply_text("❌ This command is for admins only.")
+        return
+    
+    if not context.args or len(context.args) not in (1, 3):
+        await update.message.reply_text(
+            "Usage: /setquota <user_id> [<downloads_per_hour> <MB_per_day>]\n\n"
+            "Use - for the default limit and 0 for no limit."
+        )
+        return
+    
+    try:
+        target_user_id = int(context.args[0])
+        if len(context.args) == 3:
+            downloads_per_hour, mb_per_day = [None if arg == '-' else int(arg) for arg in context.args[1:]]
+            if (downloads_per_hour or 0) < 0 or (mb_per_day or 0) < 0:
+                raise ValueError
+            bytes_per_day = mb_per_day * 1024 * 1024 if mb_per_day is not None else None
+            await quota.set_limits(target_user_id, downloads_per_hour, bytes_per_day)
+        
+        await update.message.reply_text(await quota.describe(target_user_id), parse_mode=ParseMode.HTML)
+    except ValueError:
+        await update.message.reply_text("❌ Invalid value. Please enter numbers (or - for default).")
+
+
+async def job_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle /stats [hours] command (admin only): job phase timings"""
+    user_id = update.effective_user.id
+    
+    if not await db.is_admin(user_id):
+        await update.message.reply_text("❌ This command is for admins only.")
+        return
+    
+    try:
+        hours = int(context.args[0]) if context.args else 24
+        if hours <= 0:
+            raise ValueError
+    except ValueError:
+        await update.message.reply_text("Usage: /stats [hours]")
+        return
+    
+    # Include traces still waiting to be saved
+    await trace_writer.flush()
+    jobs, outcomes, stats = await phase_stats(db, hours)
+    if not jobs:
+        await update.message.reply_text(f"📊 No download jobs in the last {hours}h.")
+        return
+    
+    def seconds(value):
+        return '-' if value is None else f"{value:.2f}s"
+    
+    lines = [f"{'phase':<12}{'jobs':>6}{'p50':>10}{'p95':>10}"]
+    for phase in PHASES + ('total',):
+        count, p50, p95 = stats[phase]
+        lines.append(f"{phase:<12}{count:>6}{seconds(p50):>10}{seconds(p95):>10}")
+    table = "\n".join(lines)
+    outcome_text = ", ".join(f"{outcome} {count}" for outcome, count in sorted(outcomes.items(), key=lambda item: -item[1]))
+    
+    await update.message.reply_text(
+        f"📊 <b>Download Jobs (last {hours}h)</b>\n\n"
+        f"Jobs: {jobs} ({outcome_text})\n\n"
+        f"<pre>{table}</pre>",
+        parse_mode=ParseMode.HTML
+    )
+
+
 async def approve_request_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle dynamic /approve_<id> commands - Legacy support"""
     # This is kept for backward compatibility if manual commands are used
     user_id = update.effective_user.id
-    if not db.is_admin(user_id): return
+    if not await db.is_admin(user_id): return
     
     command = update.message.text
     match = re.match(r'/approve_(\d+)', command)
     if not match: return
     
     request_id = int(match.group(1))
-    result = user_manager.approve_request(request_id)
+    result = await user_manager.approve_request(request_id)
     await update.message.reply_text(result['message'])
     
     if result['success']:
@@ -349,14 +476,14 @@ async def approve_request_handler(update: Update, context: ContextTypes.DEFAULT_
 async def reject_request_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle dynamic /reject_<id> commands - Legacy support"""
     user_id = update.effective_user.id
-    if not db.is_admin(user_id): return
+    if not await db.is_admin(user_id): return
     
     command = update.message.text
     match = re.match(r'/reject_(\d+)', command)
     if not match: return
     
     request_id = int(match.group(1))
-    result = user_manager.reject_request(request_id)
+    result = await user_manager.reject_request(request_id)
     await update.message.reply_text(result['message'])
     
     if result['success']:
@@ -373,14 +500,14 @@ async def reject_request_handler(update: Update, context: ContextTypes.DEFAULT_T
 async def approve_user_direct_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle dynamic /approveuser_<id> commands"""
     user_id = update.effective_user.id
-    if not db.is_admin(user_id): return
+    if not await db.is_admin(user_id): return
     
     command = update.message.text
     match = re.match(r'/approveuser_(\d+)', command)
     if not match: return
     
     target_user_id = int(match.group(1))
-    result = user_manager.add_user_directly(target_user_id)
+    result = await user_manager.add_user_directly(target_user_id)
     await update.message.reply_text(result['message'])
     
     if result['success']:
@@ -397,14 +524,14 @@ async def approve_user_direct_handler(update: Update, context: ContextTypes.DEFA
 async def reject_user_direct_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle dynamic /rejectuser_<id> commands"""
     user_id = update.effective_user.id
-    if not db.is_admin(user_id): return
+    if not await db.is_admin(user_id): return
     
     command = update.message.text
     match = re.match(r'/rejectuser_(\d+)', command)
     if not match: return
     
     target_user_id = int(match.group(1))
-    result = user_manager.remove_user(target_user_id)
+    result = await user_manager.remove_user(target_user_id)
     await update.message.reply_text(result['message'])
 
 
@@ -421,48 +548,31 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             context.user_data['awaiting_broadcast_message'] = False
             await update.message.reply_text("❌ Broadcast cancelled.")
             return
-
+        
         # Sending Broadcast
         mode = context.user_data.get('broadcast_mode')
         users_to_message = []
         
         if mode == 'all':
-            all_users = db.get_all_users()
+            all_users = await db.get_all_users()
             users_to_message = [u[0] for u in all_users]
         elif mode == 'selected':
             selected = context.user_data.get('broadcast_selected', set())
             users_to_message = list(selected)
-            
+        
         if not users_to_message:
             await update.message.reply_text("⚠️ No users found to message.")
             context.user_data['awaiting_broadcast_message'] = False
             return
-            
-        status_msg = await update.message.reply_text(f"⏳ Sending broadcast to {len(users_to_message)} users...")
         
-        success_count = 0
-        fail_count = 0
+        status_msg = await update.message.reply_text(f"⏳ Sending broadcast to {len(users_to_message)} users...")
         
-        for uid in users_to_message:
-            try:
-                await context.bot.send_message(chat_id=uid, text=text)
-                success_count += 1
-            except Exception as e:
-                logger.error(f"Failed to send broadcast to {uid}: {e}")
-                fail_count += 1
-            # Small delay to avoid hitting limits if list is huge
-            await asyncio.sleep(0.05)
-            
-        await status_msg.edit_text(
-            f"✅ <b>Broadcast Complete</b>\n\n"
-            f"🟢 Success: {success_count}\n"
-            f"🔴 Failed: {fail_count}",
-            parse_mode=ParseMode.HTML
-        )
+        # Runs in the background within Telegram's rate limits and reports progress on status_msg
+        await broadcast_engine.broadcast(user_id, text, users_to_message, status_msg)
         
         context.user_data['awaiting_broadcast_message'] = False
         return
-
+    
     # Handle Reply Keyboard Buttons
     if text == "🏠 Main Menu":
         await start(update, context)
@@ -486,10 +596,10 @@ Example:
         await update.message.reply_text(info_text, parse_mode=ParseMode.HTML)
         return
     elif text == "👑 Admin Panel":
-         if not db.is_admin(user_id):
+         if not await db.is_admin(user_id):
             await update.message.reply_text("❌ Access Denied")
             return
-            
+         
          admin_text = "<b>👑 Admin Panel</b>\n\nChoose an option below:"
          keyboard = [
             [InlineKeyboardButton("👥 Users List", callback_data="admin_list_users")],
@@ -498,9 +608,9 @@ Example:
          ]
          await update.message.reply_text(admin_text, parse_mode=ParseMode.HTML, reply_markup=InlineKeyboardMarkup(keyboard))
          return
-
+    
     # Check authorization for other messages (downloads)
-    if not db.is_user_authorized(user_id):
+    if not await db.is_user_authorized(user_id):
         await update.message.reply_text(
             "⚠️ You are not authorized to use this bot.\n\n"
             "Click 'Request Access' button or send /request.",
@@ -520,17 +630,31 @@ Example:
     
     url = urls[0]  # Take the first URL
     
+    # Refuse early when the user is out of quota
+    refusal = await quota.check(user_id)
+    if refusal:
+        await update.message.reply_text(refusal)
+        return
+    
     # Send processing message
     status_message = await update.message.reply_text("⏳ Processing link...")
     
+    # The job's trace starts here and follows the link to download_and_send
+    trace = JobTrace(user_id, url)
+    traces = context.user_data.setdefault('traces', {})
+    traces[url] = trace
+    while len(traces) > 10:
+        traces.pop(next(iter(traces)))
+    
     # Get media info
     try:
         loop = asyncio.get_running_loop()
-        media_info = await loop.run_in_executor(None, lambda: downloader.get_media_info(url))
+        with trace.phase('extract'):
+            media_info = await loop.run_in_executor(None, lambda: downloader.get_media_info(url))
     except Exception as e:
         logger.error(f"Error getting media info: {e}")
         media_info = None
-
+    
     if not media_info:
         await status_message.edit_text("❌ Failed to process link. Ensure it is valid and public.")
         return
@@ -556,6 +680,26 @@ Example:
     )
 
 
+async def notify_batch(bot, admin_chat_id, action, user_ids, notice):
+    """Tell users about a bulk approve/reject, then report the delivery to the admin"""
+    try:
+        # Concurrently, within Telegram's rate limits
+        outcomes = await sender.send_many([
+            (uid, lambda uid=uid: bot.send_message(uid, notice, parse_mode=ParseMode.HTML))
+            for uid in user_ids
+        ])
+        await bot.send_message(
+            admin_chat_id,
+            f"📨 <b>Batch {action.title()} Notifications Sent</b>\n\n"
+            f"🟢 Success: {outcomes.count('sent')}\n"
+            f"🔴 Failed: {outcomes.count('failed')}\n"
+            f"🚫 Blocked: {outcomes.count('blocked')}",
+            parse_mode=ParseMode.HTML
+        )
+    except Exception as e:
+        logger.error(f"Notifying users of batch {action} failed: {e}")
+
+
 async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle button callbacks"""
     query = update.callback_query
@@ -568,11 +712,11 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if data == "start":
         await start(update, context)
         return
-        
+    
     elif data == "help":
         await help_command(update, context)
         return
-        
+    
     elif data == "request_info":
         info_text = """
 📝 <b>Request Access</b>
@@ -588,13 +732,13 @@ Example:
         keyboard = [[InlineKeyboardButton("🔙 Back", callback_data="start")]]
         await query.edit_message_text(info_text, parse_mode=ParseMode.HTML, reply_markup=InlineKeyboardMarkup(keyboard))
         return
-
+    
     # Admin Panel Handlers
     elif data == "admin_panel":
-        if not db.is_admin(user_id):
+        if not await db.is_admin(user_id):
             await query.edit_message_text("❌ Access Denied")
             return
-            
+        
         admin_text = "<b>👑 Admin Panel</b>\n\nChoose an option below:"
         keyboard = [
             [InlineKeyboardButton("� Broadcast Message", callback_data="admin_broadcast_menu")],
@@ -604,9 +748,9 @@ Example:
         ]
         await query.edit_message_text(admin_text, parse_mode=ParseMode.HTML, reply_markup=InlineKeyboardMarkup(keyboard))
         return
-
+    
     elif data == "admin_broadcast_menu":
-        if not db.is_admin(user_id): return
+        if not await db.is_admin(user_id): return
         
         text = "📢 <b>Broadcast Message</b>\n\nWho do you want to message?"
         keyboard = [
@@ -616,22 +760,18 @@ Example:
         ]
         await query.edit_message_text(text, parse_mode=ParseMode.HTML, reply_markup=InlineKeyboardMarkup(keyboard))
         return
-
+    
     elif data.startswith("admin_broadcast_select:"):
-        if not db.is_admin(user_id): return
+        if not await db.is_admin(user_id): return
         
         # Initialize selected set if not exists
         if 'broadcast_selected' not in context.user_data:
             context.user_data['broadcast_selected'] = set()
-            
+        
         page = int(data.split(":")[1])
-        users = db.get_all_users() # (id, username, first_name, ...)
         
         # Pagination setup (5 users per page to fit buttons)
-        PER_PAGE = 5
-        start_idx = page * PER_PAGE
-        end_idx = start_idx + PER_PAGE
-        current_users = users[start_idx:end_idx]
+        page, current_users, has_next, _ = await get_users_page(context, 'broadcast_cursors', page)
         
         keyboard = []
         selected = context.user_data['broadcast_selected']
@@ -649,12 +789,12 @@ Example:
         nav_row = []
         if page > 0:
             nav_row.append(InlineKeyboardButton("⬅️ Prev", callback_data=f"admin_broadcast_select:{page-1}"))
-        if end_idx < len(users):
+        if has_next:
             nav_row.append(InlineKeyboardButton("Next ➡️", callback_data=f"admin_broadcast_select:{page+1}"))
         
         if nav_row:
             keyboard.append(nav_row)
-            
+        
         # Action buttons
         keyboard.append([InlineKeyboardButton(f"✅ Done ({len(selected)} selected)", callback_data="admin_broadcast_input:selected")])
         keyboard.append([InlineKeyboardButton("🔙 Back", callback_data="admin_broadcast_menu")])
@@ -665,7 +805,7 @@ Example:
             reply_markup=InlineKeyboardMarkup(keyboard)
         )
         return
-
+    
     elif data.startswith("admin_broadcast_toggle:"):
         parts = data.split(":")
         target_uid = int(parts[1])
@@ -673,14 +813,14 @@ Example:
         
         if 'broadcast_selected' not in context.user_data:
             context.user_data['broadcast_selected'] = set()
-            
+        
         selected = context.user_data['broadcast_selected']
         
         if target_uid in selected:
             selected.remove(target_uid)
         else:
             selected.add(target_uid)
-            
+        
         # Refresh view (loop back to select handler logic basically)
         # We can't call the handler function easily recursively with 'data', so let's just trigger the select update
         # Actually simplest is to just re-construct the view here or redirect
@@ -691,11 +831,7 @@ Example:
         # Better: Separate render function. But for now, I'll just duplicate the render logic specific to this page refresh to save space/complexity
         
         # ... Re-render logic ...
-        users = db.get_all_users()
-        PER_PAGE = 5
-        start_idx = page * PER_PAGE
-        end_idx = start_idx + PER_PAGE
-        current_users = users[start_idx:end_idx]
+        page, current_users, has_next, _ = await get_users_page(context, 'broadcast_cursors', page)
         
         keyboard = []
         for u in current_users:
@@ -704,11 +840,11 @@ Example:
             is_checked = uid in selected
             mark = "✅" if is_checked else "⬜"
             keyboard.append([InlineKeyboardButton(f"{mark} {name} ({uid})", callback_data=f"admin_broadcast_toggle:{uid}:{page}")])
-            
+        
         nav_row = []
         if page > 0:
             nav_row.append(InlineKeyboardButton("⬅️ Prev", callback_data=f"admin_broadcast_select:{page-1}"))
-        if end_idx < len(users):
+        if has_next:
             nav_row.append(InlineKeyboardButton("Next ➡️", callback_data=f"admin_broadcast_select:{page+1}"))
         if nav_row: keyboard.append(nav_row)
         
@@ -720,7 +856,7 @@ Example:
         except Exception:
             pass # No change
         return
-
+    
     elif data.startswith("admin_broadcast_input:"):
         mode = data.split(":")[1]
         context.user_data['broadcast_mode'] = mode
@@ -733,27 +869,28 @@ Example:
                 await query.answer("❌ No users selected!", show_alert=True)
                 return
             count_str = f"{count} selected users"
-            
+        
         text = f"📢 <b>Broadcast: {count_str}</b>\n\nPlease type and send the message you want to broadcast.\n\nType /cancel to cancel."
         await query.edit_message_text(text, parse_mode=ParseMode.HTML, reply_markup=None)
         return
-
-    elif data == "admin_list_users":
-        await list_users(update, context)
+    
+    elif data == "admin_list_users" or data.startswith("admin_list_users:"):
+        page = int(data.split(":")[1]) if ":" in data else 0
+        await list_users(update, context, page)
         return
-
+    
     elif data == "admin_pending":
         await pending_requests(update, context)
         return
-        
+    
     # Admin Actions Handlers
     elif data.startswith("admin_approve:"):
-        if not db.is_admin(user_id):
+        if not await db.is_admin(user_id):
             await query.edit_message_text("❌ Access Denied")
             return
-            
+        
         request_id = int(data.split(":")[1])
-        result = user_manager.approve_request(request_id)
+        result = await user_manager.approve_request(request_id)
         
         new_text = f"{query.message.text_html}\n\n<b>Result:</b> {result['message']}"
         # Remove buttons
@@ -769,14 +906,14 @@ Example:
              except Exception:
                 pass
         return
-
+    
     elif data.startswith("admin_reject:"):
-        if not db.is_admin(user_id):
+        if not await db.is_admin(user_id):
             await query.edit_message_text("❌ Access Denied")
             return
-            
+        
         request_id = int(data.split(":")[1])
-        result = user_manager.reject_request(request_id)
+        result = await user_manager.reject_request(request_id)
         
         new_text = f"{query.message.text_html}\n\n<b>Result:</b> {result['message']}"
         # Remove buttons
@@ -794,43 +931,16 @@ Example:
         return
     
     elif data.startswith("admin_pending_select:"):
-        if not db.is_admin(user_id): return
+        if not await db.is_admin(user_id): return
         
         # Initialize selected set
         if 'pending_selected' not in context.user_data:
             context.user_data['pending_selected'] = set()
-            
-        page = int(data.split(":")[1])
         
-        # Get all pending types
-        requests = db.get_pending_requests() # [{'id':..., 'user_id':...}]
-        pending_users = db.get_pending_users() # [(id, ...)]
-        
-        # Combine unique pending user objects
-        # Map user_id to display info
-        unique_pending = {}
-        
-        for req in requests:
-            uid = req['user_id']
-            # We assume req has user details or we fetch? 
-            # db.get_pending_requests usually joins with users table
-            # If not, we might need a better fetch. 
-            # Looking at user_manager.py, get_pending_requests_formatted uses db.get_pending_requests()
-            # Let's assume it returns info. If not, we rely on users table.
-            # Actually simplest is just use get_pending_users() but that might not include those who "requested" if status is different?
-            # Usually 'pending' status is consistent.
-            # Let's use get_pending_users check.
-            unique_pending[uid] = {'name': f"User {uid}", 'uid': uid} # Fallback
-            
-        # Better approach: Get all users with status 'pending'
-        # I'll rely on db.get_pending_users() which should return all pending
-        all_pending_rows = db.get_pending_users() 
+        page = int(data.split(":")[1])
         
-        # Pagination
-        PER_PAGE = 5
-        start_idx = page * PER_PAGE
-        end_idx = start_idx + PER_PAGE
-        current_rows = all_pending_rows[start_idx:end_idx]
+        # Pending users, 5 per page to fit buttons
+        page, current_rows, has_next, _ = await get_users_page(context, 'pending_cursors', page, status='pending')
         
         keyboard = []
         selected = context.user_data['pending_selected']
@@ -843,12 +953,12 @@ Example:
             mark = "✅" if is_checked else "⬜"
             
             keyboard.append([InlineKeyboardButton(f"{mark} {name} ({uid})", callback_data=f"admin_pending_toggle:{uid}:{page}")])
-            
+        
         # Navigation
         nav_row = []
         if page > 0:
             nav_row.append(InlineKeyboardButton("⬅️ Prev", callback_data=f"admin_pending_select:{page-1}"))
-        if end_idx < len(all_pending_rows):
+        if has_next:
             nav_row.append(InlineKeyboardButton("Next ➡️", callback_data=f"admin_pending_select:{page+1}"))
         if nav_row: keyboard.append(nav_row)
         
@@ -861,7 +971,7 @@ Example:
             reply_markup=InlineKeyboardMarkup(keyboard)
         )
         return
-
+    
     elif data.startswith("admin_pending_toggle:"):
         parts = data.split(":")
         target_uid = int(parts[1])
@@ -869,7 +979,7 @@ Example:
         
         if 'pending_selected' not in context.user_data:
             context.user_data['pending_selected'] = set()
-            
+        
         selected = context.user_data['pending_selected']
         
         if target_uid in selected:
@@ -878,11 +988,7 @@ Example:
             selected.add(target_uid)
         
         # Refresh view logic (duplicate of select render)
-        all_pending_rows = db.get_pending_users()
-        PER_PAGE = 5
-        start_idx = page * PER_PAGE
-        end_idx = start_idx + PER_PAGE
-        current_rows = all_pending_rows[start_idx:end_idx]
+        page, current_rows, has_next, _ = await get_users_page(context, 'pending_cursors', page, status='pending')
         
         keyboard = []
         for u in current_rows:
@@ -891,11 +997,11 @@ Example:
             is_checked = uid in selected
             mark = "✅" if is_checked else "⬜"
             keyboard.append([InlineKeyboardButton(f"{mark} {name} ({uid})", callback_data=f"admin_pending_toggle:{uid}:{page}")])
-            
+        
         nav_row = []
         if page > 0:
             nav_row.append(InlineKeyboardButton("⬅️ Prev", callback_data=f"admin_pending_select:{page-1}"))
-        if end_idx < len(all_pending_rows):
+        if has_next:
             nav_row.append(InlineKeyboardButton("Next ➡️", callback_data=f"admin_pending_select:{page+1}"))
         if nav_row: keyboard.append(nav_row)
         
@@ -907,7 +1013,7 @@ Example:
         except Exception:
             pass
         return
-
+    
     elif data == "admin_pending_confirm":
         selected = context.user_data.get('pending_selected', set())
         count = len(selected)
@@ -915,7 +1021,7 @@ Example:
         if count == 0:
             await query.answer("❌ No users selected!", show_alert=True)
             return
-
+        
         text = f"⚙️ <b>Bulk Action</b>\n\nSelected Users: {count}\n\nChoose action:"
         keyboard = [
             [InlineKeyboardButton("✅ Approve Selected", callback_data="admin_pending_execute:approve")],
@@ -924,7 +1030,7 @@ Example:
         ]
         await query.edit_message_text(text, parse_mode=ParseMode.HTML, reply_markup=InlineKeyboardMarkup(keyboard))
         return
-
+    
     elif data.startswith("admin_pending_execute:"):
         action = data.split(":")[1]
         selected = context.user_data.get('pending_selected', set())
@@ -932,56 +1038,52 @@ Example:
         if not selected:
              await query.answer("❌ No users selected!", show_alert=True)
              return
-             
+        
         await query.edit_message_text(f"⏳ Processing {len(selected)} users...")
         
-        # Batch Process
+        # Apply every status change in one transaction
         success_count = 0
+        try:
+            if action == 'approve':
+                result = await user_manager.bulk_approve(selected)
+                notice = "🎉 Your access request has been approved!"
+            else:
+                result = await user_manager.bulk_reject(selected)
+                notice = "😔 Your access request has been rejected."
+            success_count = len(result['user_ids'])
+            
+            # Notify in the background, so the admin's next updates aren't held up
+            if result['user_ids']:
+                context.application.create_task(
+                    notify_batch(context.bot, query.message.chat_id, action, result['user_ids'], notice),
+                    update=update
+                )
+        except Exception as e:
+            logger.error(f"Batch {action} failed: {e}")
         
-        # Pre-fetch requests to map UID -> Request ID
-        all_requests = db.get_pending_requests() # [{'id': 1, 'user_id': 123}, ...]
-        uid_to_req_id = {r['user_id']: r['id'] for r in all_requests}
-        
-        for uid in selected:
-            try:
-                if action == 'approve':
-                    if uid in uid_to_req_id:
-                        # Approve via request
-                        res = user_manager.approve_request(uid_to_req_id[uid])
-                    else:
-                        # Direct approve
-                        res = user_manager.add_user_directly(uid)
-                        
-                    if res['success']:
-                        success_count += 1
-                        # Notify
-                        try:
-                            await context.bot.send_message(uid, "🎉 Your access request has been approved!", parse_mode=ParseMode.HTML)
-                        except: pass
-                        
-                elif action == 'reject':
-                    if uid in uid_to_req_id:
-                         res = user_manager.reject_request(uid_to_req_id[uid])
-                    else:
-                         res = user_manager.remove_user(uid)
-                         
-                    if res['success']:
-                        success_count += 1
-                        try:
-                            await context.bot.send_message(uid, "😔 Your access request has been rejected.", parse_mode=ParseMode.HTML)
-                        except: pass
-                        
-            except Exception as e:
-                logger.error(f"Batch error for {uid}: {e}")
-                
         # Clear selection and finish
         context.user_data['pending_selected'] = set()
         
         result_text = f"✅ <b>Batch Complete</b>\n\nAction: {action.title()}\nProcessed: {success_count}/{len(selected)}"
+        if success_count:
+            result_text += "\n\n📨 Notifying users, you'll get a report when done."
         keyboard = [[InlineKeyboardButton("🔙 Back to Admin", callback_data="admin_panel")]]
         
         await query.edit_message_text(result_text, parse_mode=ParseMode.HTML, reply_markup=InlineKeyboardMarkup(keyboard))
         return
+    
+    # Download Handlers
+    elif data.startswith("cancel_job:"):
+        # Queued jobs are dropped right away, running ones stop at the next progress event
+        job_id = int(data.split(":")[1])
+        await scheduler.cancel(job_id, user_id)
+        return
+    
+    elif data.startswith("download_"):
+        if not await db.is_user_authorized(user_id):
+            await query.edit_message_text("❌ Access Denied")
+            return
+        
         parts = data.split(':', 1)
         if len(parts) != 2:
             await query.edit_message_text("❌ Invalid request.")
@@ -990,106 +1092,324 @@ Example:
         action = parts[0].replace('download_', '')
         url = parts[1]
         
+        if not scheduler.can_submit(user_id):
+            await query.edit_message_text(
+                f"⚠️ You already have {scheduler.max_jobs_per_user} downloads queued or running.\n"
+                "Please wait for one of them to finish, then send the link again."
+            )
+            return
+        
+        # Quota is charged when the download is delivered
+        refusal = await quota.confirm(user_id)
+        if refusal:
+            await query.edit_message_text(refusal)
+            return
+        
+        trace = context.user_data.get('traces', {}).pop(url, None) or JobTrace(user_id, url)
+        trace.media_type = action
+        trace.submit()
+        
         await query.edit_message_text(f"⬇️ Starting {'Video' if action == 'video' else 'Audio'} download...")
-        await download_and_send(update, context, url, action, query.message)
+        # Queue the job - a scheduler worker runs download_and_send when a slot is free
+        job_id = await scheduler.submit(user_id, query.message.chat_id, url, action, query.message, trace=trace)
+        if job_id is None:
+            # Another job of this user was queued since the check above
+            await query.edit_message_text(
+                f"⚠️ You already have {scheduler.max_jobs_per_user} downloads queued or running.\n"
+                "Please wait for one of them to finish, then send the link again."
+            )
 
 
-async def download_and_send(update: Update, context: ContextTypes.DEFAULT_TYPE, url: str, media_type: str, status_message):
-    """Download and send media to user"""
-    user_id = update.effective_user.id if update.effective_user else update.callback_query.from_user.id
+async def send_media(bot, chat_id, media_type, media, title):
+    """Send a video or audio by Telegram file_id to a chat"""
+    if media_type == 'video':
+        return await bot.send_video(
+            chat_id=chat_id,
+            video=media,
+            caption=f"🎬 {title}",
+            supports_streaming=True,
+            read_timeout=120, 
+            write_timeout=120,
+            connect_timeout=120,
+            pool_timeout=120
+        )
+    return await bot.send_audio(
+        chat_id=chat_id,
+        audio=media,
+        caption=f"🎵 {title}",
+        title=title,
+        read_timeout=120, 
+        write_timeout=120
+    )
+
+
+async def upload_media(bot, chat_id, media_type, file_path, title, reporter):
+    """Upload a downloaded file to a chat, reporting progress and throughput"""
+    started = time.monotonic()
+    if media_type == 'video':
+        message = await uploader.send_file(
+            bot, 'sendVideo', 'video', file_path,
+            {'chat_id': chat_id, 'caption': f"🎬 {title}", 'supports_streaming': True},
+            progress_callback=reporter.upload_hook
+        )
+    else:
+        message = await uploader.send_file(
+            bot, 'sendAudio', 'audio', file_path,
+            {'chat_id': chat_id, 'caption': f"🎵 {title}", 'title': title},
+            progress_callback=reporter.upload_hook
+        )
+    
+    elapsed = time.monotonic() - started
+    size = os.path.getsize(file_path)
+    UPLOAD_SECONDS.observe(elapsed, media_type=media_type)
+    UPLOADED_BYTES.inc(size, media_type=media_type)
+    size_mb = size / (1024 * 1024)
+    logger.info(f"Uploaded {size_mb:.1f} MB in {elapsed:.1f}s ({size_mb / elapsed if elapsed else 0:.1f} MB/s)")
+    return message
+
+
+async def download_and_send(bot, job, reporter, executor):
+    """Download and send media to user (runs on a scheduler worker)
+    
+    reporter is the job's ProgressReporter: it edits the status message and
+    carries the cancel flag set by the job's cancel button. The job's trace
+    (a new one for jobs resumed after a restart) is saved when it ends.
+    Returns the job's (outcome, error) as recorded on the trace.
+    """
+    user_id = job['user_id']
+    url = job['url']
+    media_type = job['media_type']
+    
+    trace = job.get('trace') or JobTrace(user_id, url, media_type)
+    trace.job_id = job['id']
+    trace.stop('queue')
     
     try:
-        # Download based on type - RUN IN EXECUTOR to prevent blocking
-        loop = asyncio.get_running_loop()
-        if media_type == 'video':
-            result = await loop.run_in_executor(None, lambda: downloader.download_video(url))
-        else:
-            result = await loop.run_in_executor(None, lambda: downloader.download_audio(url))
+        await _download_and_send(bot, job, reporter, executor, trace)
+    except asyncio.CancelledError:
+        # The bot is shutting down - keep partial files for when the job resumes
+        trace.finish('interrupted')
+        await staging.release(job['id'], keep_files=True)
+        raise
+    except Exception as e:
+        trace.finish('failed', str(e))
+        logger.error(f"Error in download_and_send: {e}")
+        await reporter.edit_text(f"❌ Error: {str(e)}")
+    finally:
+        await staging.release(job['id'])
+        trace_writer.record(trace)
+    return trace.outcome, trace.error
+
+
+async def _download_and_send(bot, job, reporter, executor, trace):
+    """The work of download_and_send. Every outcome is recorded with trace.finish()."""
+    user_id = job['user_id']
+    chat_id = job['chat_id']
+    url = job['url']
+    media_type = job['media_type']
+    
+    loop = asyncio.get_running_loop()
+    
+    # Identify the media so repeat requests can be served from the cache
+    with trace.phase('extract'):
+        media_info = await loop.run_in_executor(executor, lambda: downloader.get_media_info(url))
+    if reporter.cancelled.is_set():
+        trace.finish('cancelled')
+        await reporter.edit_text("🚫 Download cancelled.")
+        return
+    cache_key = None
+    if media_info:
+        cache_key = media_cache.make_key(media_info['extractor'], media_info['id'], media_type)
+    
+    # Size budget: Telegram's limit, or less if the user's daily quota is nearly used up
+    max_bytes = MAX_FILE_SIZE_MB * 1024 * 1024
+    remaining = await quota.remaining_bytes(user_id)
+    if remaining is not None:
+        max_bytes = min(max_bytes, remaining)
+    
+    # Cache hit - re-send by file_id, no download and no upload
+    cached = await media_cache.get(cache_key)
+    if cached and cached['file_size'] > max_bytes:
+        cached = None
+    if cached:
+        try:
+            with trace.phase('upload'):
+                await send_media(bot, chat_id, media_type, cached['file_id'], cached['title'])
+            trace.bytes = cached['file_size']
+            trace.finish('cached')
+            await reporter.edit_text("✅ Download Complete!")
+            await db.add_download(user_id, url, cached['title'], media_type, cached['file_size'])
+            await quota.record_download(user_id, cached['file_size'])
+            return
+        except Exception as e:
+            logger.warning(f"Cached file_id for {cache_key} failed, downloading again: {e}")
+            await media_cache.invalidate(cache_key)
+    
+    file_path = media_cache.get_file(cache_key)
+    if file_path and os.path.getsize(file_path) > max_bytes:
+        file_path = None
+    budget_limited = False
+    # Only a file this job downloaded is released here; disk tier files are
+    # left to the media cache's eviction
+    downloaded = not file_path
+    if file_path:
+        # Recent file still in the disk tier - skip the download
+        title = media_info['title']
+        file_size = os.path.getsize(file_path)
+    else:
+        # Reserve disk space for the download, waiting for space if the disk is nearly full
+        estimate = await loop.run_in_executor(
+            executor, lambda: downloader.estimate_download_size(url, media_type, max_bytes)
+        )
         
-        if not result['success']:
-            await status_message.edit_text(f"❌ Download failed: {result.get('error', 'Unknown error')}")
+        async def waiting_for_space():
+            await reporter.edit_text("💾 Waiting for free disk space...", reply_markup=reporter.reply_markup)
+        
+        job_dir = await staging.reserve(job['id'], estimate, on_wait=waiting_for_space, cancelled=reporter.cancelled)
+        if reporter.cancelled.is_set():
+            trace.finish('cancelled')
+            await reporter.edit_text("🚫 Download cancelled.")
+            return
+        if job_dir is None:
+            trace.finish('no_space')
+            await reporter.edit_text("❌ Not enough disk space for this download right now. Please try again later.")
             return
         
-        file_path = result['file_path']
-        file_size = result['file_size']
-        title = result['title']
+        await reporter.edit_text(
+            f"⬇️ Downloading {'Video' if media_type == 'video' else 'Audio'}...",
+            reply_markup=reporter.reply_markup
+        )
         
-        # Check file size (Telegram limit is 50MB for bots generally, 2GB for local API server?)
-        # Standard bot API limit is 50MB for send_video/send_audio if sent by URL, but 
-        # up to 50MB if sent as file. Actually, for local files it's 50MB.
-        # Wait, if we use Bot API server, it's 50MB. If we use python-telegram-bot wrapper, we are uploading.
-        # Upload limit is 50MB. 
-        # Let's assume standard bot API. 2000MB is way too high unless using local bot API server.
-        # I'll keep the check but maybe lower it or add a warning.
-        # Correction: Bots can send files up to 50MB.
-        # However, sending by URL can go up to 20MB.
-        # Let's trust the user knows what they are doing or if they are using a local api server.
-        # But to be safe, I'll warn if > 50MB.
-        
-        if file_size > 1999 * 1024 * 1024:  # 2GB limit just in case
-             await status_message.edit_text(
-                "❌ File too large. Cannot send due to Telegram limits."
+        # Download based on type - RUN IN the scheduler's bounded executor to prevent blocking.
+        # The reporter's hook streams yt-dlp progress back to the status message.
+        if media_type == 'video':
+            result = await loop.run_in_executor(
+                executor, lambda: downloader.download_video(url, reporter.hook, max_bytes, job_dir, trace)
+            )
+        else:
+            result = await loop.run_in_executor(
+                executor, lambda: downloader.download_audio(url, reporter.hook, max_bytes, job_dir, trace)
             )
-             downloader.cleanup_file(file_path)
-             return
-
-        await status_message.edit_text("📤 Uploading...")
         
-        # Send file - RUN IN EXECUTOR or just await (send_video is async)
-        # Note: opening file is blocking, but okay for small files. 
-        # For large files, it might block the event loop slightly.
-        try:
-            with open(file_path, 'rb') as f:
-                if media_type == 'video':
-                    await context.bot.send_video(
-                        chat_id=user_id,
-                        video=f,
-                        caption=f"🎬 {title}",
-                        supports_streaming=True,
-                        read_timeout=120, 
-                        write_timeout=120,
-                        connect_timeout=120,
-                        pool_timeout=120
-                    )
-                else:
-                    await context.bot.send_audio(
-                        chat_id=user_id,
-                        audio=f,
-                        caption=f"🎵 {title}",
-                        title=title,
-                        read_timeout=120, 
-                        write_timeout=120
-                    )
-        except Exception as se:
-            logger.error(f"Send error: {se}")
-            await status_message.edit_text(f"❌ Error sending file: {se}")
-            downloader.cleanup_file(file_path)
+        if result.get('cancelled'):
+            trace.finish('cancelled')
+            await reporter.edit_text("🚫 Download cancelled.")
             return
-            
-        await status_message.edit_text("✅ Download Complete!")
         
-        # Add to download history
-        db.add_download(user_id, url, title, media_type, file_size)
+        if result.get('too_large'):
+            trace.finish('too_large')
+            await reporter.edit_text(
+                f"❌ Too large to send: the smallest available format is about "
+                f"{format_bytes(result['min_size'])}, the limit is {format_bytes(max_bytes)}."
+            )
+            return
         
-        # Cleanup
-        downloader.cleanup_file(file_path)
+        if not result['success']:
+            trace.finish('failed', result.get('error'))
+            await reporter.edit_text(f"❌ Download failed: {result.get('error', 'Unknown error')}")
+            return
         
-    except Exception as e:
-        logger.error(f"Error in download_and_send: {e}")
-        await status_message.edit_text(f"❌ Error: {str(e)}")
-
-
-def main():
-    """Start the bot"""
-    if not BOT_TOKEN:
-        logger.error("BOT_TOKEN not found! Please set it in .env file")
+        file_path = result['file_path']
+        file_size = result['file_size']
+        title = result['title']
+        elapsed = result['download_seconds']
+        size_mb = file_size / (1024 * 1024)
+        logger.info(
+            f"Downloaded {size_mb:.1f} MB in {elapsed:.1f}s "
+            f"({size_mb / elapsed if elapsed else 0:.1f} MB/s, {result['transfer']})"
+        )
+        budget_limited = result.get('budget_limited', False)
+        cache_key = cache_key or media_cache.make_key(result['extractor'], result['id'], media_type)
+    
+    # Format sizes are estimates, so check the real size too
+    trace.bytes = file_size
+    if file_size > max_bytes:
+        trace.finish('too_large')
+        await reporter.edit_text(
+            f"❌ File too large ({format_bytes(file_size)}). The limit is {format_bytes(max_bytes)}."
+        )
+        if downloaded:
+            downloader.release_file(file_path)
         return
     
-    if not ADMIN_USER_ID:
-        logger.warning("ADMIN_USER_ID not set! Please set it in .env file")
+    await reporter.edit_text("📤 Uploading...", reply_markup=reporter.reply_markup)
+    
+    # Send file - streamed in chunks read off the event loop, so memory use
+    # stays bounded however large the file is
+    try:
+        with trace.phase('upload'):
+            message = await upload_media(bot, chat_id, media_type, file_path, title, reporter)
+    except Exception as se:
+        if downloaded:
+            downloader.release_file(file_path)
+        if reporter.cancelled.is_set():
+            trace.finish('cancelled')
+            await reporter.edit_text("🚫 Download cancelled.")
+            return
+        trace.finish('failed', f"Upload: {se}")
+        logger.error(f"Send error: {se}")
+        ERRORS.inc(extractor=(media_info or {}).get('extractor') or 'unknown', stage='upload')
+        await reporter.edit_text(f"❌ Error sending file: {se}")
+        return
+    
+    # Remember the file_id so the next request for this media is a cache hit
+    # A lower quality picked to fit this user's budget shouldn't be served to everyone
+    sent = message.video if media_type == 'video' else message.audio
+    if sent and not budget_limited:
+        await media_cache.put(cache_key, sent.file_id, media_type, title, file_size)
+    
+    trace.finish('done')
+    await reporter.edit_text("✅ Download Complete!")
+    
+    # Add to download history
+    await db.add_download(user_id, url, title, media_type, file_size)
+    await quota.record_download(user_id, file_size)
     
-    # Create application
-    application = Application.builder().token(BOT_TOKEN).build()
+    # Cleanup - once the last sender of a shared download is done, keep the
+    # file in the disk tier if enabled, delete it otherwise
+    if downloaded:
+        retain = None if budget_limited else (lambda path: media_cache.store_file(cache_key, path))
+        downloader.release_file(file_path, retain=retain)
+
+
+async def post_init(application: Application):
+    """Connect storage, start the download workers and resume jobs and broadcasts left over from the last run"""
+    await db.connect()
+    await metrics_server.start()
+    await scheduler.start(application.bot, download_and_send)
+    await quota.start()
+    await staging.start()
+    await trace_writer.start()
+    await broadcast_engine.start(application.bot)
+
+
+async def post_shutdown(application: Application):
+    """Stop the download workers and broadcasts and close storage"""
+    await broadcast_engine.stop()
+    await scheduler.stop()
+    await quota.stop()
+    await staging.stop()
+    await trace_writer.stop()
+    await uploader.close()
+    await metrics_server.stop()
+    await db.close()
+
+
+def build_application():
+    """Create the Application with all handlers registered (not started)"""
+    builder = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .base_url(BOT_API_URL)
+        # Concurrent across users, in order for each user
+        .concurrent_updates(PerUserUpdateProcessor(CONCURRENT_UPDATES))
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+    )
+    if BOT_MODE == 'webhook':
+        # Updates arrive through our own aiohttp server instead of getUpdates
+        builder = builder.updater(None)
+    application = builder.build()
     
     # Add handlers
     application.add_handler(CommandHandler("start", start))
@@ -1099,6 +1419,8 @@ def main():
     application.add_handler(CommandHandler("pending", pending_requests))
     application.add_handler(CommandHandler("adduser", add_user))
     application.add_handler(CommandHandler("removeuser", remove_user))
+    application.add_handler(CommandHandler("setquota", set_quota))
+    application.add_handler(CommandHandler("stats", job_stats))
     
     # Dynamic approve/reject handlers (Requests)
     application.add_handler(MessageHandler(
@@ -1109,7 +1431,7 @@ def main():
         filters.Regex(r'^/reject_\d+$'),
         reject_request_handler
     ))
-
+    
     # Dynamic approve/reject handlers (Direct Users)
     application.add_handler(MessageHandler(
         filters.Regex(r'^/approveuser_\d+$'),
@@ -1128,10 +1450,27 @@ def main():
     
     # Callback query handler
     application.add_handler(CallbackQueryHandler(button_callback))
+    return application
+
+
+def main():
+    """Start the bot"""
+    if not BOT_TOKEN:
+        logger.error("BOT_TOKEN not found! Please set it in .env file")
+        return
+    
+    if not ADMIN_USER_ID:
+        logger.warning("ADMIN_USER_ID not set! Please set it in .env file")
+    
+    application = build_application()
     
     # Start bot
-    logger.info("Bot started successfully!")
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    logger.info(f"Bot started successfully! ({BOT_MODE} mode)")
+    if BOT_MODE == 'webhook':
+        from webhook import run_webhook
+        asyncio.run(run_webhook(application))
+    else:
+        application.run_polling(allowed_updates=ALLOWED_UPDATES)
 
 
 if __name__ == '__main__':
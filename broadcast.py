@@ -0,0 +1,145 @@
+import asyncio
+import logging
+import time
+
+from telegram.constants import ParseMode
+
+from config import BROADCAST_STATUS_INTERVAL, BROADCAST_SAVE_BATCH, INSTANCE_ID, LEASE_SECONDS, LEASE_RENEW_INTERVAL
+from download_queue import StatusMessage
+from metrics import BROADCAST_MESSAGES, BROADCAST_SEND_SECONDS
+from progress import ProgressReporter
+
+logger = logging.getLogger(__name__)
+
+
+class BroadcastEngine:
+    """Sends admin broadcasts concurrently through a RateLimitedSender.
+    
+    Recipients and their delivery status are stored in the database as the
+    broadcast runs, so a broadcast interrupted by a restart resumes where it
+    stopped. Users that turn out to have blocked the bot are remembered and
+    left out of later broadcasts. Like download jobs, broadcasts are leased
+    to the process running them (owner), so only one process resumes each.
+    """
+    def __init__(self, db, sender, owner=INSTANCE_ID, lease_seconds=LEASE_SECONDS,
+                 lease_interval=LEASE_RENEW_INTERVAL):
+        self.db = db
+        self.sender = sender
+        self.owner = owner
+        self.lease_seconds = lease_seconds
+        self.lease_interval = lease_interval
+        self.lease_task = None
+        self.bot = None
+        # Broadcast ID -> task delivering it
+        self.tasks = {}
+    
+    async def start(self, bot):
+        """Resume interrupted broadcasts this process owns or that nobody holds a lease on"""
+        self.bot = bot
+        await self._resume_claimed(include_own=True)
+        self.lease_task = asyncio.create_task(self._lease_loop())
+    
+    async def stop(self):
+        """Stop running broadcasts and release them (they resume on the next start)"""
+        if self.lease_task is not None:
+            self.lease_task.cancel()
+            await asyncio.gather(self.lease_task, return_exceptions=True)
+            self.lease_task = None
+        tasks = list(self.tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await self.db.release_broadcasts(self.owner)
+    
+    async def _resume_claimed(self, include_own=False):
+        """Claim broadcasts in the database and run the ones not already running here"""
+        for broadcast_id, chat_id, message_id, text in await self.db.claim_broadcasts(
+            self.owner, self.lease_seconds, include_own
+        ):
+            if broadcast_id not in self.tasks:
+                logger.info(f"Resuming broadcast {broadcast_id}")
+                self._spawn(broadcast_id, chat_id, message_id, text)
+    
+    async def _lease_loop(self):
+        """Keep this process's leases alive and take over broadcasts of processes that stopped renewing"""
+        while True:
+            await asyncio.sleep(self.lease_interval)
+            try:
+                await self.db.renew_broadcast_leases(self.owner, self.lease_seconds)
+                await self._resume_claimed()
+            except Exception as e:
+                logger.error(f"Error renewing broadcast leases: {e}")
+    
+    async def broadcast(self, admin_id, text, user_ids, status_message):
+        """Start broadcasting text to user_ids in the background. Returns the broadcast ID."""
+        blocked = await self.db.get_blocked_user_ids()
+        recipients = [user_id for user_id in user_ids if user_id not in blocked]
+        
+        broadcast_id = await self.db.create_broadcast(
+            admin_id, status_message.chat_id, status_message.message_id, text, recipients,
+            self.owner, self.lease_seconds
+        )
+        self._spawn(broadcast_id, status_message.chat_id, status_message.message_id, text)
+        return broadcast_id
+    
+    def _spawn(self, broadcast_id, chat_id, message_id, text):
+        task = asyncio.create_task(self._run(broadcast_id, chat_id, message_id, text))
+        self.tasks[broadcast_id] = task
+        task.add_done_callback(lambda _: self.tasks.pop(broadcast_id, None))
+    
+    async def _run(self, broadcast_id, chat_id, message_id, text):
+        """Deliver a broadcast to its pending recipients"""
+        status_message = StatusMessage(self.bot, chat_id, message_id)
+        reporter = ProgressReporter(asyncio.get_running_loop(), status_message, interval=BROADCAST_STATUS_INTERVAL)
+        counts = await self.db.get_broadcast_counts(broadcast_id)
+        total = sum(counts.values())
+        results = []
+        
+        def render():
+            done = total - counts.get('pending', 0)
+            return (
+                f"⏳ Sending broadcast... {done}/{total}\n\n"
+                f"🟢 Success: {counts.get('sent', 0)}\n"
+                f"🔴 Failed: {counts.get('failed', 0)}\n"
+                f"🚫 Blocked: {counts.get('blocked', 0)}"
+            )
+        
+        async def save():
+            batch = results[:]
+            results.clear()
+            if batch:
+                await self.db.save_broadcast_results(broadcast_id, batch)
+        
+        async def deliver(user_id):
+            started = time.monotonic()
+            outcome = await self.sender.send(user_id, lambda: self.bot.send_message(chat_id=user_id, text=text))
+            BROADCAST_SEND_SECONDS.observe(time.monotonic() - started)
+            BROADCAST_MESSAGES.inc(outcome=outcome)
+            counts[outcome] = counts.get(outcome, 0) + 1
+            counts['pending'] = counts.get('pending', 0) - 1
+            results.append((user_id, outcome))
+            if len(results) >= BROADCAST_SAVE_BATCH:
+                await save()
+            reporter.update(render())
+        
+        pending = await self.db.get_broadcast_pending(broadcast_id)
+        reporter.update(render())
+        
+        try:
+            # Schedule in slices so a huge recipient list doesn't create all tasks at once
+            for start in range(0, len(pending), BROADCAST_SAVE_BATCH * 5):
+                chunk = pending[start:start + BROADCAST_SAVE_BATCH * 5]
+                await asyncio.gather(*(deliver(user_id) for user_id in chunk))
+        finally:
+            # Save what was delivered, also when cancelled by a shutdown
+            await save()
+            await reporter.close()
+        
+        await self.db.finish_broadcast(broadcast_id)
+        await status_message.edit_text(
+            f"✅ <b>Broadcast Complete</b>\n\n"
+            f"🟢 Success: {counts.get('sent', 0)}\n"
+            f"🔴 Failed: {counts.get('failed', 0)}\n"
+            f"🚫 Blocked: {counts.get('blocked', 0)}",
+            parse_mode=ParseMode.HTML
+        )
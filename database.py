@@ -1,18 +1,222 @@
+import queue
 import sqlite3
+import sys
+import threading
+import time
+from concurrent.futures import Future
+from contextlib import contextmanager
 from datetime import datetime
-from config import DATABASE_PATH, ADMIN_USER_ID
+from config import (
+    DATABASE_PATH, ADMIN_USER_ID, DB_BUSY_TIMEOUT_MS, DB_MMAP_SIZE_MB, DB_STATEMENT_CACHE_SIZE,
+    DB_GROUP_COMMIT_MS, DB_GROUP_COMMIT_MAX
+)
 
 class Database:
-    def __init__(self):
-        self.conn = sqlite3.connect(DATABASE_PATH, check_same_thread=False)
-        self.cursor = self.conn.cursor()
+    def __init__(self, path=DATABASE_PATH):
+        self.path = path
+        self._connections = []
+        self._connections_lock = threading.Lock()
+        # One read connection per thread, so the event loop and executor
+        # threads never share a connection or cursor
+        self._local = threading.local()
+        # A single dedicated writer connection; writes are serialized on it
+        self._writer = self._connect()
+        self._write_lock = threading.Lock()
+        self._writer.execute('PRAGMA journal_mode=WAL')
+        # Write-through cache of user status (user_id -> status or None), so
+        # permission checks are dictionary hits instead of SQLite round trips
+        self._status_cache = {}
+        # Write-through set of users who blocked the bot (None until first loaded)
+        self._blocked_cache = None
+        # Serializes writers that change the caches. Re-entrant: a group commit
+        # holds it while running write methods that take it too. Readers never
+        # take it, so a cache miss doesn't wait behind a write transaction.
+        self._status_lock = threading.RLock()
+        # Held briefly while a cache changes. _cache_version is bumped on every
+        # change and whenever a write transaction ends; _cache_dirty is set while
+        # a group commit holds cache changes it hasn't committed yet. A cache-miss
+        # read only fills the cache if neither happened while it ran.
+        self._cache_lock = threading.Lock()
+        self._cache_version = 0
+        self._cache_dirty = False
+        # Group commit writer thread (see submit_write)
+        self._write_queue = queue.Queue()
+        self._write_thread = None
+        self._group = threading.local()
+        
         self.create_tables()
         self.ensure_admin_exists()
     
+    def _connect(self, read_only=False):
+        """Open a tuned connection to the database"""
+        conn = sqlite3.connect(
+            self.path,
+            check_same_thread=False,
+            timeout=DB_BUSY_TIMEOUT_MS / 1000,
+            # Compiled statements are cached per connection and reused for
+            # identical SQL text, so every query here is a constant string
+            cached_statements=DB_STATEMENT_CACHE_SIZE
+        )
+        conn.execute(f'PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}')
+        # WAL only needs NORMAL sync to stay consistent; commits no longer fsync
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute(f'PRAGMA mmap_size={DB_MMAP_SIZE_MB * 1024 * 1024}')
+        conn.execute('PRAGMA temp_store=MEMORY')
+        if read_only:
+            conn.execute('PRAGMA query_only=1')
+        
+        with self._connections_lock:
+            self._connections.append(conn)
+        return conn
+    
+    def _reader(self):
+        """Get this thread's read connection"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = self._connect(read_only=True)
+        return conn
+    
+    def _fetchone(self, sql, params=()):
+        """Run a read query and return the first row"""
+        return self._reader().execute(sql, params).fetchone()
+    
+    def _fetchall(self, sql, params=()):
+        """Run a read query and return all rows"""
+        return self._reader().execute(sql, params).fetchall()
+    
+    @contextmanager
+    def _changing_cache(self):
+        """Hold while a writer changes a cache"""
+        with self._cache_lock:
+            yield
+            self._cache_version += 1
+            if getattr(self._group, 'active', False):
+                # Not committed until the group is
+                self._cache_dirty = True
+    
+    def _write_ended(self):
+        """Note that a write transaction committed or rolled back"""
+        with self._cache_lock:
+            self._cache_version += 1
+            self._cache_dirty = False
+    
+    def _fill_cache(self, version, fill):
+        """Run fill() unless a cache changed or a write was pending since _cache_version was version"""
+        with self._cache_lock:
+            if self._cache_version == version and not self._cache_dirty:
+                fill()
+    
+    @contextmanager
+    def _transaction(self):
+        """Run several writes on the writer connection as one transaction"""
+        if getattr(self._group, 'active', False):
+            # Inside a group commit on the writer thread: the group commits
+            yield self._writer
+            return
+        
+        with self._write_lock:
+            try:
+                yield self._writer
+                self._writer.commit()
+            except Exception:
+                self._writer.rollback()
+                raise
+            finally:
+                self._write_ended()
+    
+    def _execute(self, sql, params=()):
+        """Run a write statement on the writer connection and commit it"""
+        with self._transaction() as conn:
+            return conn.execute(sql, params)
+    
+    # Group Commit Writer
+    def start_writer(self):
+        """Start the writer thread that runs submit_write() calls with group commits"""
+        if self._write_thread is None:
+            self._write_thread = threading.Thread(target=self._write_loop, name="sqlite-writer", daemon=True)
+            self._write_thread.start()
+    
+    def submit_write(self, method, *args):
+        """Queue method(*args) (a write method of this class) for the writer thread.
+        
+        Returns a concurrent.futures.Future resolved once the write is committed.
+        """
+        future = Future()
+        self._write_queue.put((method, args, future))
+        return future
+    
+    def _write_loop(self):
+        """Collect writes arriving within a few milliseconds and commit them together"""
+        while True:
+            op = self._write_queue.get()
+            if op is None:
+                return
+            
+            batch = [op]
+            stop = False
+            deadline = time.monotonic() + DB_GROUP_COMMIT_MS / 1000
+            while len(batch) < DB_GROUP_COMMIT_MAX:
+                try:
+                    op = self._write_queue.get(timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if op is None:
+                    stop = True
+                    break
+                batch.append(op)
+            
+            self._commit_group(batch)
+            if stop:
+                return
+    
+    def _commit_group(self, batch):
+        """Run a batch of writes in one transaction, each in its own savepoint"""
+        results = []
+        with self._status_lock, self._write_lock:
+            self._group.active = True
+            try:
+                self._writer.execute('BEGIN')
+                for method, args, future in batch:
+                    if not future.set_running_or_notify_cancel():
+                        continue
+                    self._writer.execute('SAVEPOINT op')
+                    try:
+                        result = method(*args)
+                    except Exception as e:
+                        # Undo just this write, the rest of the group still commits
+                        self._writer.execute('ROLLBACK TO op')
+                        self._writer.execute('RELEASE op')
+                        future.set_exception(e)
+                        continue
+                    self._writer.execute('RELEASE op')
+                    results.append((future, result))
+                self._writer.commit()
+            except Exception as e:
+                print(f"Error committing writes: {e}")
+                self._writer.rollback()
+                # Cached statuses may describe writes that were just rolled back
+                with self._changing_cache():
+                    self._status_cache.clear()
+                    self._blocked_cache = None
+                for future, _ in results:
+                    future.set_exception(e)
+                for method, args, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                return
+            finally:
+                self._group.active = False
+                self._write_ended()
+        
+        for future, result in results:
+            future.set_result(result)
+    
     def create_tables(self):
         """Create all necessary database tables"""
+        cursor = self._writer.cursor()
+        
         # Users table
-        self.cursor.execute('''
+        cursor.execute('''
             CREATE TABLE IF NOT EXISTS users (
                 user_id INTEGER PRIMARY KEY,
                 username TEXT,
@@ -24,7 +228,7 @@ class Database:
         ''')
         
         # Download history table
-        self.cursor.execute('''
+        cursor.execute('''
             CREATE TABLE IF NOT EXISTS downloads (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 user_id INTEGER,
@@ -38,7 +242,7 @@ class Database:
         ''')
         
         # Access requests table
-        self.cursor.execute('''
+        cursor.execute('''
             CREATE TABLE IF NOT EXISTS access_requests (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 user_id INTEGER,
@@ -52,77 +256,308 @@ class Database:
             )
         ''')
         
-        self.conn.commit()
+        # Download job queue table
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS download_jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER,
+                chat_id INTEGER,
+                message_id INTEGER,
+                url TEXT,
+                media_type TEXT,
+                status TEXT DEFAULT 'queued',
+                error TEXT,
+                owner TEXT,
+                lease_expires_at TIMESTAMP,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (user_id) REFERENCES users(user_id)
+            )
+        ''')
+        
+        # Sent media cache table (Telegram file_id per media + format)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS media_cache (
+                cache_key TEXT PRIMARY KEY,
+                file_id TEXT,
+                file_type TEXT,
+                title TEXT,
+                file_size INTEGER,
+                hits INTEGER DEFAULT 0,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                last_used_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        
+        # Broadcast tables (progress is saved so interrupted broadcasts resume)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS broadcasts (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                admin_id INTEGER,
+                chat_id INTEGER,
+                message_id INTEGER,
+                text TEXT,
+                status TEXT DEFAULT 'running',
+                owner TEXT,
+                lease_expires_at TIMESTAMP,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS broadcast_recipients (
+                broadcast_id INTEGER,
+                user_id INTEGER,
+                status TEXT DEFAULT 'pending',
+                PRIMARY KEY (broadcast_id, user_id),
+                FOREIGN KEY (broadcast_id) REFERENCES broadcasts(id)
+            )
+        ''')
+        
+        # Users who blocked the bot or were deactivated (skipped by broadcasts)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS blocked_users (
+                user_id INTEGER PRIMARY KEY,
+                blocked_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        
+        # Download quotas: per-user overrides of the default limits (NULL = default)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS user_quotas (
+                user_id INTEGER PRIMARY KEY,
+                downloads_per_hour INTEGER,
+                bytes_per_day INTEGER,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        
+        # Hourly per-user usage rolled up from downloads, so quota checks don't scan history
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS download_usage (
+                user_id INTEGER,
+                hour TIMESTAMP,
+                downloads INTEGER DEFAULT 0,
+                bytes INTEGER DEFAULT 0,
+                PRIMARY KEY (user_id, hour)
+            )
+        ''')
+        
+        # Shared quota token buckets (key -> tokens left, julianday of the last refill)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS quota_buckets (
+                key TEXT PRIMARY KEY,
+                tokens REAL,
+                updated_at REAL
+            )
+        ''')
+        
+        # Progress of periodic rollups (name -> last rolled up row ID)
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS rollup_state (
+                name TEXT PRIMARY KEY,
+                last_id INTEGER
+            )
+        ''')
+        
+        # Per-job traces: phase timings (seconds, NULL if the phase didn't run) and outcome
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS job_traces (
+                job_id INTEGER PRIMARY KEY,
+                user_id INTEGER,
+                media_type TEXT,
+                extractor TEXT,
+                format_id TEXT,
+                bytes INTEGER,
+                outcome TEXT,
+                error TEXT,
+                extract_seconds REAL,
+                queue_seconds REAL,
+                download_seconds REAL,
+                postprocess_seconds REAL,
+                upload_seconds REAL,
+                total_seconds REAL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (job_id) REFERENCES download_jobs(id)
+            )
+        ''')
+        
+        # Ownership leases, added after the tables above first shipped
+        for table in ('download_jobs', 'broadcasts'):
+            columns = {row[1] for row in cursor.execute(f'PRAGMA table_info({table})')}
+            if 'owner' not in columns:
+                cursor.execute(f'ALTER TABLE {table} ADD COLUMN owner TEXT')
+            if 'lease_expires_at' not in columns:
+                cursor.execute(f'ALTER TABLE {table} ADD COLUMN lease_expires_at TIMESTAMP')
+        
+        # Indexes for the status filters, paginated listings and per-user history
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_status_created ON users (status, created_at)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_created ON users (created_at)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_requests_status_created ON access_requests (status, created_at)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_downloads_user_date ON downloads (user_id, download_date)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_job_traces_created ON job_traces (created_at)')
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_jobs_unfinished ON download_jobs (id) WHERE status IN ('queued', 'running')")
+        
+        self._writer.commit()
     
     def ensure_admin_exists(self):
         """Ensure admin user exists in database"""
         if ADMIN_USER_ID:
-            user = self.get_user(ADMIN_USER_ID)
-            if not user:
+            status = self.get_user_status(ADMIN_USER_ID)
+            if status is None:
                 self.add_user(ADMIN_USER_ID, "Admin", "Admin", status="admin")
-            elif user[3] != 'admin':  # status column
+            elif status != 'admin':
                 self.update_user_status(ADMIN_USER_ID, "admin")
     
     def add_user(self, user_id, username, first_name, status='pending'):
         """Add a new user to the database"""
-        try:
-            self.cursor.execute('''
-                INSERT INTO users (user_id, username, first_name, status)
-                VALUES (?, ?, ?, ?)
-            ''', (user_id, username, first_name, status))
-            self.conn.commit()
+        with self._status_lock:
+            try:
+                self._execute('''
+                    INSERT INTO users (user_id, username, first_name, status)
+                    VALUES (?, ?, ?, ?)
+                ''', (user_id, username, first_name, status))
+            except sqlite3.IntegrityError:
+                return False
+            with self._changing_cache():
+                self._status_cache[user_id] = sys.intern(status)
             return True
-        except sqlite3.IntegrityError:
-            return False
     
     def get_user(self, user_id):
         """Get user information"""
-        self.cursor.execute('SELECT * FROM users WHERE user_id = ?', (user_id,))
-        return self.cursor.fetchone()
+        return self._fetchone('SELECT * FROM users WHERE user_id = ?', (user_id,))
+    
+    def get_user_status(self, user_id):
+        """Get user status (None if unknown), served from the in-memory cache"""
+        try:
+            return self._status_cache[user_id]
+        except KeyError:
+            pass
+        
+        version = self._cache_version
+        row = self._fetchone('SELECT status FROM users WHERE user_id = ?', (user_id,))
+        status = sys.intern(row[0]) if row else None
+        self._fill_cache(version, lambda: self._status_cache.setdefault(user_id, status))
+        return status
+    
+    def get_cached_user_status(self, user_id):
+        """Get user status from the in-memory cache only (KeyError if not cached)"""
+        return self._status_cache[user_id]
     
     def update_user_status(self, user_id, status):
         """Update user status"""
-        self.cursor.execute('''
-            UPDATE users 
-            SET status = ?, updated_at = CURRENT_TIMESTAMP
-            WHERE user_id = ?
-        ''', (status, user_id))
-        self.conn.commit()
+        with self._status_lock:
+            cursor = self._execute('''
+                UPDATE users 
+                SET status = ?, updated_at = CURRENT_TIMESTAMP
+                WHERE user_id = ?
+            ''', (status, user_id))
+            with self._changing_cache():
+                self._status_cache[user_id] = sys.intern(status) if cursor.rowcount else None
     
     def remove_user(self, user_id):
         """Remove a user from database"""
-        self.cursor.execute('DELETE FROM users WHERE user_id = ?', (user_id,))
-        self.conn.commit()
+        with self._status_lock:
+            self._execute('DELETE FROM users WHERE user_id = ?', (user_id,))
+            with self._changing_cache():
+                self._status_cache[user_id] = None
     
     def get_all_users(self):
         """Get all users"""
-        self.cursor.execute('SELECT * FROM users ORDER BY created_at DESC')
-        return self.cursor.fetchall()
+        return self._fetchall('SELECT * FROM users ORDER BY created_at DESC')
+    
+    def get_users_page(self, status=None, after=None, limit=5):
+        """Get one page of users (optionally with a given status), newest first.
+        
+        Uses keyset pagination: after is the (created_at, user_id) of the last
+        row of the previous page, or None for the first page.
+        """
+        conditions = []
+        params = []
+        if status is not None:
+            conditions.append('status = ?')
+            params.append(status)
+        if after is not None:
+            conditions.append('(created_at, user_id) < (?, ?)')
+            params.extend(after)
+        
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+        return self._fetchall(f'''
+            SELECT * FROM users 
+            {where}
+            ORDER BY created_at DESC, user_id DESC
+            LIMIT ?
+        ''', (*params, limit))
+    
+    def count_users(self, status=None):
+        """Count users (optionally with a given status)"""
+        if status is None:
+            row = self._fetchone('SELECT COUNT(*) FROM users')
+        else:
+            row = self._fetchone('SELECT COUNT(*) FROM users WHERE status = ?', (status,))
+        return row[0]
     
     def is_user_authorized(self, user_id):
         """Check if user is authorized (admin or approved)"""
-        user = self.get_user(user_id)
-        if not user:
-            return False
-        status = user[3]  # status column
-        return status in ['admin', 'approved']
+        return self.get_user_status(user_id) in ('admin', 'approved')
     
     def is_admin(self, user_id):
         """Check if user is admin"""
-        user = self.get_user(user_id)
-        if not user:
-            return False
-        return user[3] == 'admin'
+        return self.get_user_status(user_id) == 'admin'
+    
+    def bulk_approve_users(self, user_ids, request_ids=()):
+        """Approve many users (creating unknown ones) and their requests in one transaction"""
+        with self._status_lock:
+            with self._transaction() as conn:
+                conn.executemany('''
+                    INSERT OR IGNORE INTO users (user_id, username, first_name, status)
+                    VALUES (?, 'Unknown', 'Unknown', 'approved')
+                ''', [(user_id,) for user_id in user_ids])
+                conn.executemany('''
+                    UPDATE users 
+                    SET status = 'approved', updated_at = CURRENT_TIMESTAMP
+                    WHERE user_id = ? AND status != 'admin'
+                ''', [(user_id,) for user_id in user_ids])
+                conn.executemany('''
+                    UPDATE access_requests 
+                    SET status = 'approved', updated_at = CURRENT_TIMESTAMP
+                    WHERE id = ?
+                ''', [(request_id,) for request_id in request_ids])
+            with self._changing_cache():
+                for user_id in user_ids:
+                    self._status_cache.pop(user_id, None)
+    
+    def bulk_reject_users(self, user_ids, request_ids=(), remove_user_ids=()):
+        """Reject users and their requests, and remove users without one, in one transaction"""
+        with self._status_lock:
+            with self._transaction() as conn:
+                conn.executemany('''
+                    UPDATE users 
+                    SET status = 'rejected', updated_at = CURRENT_TIMESTAMP
+                    WHERE user_id = ? AND status != 'admin'
+                ''', [(user_id,) for user_id in user_ids])
+                conn.executemany('''
+                    UPDATE access_requests 
+                    SET status = 'rejected', updated_at = CURRENT_TIMESTAMP
+                    WHERE id = ?
+                ''', [(request_id,) for request_id in request_ids])
+                conn.executemany(
+                    "DELETE FROM users WHERE user_id = ? AND status != 'admin'",
+                    [(user_id,) for user_id in remove_user_ids]
+                )
+            with self._changing_cache():
+                for user_id in list(user_ids) + list(remove_user_ids):
+                    self._status_cache.pop(user_id, None)
     
     # Access Request Methods
     def create_access_request(self, user_id, username, first_name, message):
         """Create a new access request"""
         try:
-            self.cursor.execute('''
+            self._execute('''
                 INSERT INTO access_requests (user_id, username, first_name, message)
                 VALUES (?, ?, ?, ?)
             ''', (user_id, username, first_name, message))
-            self.conn.commit()
             return True
         except Exception as e:
             print(f"Error creating access request: {e}")
@@ -130,50 +565,371 @@ class Database:
     
     def get_pending_requests(self):
         """Get all pending access requests"""
-        self.cursor.execute('''
+        return self._fetchall('''
             SELECT * FROM access_requests 
             WHERE status = 'pending'
             ORDER BY created_at DESC
         ''')
-        return self.cursor.fetchall()
     
     def get_pending_users(self):
         """Get all users with pending status"""
-        self.cursor.execute("SELECT * FROM users WHERE status = 'pending'")
-        return self.cursor.fetchall()
+        return self._fetchall("SELECT * FROM users WHERE status = 'pending'")
     
     def update_request_status(self, request_id, status):
         """Update access request status"""
-        self.cursor.execute('''
+        self._execute('''
             UPDATE access_requests 
             SET status = ?, updated_at = CURRENT_TIMESTAMP
             WHERE id = ?
         ''', (status, request_id))
-        self.conn.commit()
     
     def get_request_by_id(self, request_id):
         """Get access request by ID"""
-        self.cursor.execute('SELECT * FROM access_requests WHERE id = ?', (request_id,))
-        return self.cursor.fetchone()
+        return self._fetchone('SELECT * FROM access_requests WHERE id = ?', (request_id,))
     
     # Download History Methods
     def add_download(self, user_id, url, title, file_type, file_size):
         """Add download to history"""
-        self.cursor.execute('''
+        self._execute('''
             INSERT INTO downloads (user_id, url, title, file_type, file_size)
             VALUES (?, ?, ?, ?, ?)
         ''', (user_id, url, title, file_type, file_size))
-        self.conn.commit()
     
     def get_user_downloads(self, user_id):
         """Get download history for a user"""
-        self.cursor.execute('''
+        return self._fetchall('''
             SELECT * FROM downloads 
             WHERE user_id = ?
             ORDER BY download_date DESC
         ''', (user_id,))
-        return self.cursor.fetchall()
+    
+    # Quota Methods
+    def get_quota_override(self, user_id):
+        """Get a user's (downloads_per_hour, bytes_per_day) override, or None"""
+        return self._fetchone(
+            'SELECT downloads_per_hour, bytes_per_day FROM user_quotas WHERE user_id = ?',
+            (user_id,)
+        )
+    
+    def set_quota_override(self, user_id, downloads_per_hour, bytes_per_day):
+        """Override a user's limits (None = default); removes the override if both are None"""
+        if downloads_per_hour is None and bytes_per_day is None:
+            self._execute('DELETE FROM user_quotas WHERE user_id = ?', (user_id,))
+            return
+        self._execute('''
+            INSERT OR REPLACE INTO user_quotas (user_id, downloads_per_hour, bytes_per_day)
+            VALUES (?, ?, ?)
+        ''', (user_id, downloads_per_hour, bytes_per_day))
+    
+    def get_download_usage(self, user_id, since):
+        """Get (downloads, bytes) of a user since a UTC datetime.
+        
+        Reads the hourly rollups (whole hours, so up to an hour more than asked)
+        plus the downloads not rolled up yet.
+        """
+        since = since.strftime('%Y-%m-%d %H:00:00')
+        rolled = self._fetchone('''
+            SELECT COALESCE(SUM(downloads), 0), COALESCE(SUM(bytes), 0) FROM download_usage 
+            WHERE user_id = ? AND hour >= ?
+        ''', (user_id, since))
+        recent = self._fetchone('''
+            SELECT COUNT(*), COALESCE(SUM(file_size), 0) FROM downloads 
+            WHERE user_id = ? AND download_date >= ?
+            AND id > COALESCE((SELECT last_id FROM rollup_state WHERE name = 'downloads'), 0)
+        ''', (user_id, since))
+        return rolled[0] + recent[0], rolled[1] + recent[1]
+    
+    def take_quota_tokens(self, key, rate, capacity, amount, initial, allow_debt=False):
+        """Refill the token bucket `key` and take `amount` tokens from it, atomically.
+        
+        A missing bucket starts with `initial` tokens. Unless allow_debt, nothing
+        is taken when fewer than `amount` are available. Returns (taken, tokens left).
+        """
+        with self._transaction() as conn:
+            conn.execute('''
+                INSERT OR IGNORE INTO quota_buckets (key, tokens, updated_at)
+                VALUES (?, ?, julianday('now'))
+            ''', (key, initial))
+            tokens = conn.execute('''
+                SELECT MIN(?, tokens + MAX(0, julianday('now') - updated_at) * 86400 * ?) FROM quota_buckets 
+                WHERE key = ?
+            ''', (capacity, rate, key)).fetchone()[0]
+            taken = allow_debt or tokens >= amount
+            if taken:
+                tokens -= amount
+            conn.execute('''
+                UPDATE quota_buckets 
+                SET tokens = ?, updated_at = julianday('now')
+                WHERE key = ?
+            ''', (tokens, key))
+        return taken, tokens
+    
+    def rollup_downloads(self, keep_hours=48):
+        """Fold new downloads into hourly per-user usage and drop old usage rows.
+        
+        Returns the number of downloads rolled up.
+        """
+        with self._transaction() as conn:
+            row = conn.execute("SELECT last_id FROM rollup_state WHERE name = 'downloads'").fetchone()
+            last_id = row[0] if row else 0
+            max_id = conn.execute('SELECT MAX(id) FROM downloads').fetchone()[0] or 0
+            if max_id <= last_id:
+                return 0
+            
+            conn.execute('''
+                INSERT INTO download_usage (user_id, hour, downloads, bytes)
+                SELECT user_id, strftime('%Y-%m-%d %H:00:00', download_date), COUNT(*), COALESCE(SUM(file_size), 0)
+                FROM downloads 
+                WHERE id > ? AND id <= ?
+                GROUP BY 1, 2
+                ON CONFLICT (user_id, hour) DO UPDATE SET 
+                    downloads = downloads + excluded.downloads,
+                    bytes = bytes + excluded.bytes
+            ''', (last_id, max_id))
+            conn.execute(
+                "INSERT OR REPLACE INTO rollup_state (name, last_id) VALUES ('downloads', ?)",
+                (max_id,)
+            )
+            conn.execute(
+                "DELETE FROM download_usage WHERE hour < strftime('%Y-%m-%d %H:00:00', 'now', ?)",
+                (f'-{keep_hours} hours',)
+            )
+            # Untouched for a day, a bucket has refilled completely
+            conn.execute("DELETE FROM quota_buckets WHERE updated_at < julianday('now') - 1")
+        return max_id - last_id
+    
+    # Download Job Queue Methods
+    def add_job(self, user_id, chat_id, message_id, url, media_type, owner=None, lease_seconds=0):
+        """Add a download job to the queue and return its ID (leased to owner if given)"""
+        return self._execute('''
+            INSERT INTO download_jobs (user_id, chat_id, message_id, url, media_type, owner, lease_expires_at)
+            VALUES (?, ?, ?, ?, ?, ?, datetime('now', ?))
+        ''', (user_id, chat_id, message_id, url, media_type, owner, f'+{lease_seconds} seconds')).lastrowid
+    
+    def update_job_status(self, job_id, status, error=None):
+        """Update download job status"""
+        self._execute('''
+            UPDATE download_jobs 
+            SET status = ?, error = ?, updated_at = CURRENT_TIMESTAMP
+            WHERE id = ?
+        ''', (status, error, job_id))
+    
+    def claim_jobs(self, owner, lease_seconds, include_own=False):
+        """Lease unowned and expired unfinished jobs (and owner's own if include_own) to owner.
+        
+        Claimed jobs are set back to queued and returned in queue order.
+        """
+        with self._transaction() as conn:
+            rows = conn.execute('''
+                UPDATE download_jobs 
+                SET status = 'queued', owner = ?, lease_expires_at = datetime('now', ?), updated_at = CURRENT_TIMESTAMP
+                WHERE id IN (
+                    SELECT id FROM download_jobs 
+                    WHERE status IN ('queued', 'running')
+                    AND (owner IS NULL OR lease_expires_at < datetime('now') OR (owner = ? AND ?))
+                )
+                RETURNING id, user_id, chat_id, message_id, url, media_type
+            ''', (owner, f'+{lease_seconds} seconds', owner, include_own)).fetchall()
+        return sorted(rows)
+    
+    def renew_job_leases(self, owner, lease_seconds):
+        """Extend the leases of owner's unfinished jobs"""
+        self._execute('''
+            UPDATE download_jobs 
+            SET lease_expires_at = datetime('now', ?)
+            WHERE owner = ? AND status IN ('queued', 'running')
+        ''', (f'+{lease_seconds} seconds', owner))
+    
+    def release_jobs(self, owner):
+        """Give up owner's unfinished jobs so any process can claim them right away"""
+        self._execute('''
+            UPDATE download_jobs 
+            SET owner = NULL, lease_expires_at = NULL
+            WHERE owner = ? AND status IN ('queued', 'running')
+        ''', (owner,))
+    
+    # Job Trace Methods
+    def add_job_traces(self, traces):
+        """Save finished job traces, each a JobTrace.row() tuple"""
+        with self._transaction() as conn:
+            conn.executemany('''
+                INSERT OR REPLACE INTO job_traces (
+                    job_id, user_id, media_type, extractor, format_id, bytes, outcome, error,
+                    extract_seconds, queue_seconds, download_seconds, postprocess_seconds, upload_seconds, total_seconds
+                )
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', traces)
+    
+    def get_job_traces(self, since, limit=10000):
+        """Get (media_type, outcome, extract, queue, download, postprocess, upload, total seconds)
+        of the latest jobs traced since a UTC datetime
+        """
+        return self._fetchall('''
+            SELECT media_type, outcome, extract_seconds, queue_seconds, download_seconds,
+                postprocess_seconds, upload_seconds, total_seconds
+            FROM job_traces 
+            WHERE created_at >= ?
+            ORDER BY created_at DESC
+            LIMIT ?
+        ''', (since.strftime('%Y-%m-%d %H:%M:%S'), limit))
+    
+    # Media Cache Methods
+    def get_cached_media(self, cache_key):
+        """Get cached Telegram file for a media cache key"""
+        return self._fetchone('''
+            SELECT cache_key, file_id, file_type, title, file_size FROM media_cache 
+            WHERE cache_key = ?
+        ''', (cache_key,))
+    
+    def add_cached_media(self, cache_key, file_id, file_type, title, file_size):
+        """Store the Telegram file_id of sent media"""
+        self._execute('''
+            INSERT OR REPLACE INTO media_cache (cache_key, file_id, file_type, title, file_size)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (cache_key, file_id, file_type, title, file_size))
+    
+    def touch_cached_media(self, cache_key):
+        """Record a cache hit"""
+        self._execute('''
+            UPDATE media_cache 
+            SET hits = hits + 1, last_used_at = CURRENT_TIMESTAMP
+            WHERE cache_key = ?
+        ''', (cache_key,))
+    
+    def remove_cached_media(self, cache_key):
+        """Remove a cache entry (e.g. when its file_id stopped working)"""
+        self._execute('DELETE FROM media_cache WHERE cache_key = ?', (cache_key,))
+    
+    # Broadcast Methods
+    def create_broadcast(self, admin_id, chat_id, message_id, text, user_ids, owner=None, lease_seconds=0):
+        """Create a broadcast with its recipient list and return its ID (leased to owner if given)"""
+        with self._transaction() as conn:
+            broadcast_id = conn.execute('''
+                INSERT INTO broadcasts (admin_id, chat_id, message_id, text, owner, lease_expires_at)
+                VALUES (?, ?, ?, ?, ?, datetime('now', ?))
+            ''', (admin_id, chat_id, message_id, text, owner, f'+{lease_seconds} seconds')).lastrowid
+            conn.executemany('''
+                INSERT OR IGNORE INTO broadcast_recipients (broadcast_id, user_id)
+                VALUES (?, ?)
+            ''', [(broadcast_id, user_id) for user_id in user_ids])
+        return broadcast_id
+    
+    def claim_broadcasts(self, owner, lease_seconds, include_own=False):
+        """Lease unowned and expired running broadcasts (and owner's own if include_own) to owner"""
+        with self._transaction() as conn:
+            rows = conn.execute('''
+                UPDATE broadcasts 
+                SET owner = ?, lease_expires_at = datetime('now', ?), updated_at = CURRENT_TIMESTAMP
+                WHERE id IN (
+                    SELECT id FROM broadcasts 
+                    WHERE status = 'running'
+                    AND (owner IS NULL OR lease_expires_at < datetime('now') OR (owner = ? AND ?))
+                )
+                RETURNING id, chat_id, message_id, text
+            ''', (owner, f'+{lease_seconds} seconds', owner, include_own)).fetchall()
+        return sorted(rows)
+    
+    def renew_broadcast_leases(self, owner, lease_seconds):
+        """Extend the leases of owner's running broadcasts"""
+        self._execute('''
+            UPDATE broadcasts 
+            SET lease_expires_at = datetime('now', ?)
+            WHERE owner = ? AND status = 'running'
+        ''', (f'+{lease_seconds} seconds', owner))
+    
+    def release_broadcasts(self, owner):
+        """Give up owner's running broadcasts so any process can claim them right away"""
+        self._execute('''
+            UPDATE broadcasts 
+            SET owner = NULL, lease_expires_at = NULL
+            WHERE owner = ? AND status = 'running'
+        ''', (owner,))
+    
+    def get_broadcast_pending(self, broadcast_id):
+        """Get user IDs a broadcast still has to reach"""
+        rows = self._fetchall('''
+            SELECT user_id FROM broadcast_recipients 
+            WHERE broadcast_id = ? AND status = 'pending'
+        ''', (broadcast_id,))
+        return [row[0] for row in rows]
+    
+    def get_broadcast_counts(self, broadcast_id):
+        """Get recipient counts by status for a broadcast"""
+        rows = self._fetchall('''
+            SELECT status, COUNT(*) FROM broadcast_recipients 
+            WHERE broadcast_id = ?
+            GROUP BY status
+        ''', (broadcast_id,))
+        return dict(rows)
+    
+    def save_broadcast_results(self, broadcast_id, results):
+        """Save delivery results, a list of (user_id, status), in one transaction"""
+        blocked = [(user_id,) for user_id, status in results if status == 'blocked']
+        with self._transaction() as conn:
+            conn.executemany('''
+                UPDATE broadcast_recipients 
+                SET status = ?
+                WHERE broadcast_id = ? AND user_id = ?
+            ''', [(status, broadcast_id, user_id) for user_id, status in results])
+            if blocked:
+                conn.executemany('INSERT OR IGNORE INTO blocked_users (user_id) VALUES (?)', blocked)
+        if blocked:
+            with self._changing_cache():
+                if self._blocked_cache is not None:
+                    self._blocked_cache.update(row[0] for row in blocked)
+    
+    def finish_broadcast(self, broadcast_id):
+        """Mark a broadcast as done"""
+        self._execute('''
+            UPDATE broadcasts 
+            SET status = 'done', updated_at = CURRENT_TIMESTAMP
+            WHERE id = ?
+        ''', (broadcast_id,))
+    
+    def get_blocked_user_ids(self):
+        """Get IDs of users who blocked the bot, served from the in-memory set"""
+        with self._cache_lock:
+            if self._blocked_cache is not None:
+                return set(self._blocked_cache)
+        
+        version = self._cache_version
+        blocked = {row[0] for row in self._fetchall('SELECT user_id FROM blocked_users')}
+        
+        def fill():
+            if self._blocked_cache is None:
+                self._blocked_cache = set(blocked)
+        self._fill_cache(version, fill)
+        return blocked
+    
+    def is_user_blocked(self, user_id):
+        """Whether a user blocked the bot"""
+        blocked = self._blocked_cache
+        if blocked is None:
+            blocked = self.get_blocked_user_ids()
+        return user_id in blocked
+    
+    def is_user_blocked_cached(self, user_id):
+        """Whether a user blocked the bot, from the in-memory set only (KeyError if not loaded yet)"""
+        if self._blocked_cache is None:
+            raise KeyError(user_id)
+        return user_id in self._blocked_cache
+    
+    def unblock_user(self, user_id):
+        """Forget that a user blocked the bot (they talked to it again)"""
+        with self._status_lock:
+            self._execute('DELETE FROM blocked_users WHERE user_id = ?', (user_id,))
+            with self._changing_cache():
+                if self._blocked_cache is not None:
+                    self._blocked_cache.discard(user_id)
     
     def close(self):
-        """Close database connection"""
-        self.conn.close()
+        """Close all database connections (after committing queued writes)"""
+        if self._write_thread is not None:
+            self._write_queue.put(None)
+            self._write_thread.join()
+            self._write_thread = None
+        
+        with self._connections_lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections = []
@@ -0,0 +1,328 @@
+import asyncio
+import logging
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import BadRequest
+
+from config import (
+    VIDEO_DOWNLOAD_WORKERS, AUDIO_DOWNLOAD_WORKERS, MAX_JOBS_PER_USER, MAX_RUNNING_JOBS_PER_USER,
+    INSTANCE_ID, LEASE_SECONDS, LEASE_RENEW_INTERVAL
+)
+from metrics import QUEUE_DEPTH, RUNNING_JOBS
+from progress import ProgressReporter
+
+logger = logging.getLogger(__name__)
+
+
+class StatusMessage:
+    """Status message addressed by chat and message ID (survives restarts)"""
+    def __init__(self, bot, chat_id, message_id):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.message_id = message_id
+    
+    async def edit_text(self, text, **kwargs):
+        """Edit the status message, ignoring 'message is not modified' errors"""
+        try:
+            return await self.bot.edit_message_text(
+                text,
+                chat_id=self.chat_id,
+                message_id=self.message_id,
+                **kwargs
+            )
+        except BadRequest as e:
+            if 'not modified' not in str(e).lower():
+                raise
+
+
+def job_status(outcome, cancelled=False):
+    """download_jobs status for a job outcome: done (also served from the cache), cancelled or failed"""
+    if cancelled or outcome == 'cancelled':
+        return 'cancelled'
+    if outcome in (None, 'done', 'cached'):
+        return 'done'
+    return 'failed'
+
+
+def cancel_markup(job_id):
+    """Inline keyboard with a cancel button for a job"""
+    return InlineKeyboardMarkup([[InlineKeyboardButton("❌ Cancel", callback_data=f"cancel_job:{job_id}")]])
+
+
+class DownloadScheduler:
+    """Persistent download queue with a bounded worker pool per media type.
+    
+    Each user may have at most max_jobs_per_user jobs queued or running, and
+    at most max_running_per_user of them running at once; workers skip over
+    the queued jobs of a user at that limit, so one user cannot occupy every
+    download slot.
+    
+    Jobs are leased to this process (owner) in the database. Only jobs it
+    owns, or whose owner stopped renewing its lease, are resumed here, so
+    several processes sharing a database never run the same job twice.
+    """
+    def __init__(self, db, video_workers=VIDEO_DOWNLOAD_WORKERS, audio_workers=AUDIO_DOWNLOAD_WORKERS,
+                 max_jobs_per_user=MAX_JOBS_PER_USER, max_running_per_user=MAX_RUNNING_JOBS_PER_USER,
+                 owner=INSTANCE_ID, lease_seconds=LEASE_SECONDS, lease_interval=LEASE_RENEW_INTERVAL):
+        self.db = db
+        self.owner = owner
+        self.lease_seconds = lease_seconds
+        self.lease_interval = lease_interval
+        self.lease_task = None
+        self.limits = {'video': video_workers, 'audio': audio_workers}
+        self.max_jobs_per_user = max_jobs_per_user
+        self.max_running_per_user = max_running_per_user
+        # User ID -> number of jobs taken by a worker and not finished yet
+        self.user_running = Counter()
+        self.executors = {
+            media_type: ThreadPoolExecutor(max_workers=limit, thread_name_prefix=f"{media_type}-download")
+            for media_type, limit in self.limits.items()
+        }
+        self.pending = {media_type: deque() for media_type in self.limits}
+        # Running job ID -> (job, ProgressReporter)
+        self.running = {}
+        self.conditions = {}
+        self.workers = []
+        # Queue position updates running in the background
+        self.announcements = set()
+        self.bot = None
+        self.handler = None
+        
+        for media_type in self.limits:
+            QUEUE_DEPTH.set_function(lambda media_type=media_type: len(self.pending[media_type]), media_type=media_type)
+            RUNNING_JOBS.set_function(
+                lambda media_type=media_type: sum(
+                    1 for job, _ in list(self.running.values()) if job['media_type'] == media_type
+                ),
+                media_type=media_type
+            )
+    
+    async def start(self, bot, handler):
+        """Claim unfinished jobs from the database and start the workers.
+        
+        handler is awaited as handler(bot, job, reporter, executor), where
+        reporter is the job's ProgressReporter, and returns the job's
+        (outcome, error); see job_status().
+        """
+        self.bot = bot
+        self.handler = handler
+        self.conditions = {media_type: asyncio.Condition() for media_type in self.limits}
+        
+        resumed = await self._enqueue_claimed(include_own=True)
+        if resumed:
+            logger.info(f"Resuming {resumed} queued download job(s)")
+        
+        for media_type, limit in self.limits.items():
+            for _ in range(limit):
+                self.workers.append(asyncio.create_task(self._worker(media_type)))
+            self._announce_later(media_type)
+        self.lease_task = asyncio.create_task(self._lease_loop())
+    
+    async def stop(self):
+        """Stop the workers and release this process's jobs.
+        
+        Interrupted jobs stay in the queue for the next start (of this or another process).
+        """
+        if self.lease_task is not None:
+            self.lease_task.cancel()
+            await asyncio.gather(self.lease_task, return_exceptions=True)
+            self.lease_task = None
+        # Cancelling the workers first leaves the jobs' status alone; the
+        # reporters then make the download threads stop at their next progress hook
+        reporters = [reporter for _, reporter in self.running.values()]
+        tasks = self.workers + list(self.announcements)
+        for task in tasks:
+            task.cancel()
+        for reporter in reporters:
+            reporter.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.workers = []
+        for executor in self.executors.values():
+            executor.shutdown(wait=False, cancel_futures=True)
+        await self.db.release_jobs(self.owner)
+    
+    async def _enqueue_claimed(self, include_own=False):
+        """Claim jobs in the database and queue the ones not already here. Returns how many were queued."""
+        known = set(self.running)
+        known.update(job['id'] for queue in self.pending.values() for job in queue)
+        claimed = 0
+        
+        for row in await self.db.claim_jobs(self.owner, self.lease_seconds, include_own):
+            job_id, user_id, chat_id, message_id, url, media_type = row
+            if job_id in known:
+                continue
+            job = {
+                'id': job_id,
+                'user_id': user_id,
+                'chat_id': chat_id,
+                'message_id': message_id,
+                'url': url,
+                'media_type': media_type if media_type in self.limits else 'video',
+                'position': None,
+            }
+            condition = self.conditions[job['media_type']]
+            async with condition:
+                self.pending[job['media_type']].append(job)
+                condition.notify()
+            claimed += 1
+        return claimed
+    
+    async def _lease_loop(self):
+        """Keep this process's leases alive and take over jobs of processes that stopped renewing"""
+        while True:
+            await asyncio.sleep(self.lease_interval)
+            try:
+                await self.db.renew_job_leases(self.owner, self.lease_seconds)
+                taken_over = await self._enqueue_claimed()
+                if taken_over:
+                    logger.info(f"Took over {taken_over} download job(s) with expired leases")
+                    for media_type in self.limits:
+                        await self._announce_positions(media_type)
+            except Exception as e:
+                logger.error(f"Error renewing download job leases: {e}")
+    
+    def user_job_count(self, user_id):
+        """Number of jobs a user has queued or running"""
+        queued = sum(1 for queue in self.pending.values() for job in queue if job['user_id'] == user_id)
+        return queued + self.user_running[user_id]
+    
+    def can_submit(self, user_id):
+        """Whether a user is below their queued/running job limit"""
+        return self.user_job_count(user_id) < self.max_jobs_per_user
+    
+    async def submit(self, user_id, chat_id, url, media_type, status_message, trace=None):
+        """Persist a new download job and queue it. Returns None if the user is at their job limit.
+        
+        trace (a JobTrace) is handed to the handler with the job as job['trace'].
+        """
+        if not self.can_submit(user_id):
+            return None
+        
+        job_id = await self.db.add_job(
+            user_id, chat_id, status_message.message_id, url, media_type, self.owner, self.lease_seconds
+        )
+        job = {
+            'id': job_id,
+            'user_id': user_id,
+            'chat_id': chat_id,
+            'message_id': status_message.message_id,
+            'url': url,
+            'media_type': media_type,
+            'position': None,
+            'trace': trace,
+        }
+        
+        condition = self.conditions[media_type]
+        async with condition:
+            self.pending[media_type].append(job)
+            condition.notify()
+        
+        await self._announce_positions(media_type)
+        return job_id
+    
+    async def cancel(self, job_id, user_id):
+        """Cancel a queued or running job owned by user_id. Returns True if found."""
+        if job_id in self.running:
+            job, reporter = self.running[job_id]
+            if job['user_id'] != user_id:
+                return False
+            reporter.cancel()
+            return True
+        
+        for media_type, queue in self.pending.items():
+            for job in list(queue):
+                if job['id'] == job_id and job['user_id'] == user_id:
+                    queue.remove(job)
+                    await self.db.update_job_status(job_id, 'cancelled')
+                    await StatusMessage(self.bot, job['chat_id'], job['message_id']).edit_text("🚫 Download cancelled.")
+                    await self._announce_positions(media_type)
+                    return True
+        return False
+    
+    def queue_length(self, media_type):
+        """Number of jobs waiting for a worker"""
+        return len(self.pending[media_type])
+    
+    def _announce_later(self, media_type):
+        """Run _announce_positions in the background, keeping a reference to the task"""
+        task = asyncio.create_task(self._announce_positions(media_type))
+        self.announcements.add(task)
+        task.add_done_callback(self._announced)
+    
+    def _announced(self, task):
+        self.announcements.discard(task)
+        if not task.cancelled() and task.exception():
+            logger.error(f"Error announcing queue positions: {task.exception()}")
+    
+    async def _announce_positions(self, media_type):
+        """Tell waiting users their position in the queue when it changes"""
+        for index, job in enumerate(list(self.pending[media_type])):
+            position = index + 1
+            if job['position'] == position:
+                continue
+            job['position'] = position
+            try:
+                await StatusMessage(self.bot, job['chat_id'], job['message_id']).edit_text(
+                    f"🕒 Queued for download. Position in queue: {position}",
+                    reply_markup=cancel_markup(job['id'])
+                )
+            except Exception as e:
+                logger.error(f"Error updating queue position for job {job['id']}: {e}")
+    
+    async def _worker(self, media_type):
+        """Take jobs of one media type off the queue and run them"""
+        condition = self.conditions[media_type]
+        queue = self.pending[media_type]
+        
+        while True:
+            async with condition:
+                await condition.wait_for(lambda: self._next_job(queue) is not None)
+                job = self._next_job(queue)
+                queue.remove(job)
+                self.user_running[job['user_id']] += 1
+            
+            self._announce_later(media_type)
+            try:
+                await self._run_job(job)
+            finally:
+                self.user_running[job['user_id']] -= 1
+                if self.user_running[job['user_id']] <= 0:
+                    del self.user_running[job['user_id']]
+                # The user's other queued jobs (of any type) may run now
+                for other in self.conditions.values():
+                    async with other:
+                        other.notify_all()
+    
+    def _next_job(self, queue):
+        """First queued job whose user is below the running limit"""
+        for job in queue:
+            if self.user_running[job['user_id']] < self.max_running_per_user:
+                return job
+        return None
+    
+    async def _run_job(self, job):
+        """Run a single job and record its outcome"""
+        await self.db.update_job_status(job['id'], 'running')
+        status_message = StatusMessage(self.bot, job['chat_id'], job['message_id'])
+        reporter = ProgressReporter(asyncio.get_running_loop(), status_message, reply_markup=cancel_markup(job['id']))
+        self.running[job['id']] = (job, reporter)
+        
+        try:
+            outcome, error = await self.handler(self.bot, job, reporter, self.executors[job['media_type']])
+            status = job_status(outcome, reporter.cancelled.is_set())
+            if status == 'failed':
+                logger.error(f"Download job {job['id']} failed: {error or outcome}")
+                await self.db.update_job_status(job['id'], status, error or outcome)
+            else:
+                await self.db.update_job_status(job['id'], status)
+        except asyncio.CancelledError:
+            # Bot is shutting down - leave the job as 'running' so it resumes on restart
+            raise
+        except Exception as e:
+            logger.error(f"Download job {job['id']} failed: {e}")
+            await self.db.update_job_status(job['id'], 'failed', str(e))
+        finally:
+            del self.running[job['id']]
+            await reporter.close()
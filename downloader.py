@@ -1,102 +1,574 @@
 import yt_dlp
+import copy
 import os
-from config import DOWNLOAD_FOLDER, MAX_FILE_SIZE_MB, LONG_VIDEO_THRESHOLD
+import shlex
+import shutil
+import subprocess
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+from yt_dlp.utils import DownloadCancelled
+from config import (
+    DOWNLOAD_FOLDER, MAX_FILE_SIZE_MB, LONG_VIDEO_THRESHOLD,
+    MEDIA_INFO_CACHE_TTL, MEDIA_INFO_CACHE_SIZE, AUDIO_PASSTHROUGH_CODECS,
+    FRAGMENT_DOWNLOADS_SHORT, FRAGMENT_DOWNLOADS_LONG, HTTP_CHUNK_SIZE_MB_SHORT, HTTP_CHUNK_SIZE_MB_LONG,
+    EXTERNAL_DOWNLOADER, EXTERNAL_DOWNLOADER_ARGS, EXTERNAL_DOWNLOADER_JOBS
+)
+from metrics import MEDIA_INFO_SECONDS, DOWNLOAD_SECONDS, DOWNLOADED_BYTES, ERRORS, CACHE_REQUESTS
+from tracing import trace_phase
+
+# Format selectors used when the info dict has no formats list to choose from
+DEFAULT_FORMATS = {
+    'video': 'best[ext=mp4]/best',
+    'audio': 'bestaudio/best',
+}
+MP3_BYTES_PER_SECOND = 192 * 1000 // 8  # Output size of the 192 kbps mp3 transcode
+# Container an audio codec is sent in when it isn't re-encoded
+AUDIO_CONTAINERS = {
+    'aac': 'm4a',
+    'mp3': 'mp3',
+    'opus': 'ogg',
+}
+# Codec of audio formats that don't list one (e.g. direct links), by file extension
+AUDIO_EXT_CODECS = {'m4a': 'aac', 'aac': 'aac', 'mp3': 'mp3', 'opus': 'opus'}
+
+# Transfer settings per job class, see job_class()
+TRANSFER_PROFILES = {
+    'short': {
+        'fragments': FRAGMENT_DOWNLOADS_SHORT,
+        'chunk_mb': HTTP_CHUNK_SIZE_MB_SHORT,
+        'external': 'short' in EXTERNAL_DOWNLOADER_JOBS,
+    },
+    'long': {
+        'fragments': FRAGMENT_DOWNLOADS_LONG,
+        'chunk_mb': HTTP_CHUNK_SIZE_MB_LONG,
+        'external': 'long' in EXTERNAL_DOWNLOADER_JOBS,
+    },
+}
+
+# Query parameters that never change which media a link points to
+TRACKING_PARAMS = {'si', 'feature', 'fbclid', 'gclid', 'igshid', 'igsh', 'ref', 'ref_src', 'share_id'}
+
+
+def normalize_url(url):
+    """Normalize a URL for use as a cache key"""
+    parts = urlsplit(url.strip())
+    netloc = parts.netloc.lower()
+    if netloc.startswith('www.'):
+        netloc = netloc[4:]
+    query = sorted(
+        (key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True)
+        if key not in TRACKING_PARAMS and not key.startswith('utm_')
+    )
+    return urlunsplit((parts.scheme.lower(), netloc, parts.path.rstrip('/'), urlencode(query), ''))
+
+
+def audio_codec(acodec, ext=None):
+    """Normalize a yt-dlp acodec string ('mp4a.40.2', 'opus', ...) to a codec name.
+    
+    Formats with no codec listed (e.g. direct links) go by their extension.
+    """
+    acodec = (acodec or '').lower()
+    if not acodec:
+        return AUDIO_EXT_CODECS.get((ext or '').lower(), '')
+    if acodec.startswith(('mp4a', 'aac')):
+        return 'aac'
+    return acodec.split('.')[0]
+
+
+def run_ffmpeg(args):
+    """Run ffmpeg with the given arguments, raising on failure"""
+    result = subprocess.run(
+        ['ffmpeg', '-y', '-hide_banner', '-loglevel', 'error', *args],
+        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"ffmpeg failed: {result.stderr.decode('utf-8', 'replace').strip()}")
+
 
 class MediaDownloader:
-    def __init__(self):
+    def __init__(self, info_cache_ttl=MEDIA_INFO_CACHE_TTL, info_cache_size=MEDIA_INFO_CACHE_SIZE):
         self.download_folder = DOWNLOAD_FOLDER
+        
+        # Info dict cache: normalized URL -> (expires_at, info), kept in LRU order
+        self.info_cache_ttl = info_cache_ttl
+        self.info_cache_size = info_cache_size
+        self._info_cache = OrderedDict()
+        # In-flight extractions: normalized URL -> Future shared by concurrent callers
+        self._info_inflight = {}
+        self._info_lock = threading.Lock()
+        
+        # Running downloads: (extractor, media id, media type) -> shared result
+        self._downloads = {}
+        # Downloaded file path -> number of callers still using it
+        self._file_refs = {}
+        self._download_lock = threading.Lock()
+        
+        self.passthrough_codecs = set(AUDIO_PASSTHROUGH_CODECS)
+        
+        self.external_downloader = None
+        if EXTERNAL_DOWNLOADER:
+            if shutil.which(EXTERNAL_DOWNLOADER):
+                self.external_downloader = EXTERNAL_DOWNLOADER
+            else:
+                print(f"External downloader {EXTERNAL_DOWNLOADER} not found, using yt-dlp's own downloader")
     
-    def get_media_info(self, url):
-        """Get information about the media without downloading"""
-        ydl_opts = {
-            'quiet': True,
-            'no_warnings': True,
-            'extract_flat': False,
-        }
+    def extract_info(self, url):
+        """Get the full yt-dlp info dict for a URL.
+        
+        Results are cached with a TTL, and concurrent calls for the same URL
+        share a single extraction. Raises on extraction errors.
+        """
+        key = normalize_url(url)
+        
+        with self._info_lock:
+            cached = self._info_cache.get(key)
+            if cached and cached[0] > time.monotonic():
+                self._info_cache.move_to_end(key)
+                CACHE_REQUESTS.inc(cache='media_info', result='hit')
+                return copy.deepcopy(cached[1])
+            
+            future = self._info_inflight.get(key)
+            is_leader = future is None
+            if is_leader:
+                future = Future()
+                self._info_inflight[key] = future
+        
+        if not is_leader:
+            CACHE_REQUESTS.inc(cache='media_info', result='shared')
+            return copy.deepcopy(future.result())
         
+        CACHE_REQUESTS.inc(cache='media_info', result='miss')
+        started = time.monotonic()
         try:
+            ydl_opts = {
+                'quiet': True,
+                'no_warnings': True,
+                'extract_flat': False,
+            }
             with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                info = ydl.extract_info(url, download=False)
-                
-                duration = info.get('duration', 0)
-                title = info.get('title', 'Unknown')
-                
-                return {
-                    'title': title,
-                    'duration': duration,
-                    'is_long': duration > LONG_VIDEO_THRESHOLD,
-                    'url': url
-                }
+                info = ydl.sanitize_info(ydl.extract_info(url, download=False))
+        except Exception as e:
+            with self._info_lock:
+                del self._info_inflight[key]
+            ERRORS.inc(extractor='unknown', stage='extract')
+            future.set_exception(e)
+            raise
+        
+        MEDIA_INFO_SECONDS.observe(
+            time.monotonic() - started, extractor=info.get('extractor_key') or info.get('extractor') or 'unknown'
+        )
+        
+        with self._info_lock:
+            del self._info_inflight[key]
+            self._info_cache[key] = (time.monotonic() + self.info_cache_ttl, info)
+            self._info_cache.move_to_end(key)
+            while len(self._info_cache) > self.info_cache_size:
+                self._info_cache.popitem(last=False)
+        
+        future.set_result(info)
+        return copy.deepcopy(info)
+    
+    def get_media_info(self, url):
+        """Get information about the media without downloading"""
+        try:
+            info = self.extract_info(url)
+            
+            duration = info.get('duration') or 0
+            title = info.get('title', 'Unknown')
+            
+            return {
+                'title': title,
+                'duration': duration,
+                'is_long': duration > LONG_VIDEO_THRESHOLD,
+                'url': url,
+                'extractor': info.get('extractor_key') or info.get('extractor'),
+                'id': info.get('id')
+            }
         except Exception as e:
             print(f"Error getting media info: {e}")
             return None
     
-    def download_video(self, url, progress_callback=None):
-        """Download video from URL"""
-        output_template = os.path.join(self.download_folder, '%(title)s.%(ext)s')
+    @staticmethod
+    def estimate_size(fmt, duration=None):
+        """Estimated size in bytes of a yt-dlp format dict, or None if unknown"""
+        size = fmt.get('filesize') or fmt.get('filesize_approx')
+        if not size and fmt.get('tbr') and duration:
+            # tbr is in kbit/s
+            size = fmt['tbr'] * 1000 / 8 * duration
+        return int(size) if size else None
+    
+    def select_format(self, info, media_type, max_bytes=None):
+        """Choose the format to download from an info dict within a byte budget.
+        
+        Video prefers mp4 and then the best quality, like 'best[ext=mp4]/best';
+        audio prefers the best audio-only format that can be sent without
+        transcoding. Formats of unknown size are
+        allowed (the size is checked again after the download).
+        Returns (format selector, estimated size, limited), where limited is
+        True if the budget ruled out a better format, or
+        (None, smallest size, True) if nothing fits.
+        """
+        duration = info.get('duration') or 0
+        formats = info.get('formats') or []
+        if media_type == 'video':
+            candidates = [f for f in formats if f.get('vcodec') != 'none' and f.get('acodec') != 'none']
+        else:
+            candidates = [f for f in formats if f.get('vcodec') == 'none' and f.get('acodec') != 'none']
+            candidates = candidates or [f for f in formats if f.get('acodec') != 'none']
         
+        if not candidates:
+            size = self.estimate_size(info, duration)
+            if max_bytes is not None and size and size > max_bytes:
+                return None, size, True
+            return DEFAULT_FORMATS[media_type], size, False
+        
+        # yt-dlp lists formats worst to best
+        candidates = list(reversed(candidates))
+        if media_type == 'video':
+            candidates.sort(key=lambda f: f.get('ext') != 'mp4')
+        else:
+            candidates.sort(key=lambda f: audio_codec(f.get('acodec'), f.get('ext')) not in self.passthrough_codecs)
+        
+        def output_size(fmt):
+            size = self.estimate_size(fmt, duration)
+            if media_type == 'audio' and audio_codec(fmt.get('acodec'), fmt.get('ext')) not in self.passthrough_codecs:
+                # The mp3 we upload, not just the source, has to fit
+                size = max(size or 0, duration * MP3_BYTES_PER_SECOND) or None
+            return size
+        
+        for index, fmt in enumerate(candidates):
+            size = output_size(fmt)
+            if max_bytes is None or size is None or size <= max_bytes:
+                return fmt['format_id'], size, index > 0
+        
+        return None, min(output_size(fmt) for fmt in candidates), True
+    
+    @staticmethod
+    def job_class(info):
+        """'long' for media over LONG_VIDEO_THRESHOLD seconds, 'short' otherwise"""
+        return 'long' if (info.get('duration') or 0) > LONG_VIDEO_THRESHOLD else 'short'
+    
+    def downloader_name(self, job_class):
+        """External downloader used for a job class (e.g. 'aria2c'), or 'native' for yt-dlp's own"""
+        if TRANSFER_PROFILES[job_class]['external'] and self.external_downloader:
+            return os.path.basename(self.external_downloader).lower()
+        return 'native'
+    
+    def transfer_options(self, info):
+        """yt-dlp options for fetching a media item, tuned to its job class.
+        
+        Returns (options, description); the description (e.g.
+        'long/8 fragments/10MB chunks') is reported with the download.
+        """
+        job_class = self.job_class(info)
+        profile = TRANSFER_PROFILES[job_class]
+        options = {'concurrent_fragment_downloads': profile['fragments']}
+        description = [job_class, f"{profile['fragments']} fragments"]
+        
+        if profile['chunk_mb']:
+            options['http_chunk_size'] = profile['chunk_mb'] * 1024 * 1024
+            description.append(f"{profile['chunk_mb']}MB chunks")
+        
+        name = self.downloader_name(job_class)
+        if name != 'native':
+            # Progress and cancellation are coarser with an external downloader
+            options['external_downloader'] = {'default': self.external_downloader}
+            options['external_downloader_args'] = {name: shlex.split(EXTERNAL_DOWNLOADER_ARGS)}
+            description.append(name)
+        
+        return options, '/'.join(description)
+    
+    def estimate_download_size(self, url, media_type, max_bytes=None):
+        """Estimated disk space a download will take, or None if unknown.
+        
+        Audio counts twice: the source and the remuxed/transcoded file exist
+        side by side for a moment.
+        """
+        try:
+            info = self.extract_info(url)
+        except Exception:
+            return None
+        format_id, size, _ = self.select_format(info, media_type, max_bytes)
+        if format_id is None or not size:
+            return None
+        return size * 2 if media_type == 'audio' else size
+    
+    def files_in_use(self):
+        """Paths of downloaded files not released by every caller yet"""
+        with self._download_lock:
+            return set(self._file_refs)
+    
+    def _shared_download(self, url, media_type, download, progress_callback=None, max_bytes=None, trace=None):
+        """Run a download once per (media id, format) however many callers ask for it.
+        
+        While a download is running, other callers for the same media wait for
+        it and receive the same file. Each successful caller holds a reference
+        to the file and must hand it back with release_file(). Waiting callers
+        call progress_callback({'status': 'waiting'}) every second, so a
+        progress hook can cancel the wait by raising DownloadCancelled.
+        
+        The format is chosen up front from the info dict so it fits in
+        max_bytes; if nothing does, nothing is downloaded and the result has
+        'too_large' set with the smallest available size in 'min_size'.
+        The extractor, format and phase timings are recorded on trace, if given.
+        """
+        try:
+            # Reuse the (cached) info dict instead of extracting again
+            info = self.extract_info(url)
+        except Exception as e:
+            return {
+                'success': False,
+                'error': str(e)
+            }
+        
+        format_id, estimated_size, limited = self.select_format(info, media_type, max_bytes)
+        if format_id is None:
+            return {
+                'success': False,
+                'too_large': True,
+                'min_size': estimated_size,
+                'error': 'No format fits in the size limit'
+            }
+        
+        key = (info.get('extractor_key') or info.get('extractor'), info.get('id') or url, media_type, format_id)
+        if trace:
+            trace.extractor = key[0]
+            trace.format_id = format_id
+        
+        with self._download_lock:
+            flight = self._downloads.get(key)
+            is_leader = flight is None
+            if is_leader:
+                flight = {'future': Future(), 'waiters': 0}
+                self._downloads[key] = flight
+            else:
+                flight['waiters'] += 1
+        
+        if not is_leader:
+            with trace_phase(trace, 'download'):
+                return self._wait_for_download(url, media_type, download, progress_callback, max_bytes, trace, key, flight)
+        
+        try:
+            started = time.monotonic()
+            result = download(info, format_id)
+            result['format_id'] = format_id
+            result['budget_limited'] = limited
+            result['download_seconds'] = time.monotonic() - started
+            job_class = self.job_class(info)
+            DOWNLOAD_SECONDS.observe(
+                result['download_seconds'],
+                media_type=media_type, job_class=job_class, downloader=self.downloader_name(job_class)
+            )
+            DOWNLOADED_BYTES.inc(result['file_size'], media_type=media_type, job_class=job_class)
+        except DownloadCancelled as e:
+            result = {
+                'success': False,
+                'cancelled': True,
+                'error': str(e)
+            }
+        except Exception as e:
+            ERRORS.inc(extractor=key[0] or 'unknown', stage='download')
+            result = {
+                'success': False,
+                'error': str(e)
+            }
+        
+        with self._download_lock:
+            del self._downloads[key]
+            if result['success']:
+                # One reference for the leader plus one for every waiting caller
+                path = result['file_path']
+                self._file_refs[path] = self._file_refs.get(path, 0) + 1 + flight['waiters']
+        
+        flight['future'].set_result(result)
+        return dict(result)
+    
+    def _wait_for_download(self, url, media_type, download, progress_callback, max_bytes, trace, key, flight):
+        """Wait for another caller's download of the same media"""
+        while True:
+            try:
+                result = flight['future'].result(timeout=1)
+                break
+            except FutureTimeout:
+                pass
+            
+            try:
+                if progress_callback:
+                    progress_callback({'status': 'waiting'})
+            except DownloadCancelled as e:
+                with self._download_lock:
+                    finished = self._downloads.get(key) is not flight
+                    if not finished:
+                        flight['waiters'] -= 1
+                if finished:
+                    # The download completed meanwhile and counted us in - hand our reference back
+                    result = flight['future'].result()
+                    if result['success']:
+                        self.release_file(result['file_path'])
+                return {
+                    'success': False,
+                    'cancelled': True,
+                    'error': str(e)
+                }
+        
+        if result.get('cancelled'):
+            # Whoever ran the download cancelled it - start over for ourselves
+            return self._shared_download(url, media_type, download, progress_callback, max_bytes, trace)
+        return dict(result)
+    
+    def download_video(self, url, progress_callback=None, max_bytes=None, job_dir=None, trace=None):
+        """Download video from URL, in the best format that fits in max_bytes.
+        
+        The file is written to job_dir (the download folder if not given) and
+        the download is recorded on trace, if given.
+        """
+        return self._shared_download(
+            url, 'video', lambda info, format_id: self._download_video(info, format_id, progress_callback, job_dir, trace),
+            progress_callback, max_bytes, trace
+        )
+    
+    def _output_template(self, job_dir):
+        """Output template for one download.
+        
+        A job directory belongs to one job, so the name there is deterministic
+        and a retried download resumes its .part file. In the shared download
+        folder a unique suffix keeps concurrent downloads apart.
+        """
+        if job_dir:
+            return os.path.join(job_dir, "%(extractor_key)s-%(id)s.%(ext)s")
+        return os.path.join(self.download_folder, f"%(extractor_key)s-%(id)s-{uuid.uuid4().hex}.%(ext)s")
+    
+    @staticmethod
+    def _downloaded_path(ydl, info):
+        """Path of the file yt-dlp wrote, after its postprocessors ran"""
+        for download in info.get('requested_downloads') or []:
+            if download.get('filepath'):
+                return download['filepath']
+        return ydl.prepare_filename(info)
+    
+    def _download_video(self, info, format_id, progress_callback=None, job_dir=None, trace=None):
+        output_template = self._output_template(job_dir)
+        
+        transfer_options, transfer = self.transfer_options(info)
         ydl_opts = {
-            'format': 'best[ext=mp4]/best',
+            'format': format_id,
             'outtmpl': output_template,
             'quiet': False,
             'no_warnings': False,
             'progress_hooks': [progress_callback] if progress_callback else [],
+            **transfer_options,
         }
         
-        try:
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                info = ydl.extract_info(url, download=True)
-                filename = ydl.prepare_filename(info)
-                
-                return {
-                    'success': True,
-                    'file_path': filename,
-                    'title': info.get('title', 'Unknown'),
-                    'file_size': os.path.getsize(filename) if os.path.exists(filename) else 0
-                }
-        except Exception as e:
+        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+            with trace_phase(trace, 'download'):
+                info = ydl.process_ie_result(info, download=True)
+            filename = self._downloaded_path(ydl, info)
+            
             return {
-                'success': False,
-                'error': str(e)
+                'success': True,
+                'file_path': filename,
+                'title': info.get('title', 'Unknown'),
+                'extractor': info.get('extractor_key') or info.get('extractor'),
+                'id': info.get('id'),
+                'file_size': os.path.getsize(filename) if os.path.exists(filename) else 0,
+                'transfer': transfer
             }
     
-    def download_audio(self, url, progress_callback=None):
-        """Download audio only from URL"""
-        output_template = os.path.join(self.download_folder, '%(title)s.%(ext)s')
+    def download_audio(self, url, progress_callback=None, max_bytes=None, job_dir=None, trace=None):
+        """Download audio only from URL, from the best source that fits in max_bytes.
+        
+        The file is written to job_dir (the download folder if not given) and
+        the download is recorded on trace, if given.
+        """
+        return self._shared_download(
+            url, 'audio', lambda info, format_id: self._download_audio(info, format_id, progress_callback, job_dir, trace),
+            progress_callback, max_bytes, trace
+        )
+    
+    def _download_audio(self, info, format_id, progress_callback=None, job_dir=None, trace=None):
+        output_template = self._output_template(job_dir)
         
+        transfer_options, transfer = self.transfer_options(info)
         ydl_opts = {
-            'format': 'bestaudio/best',
+            'format': format_id,
             'outtmpl': output_template,
             'quiet': False,
             'no_warnings': False,
-            'postprocessors': [{
-                'key': 'FFmpegExtractAudio',
-                'preferredcodec': 'mp3',
-                'preferredquality': '192',
-            }],
             'progress_hooks': [progress_callback] if progress_callback else [],
+            **transfer_options,
         }
         
-        try:
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                info = ydl.extract_info(url, download=True)
-                # Get the filename after audio extraction
-                filename = ydl.prepare_filename(info)
-                # Replace extension with mp3
-                filename = os.path.splitext(filename)[0] + '.mp3'
-                
-                return {
-                    'success': True,
-                    'file_path': filename,
-                    'title': info.get('title', 'Unknown'),
-                    'file_size': os.path.getsize(filename) if os.path.exists(filename) else 0
-                }
-        except Exception as e:
+        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+            with trace_phase(trace, 'download'):
+                info = ydl.process_ie_result(info, download=True)
+            with trace_phase(trace, 'postprocess'):
+                filename = self._prepare_audio(self._downloaded_path(ydl, info), info.get('acodec'), info.get('ext'))
+            
             return {
-                'success': False,
-                'error': str(e)
+                'success': True,
+                'file_path': filename,
+                'title': info.get('title', 'Unknown'),
+                'extractor': info.get('extractor_key') or info.get('extractor'),
+                'id': info.get('id'),
+                'file_size': os.path.getsize(filename) if os.path.exists(filename) else 0,
+                'transfer': transfer
             }
     
+    def _prepare_audio(self, source, acodec, ext=None):
+        """Turn a downloaded audio stream into a file Telegram plays. Returns its path.
+        
+        Codecs Telegram plays are only remuxed into their container (or left
+        alone if already in it); the rest is transcoded to 192 kbps mp3 by
+        ffmpeg in its own process. This runs on the audio download executor,
+        so AUDIO_DOWNLOAD_WORKERS caps how many transcodes run at once.
+        """
+        base, suffix = os.path.splitext(source)
+        codec = audio_codec(acodec, ext or suffix[1:])
+        
+        if codec in self.passthrough_codecs:
+            container = AUDIO_CONTAINERS.get(codec)
+            if container and suffix.lower() == '.' + container:
+                return source
+            if container:
+                target = f"{base}.{container}"
+                try:
+                    run_ffmpeg(['-i', source, '-vn', '-c:a', 'copy', target])
+                    self.cleanup_file(source)
+                    return target
+                except Exception as e:
+                    print(f"Remux of {source} failed, transcoding instead: {e}")
+        
+        target = base + '.mp3'
+        if target == source:
+            target = base + '.192k.mp3'
+        run_ffmpeg(['-i', source, '-vn', '-c:a', 'libmp3lame', '-b:a', '192k', target])
+        self.cleanup_file(source)
+        return target
+    
+    def release_file(self, file_path, retain=None):
+        """Drop one reference to a downloaded file.
+        
+        The file is only disposed of when the last holder releases it: passed
+        to retain(file_path) if given (e.g. to keep it in a cache), deleted
+        otherwise. Returns True if this was the last reference.
+        """
+        with self._download_lock:
+            refs = self._file_refs.get(file_path, 1) - 1
+            if refs > 0:
+                self._file_refs[file_path] = refs
+                return False
+            self._file_refs.pop(file_path, None)
+        
+        if retain:
+            retain(file_path)
+        else:
+            self.cleanup_file(file_path)
+        return True
+    
     def cleanup_file(self, file_path):
         """Remove downloaded file after sending"""
         try:
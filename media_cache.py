@@ -0,0 +1,153 @@
+import glob
+import hashlib
+import os
+import shutil
+import time
+
+from config import MEDIA_CACHE_FOLDER, MEDIA_CACHE_DISK_MB, MEDIA_CACHE_DISK_TTL
+from metrics import CACHE_REQUESTS
+
+# Format part of the cache key for each media type
+FORMAT_TAGS = {
+    'video': 'mp4-best',
+    'audio': 'audio-native',  # Source stream if Telegram plays it, mp3-192 otherwise
+}
+
+
+class MediaCache:
+    """Content-addressed cache of sent media.
+
+    The main tier maps '<extractor>:<media id>:<format>' to the Telegram file_id
+    returned when the media was first sent, so a hit is re-sent without any
+    download or upload. The optional disk tier keeps recent files for a short
+    window, bounded by size and age.
+    """
+    def __init__(self, db, folder=MEDIA_CACHE_FOLDER, max_disk_mb=MEDIA_CACHE_DISK_MB, disk_ttl=MEDIA_CACHE_DISK_TTL):
+        self.db = db
+        self.folder = folder
+        self.max_disk_bytes = max_disk_mb * 1024 * 1024
+        self.disk_ttl = disk_ttl
+
+        if self.disk_enabled and not os.path.exists(self.folder):
+            os.makedirs(self.folder)
+
+    @property
+    def disk_enabled(self):
+        return self.max_disk_bytes > 0
+
+    @staticmethod
+    def make_key(extractor, media_id, media_type):
+        """Build the cache key for a media item, or None if it can't be identified"""
+        if not extractor or not media_id:
+            return None
+        return f"{extractor.lower()}:{media_id}:{FORMAT_TAGS[media_type]}"
+
+    # Telegram file_id tier
+    async def get(self, cache_key):
+        """Get cached file_id info for a key"""
+        if not cache_key:
+            return None
+        row = await self.db.get_cached_media(cache_key)
+        CACHE_REQUESTS.inc(cache='media', result='hit' if row else 'miss')
+        if not row:
+            return None
+        await self.db.touch_cached_media(cache_key)
+        _, file_id, file_type, title, file_size = row
+        return {
+            'file_id': file_id,
+            'file_type': file_type,
+            'title': title,
+            'file_size': file_size
+        }
+
+    async def put(self, cache_key, file_id, file_type, title, file_size):
+        """Remember the file_id of media that was just sent"""
+        if cache_key and file_id:
+            await self.db.add_cached_media(cache_key, file_id, file_type, title, file_size)
+
+    async def invalidate(self, cache_key):
+        """Forget a cache entry"""
+        if cache_key:
+            await self.db.remove_cached_media(cache_key)
+
+    # On-disk tier
+    def _disk_name(self, cache_key):
+        return hashlib.sha1(cache_key.encode('utf-8')).hexdigest()
+
+    def get_file(self, cache_key):
+        """Get the path of a fresh cached file for a key, or None"""
+        if not self.disk_enabled or not cache_key:
+            return None
+
+        for path in glob.glob(os.path.join(self.folder, self._disk_name(cache_key) + '.*')):
+            try:
+                if time.time() - os.path.getmtime(path) > self.disk_ttl:
+                    os.remove(path)
+                    continue
+                # Refresh mtime so eviction is least-recently-used
+                os.utime(path)
+                return path
+            except OSError:
+                continue
+        return None
+
+    def store_file(self, cache_key, file_path):
+        """Move a sent file into the disk tier, or delete it if the tier is off.
+
+        Returns the path the file now lives at, or None if it was removed.
+        """
+        if not os.path.exists(file_path):
+            return None
+
+        # Already served from the disk tier
+        if os.path.dirname(os.path.abspath(file_path)) == os.path.abspath(self.folder):
+            return file_path
+
+        if not self.disk_enabled or not cache_key or os.path.getsize(file_path) > self.max_disk_bytes:
+            self._remove(file_path)
+            return None
+
+        ext = os.path.splitext(file_path)[1]
+        target = os.path.join(self.folder, self._disk_name(cache_key) + ext)
+        try:
+            shutil.move(file_path, target)
+            os.utime(target)
+        except OSError as e:
+            print(f"Error caching file: {e}")
+            self._remove(file_path)
+            return None
+
+        self.evict()
+        return target if os.path.exists(target) else None
+
+    def evict(self):
+        """Drop expired files, then least recently used ones until under the size cap"""
+        if not self.disk_enabled or not os.path.exists(self.folder):
+            return
+
+        now = time.time()
+        entries = []
+        for name in os.listdir(self.folder):
+            path = os.path.join(self.folder, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            if now - stat.st_mtime > self.disk_ttl:
+                self._remove(path)
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_disk_bytes:
+                break
+            self._remove(path)
+            total -= size
+
+    def _remove(self, path):
+        try:
+            if os.path.exists(path):
+                os.remove(path)
+        except Exception as e:
+            print(f"Error cleaning up file: {e}")
@@ -0,0 +1,215 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+from aiohttp import web
+
+from config import METRICS_HOST, METRICS_PORT
+
+logger = logging.getLogger(__name__)
+
+# Latency buckets in seconds, from fast database reads to long downloads
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+REGISTRY = []
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """A named metric with optional labels, in the Prometheus text format.
+    
+    Values are kept per label combination and updated under a lock, so
+    metrics can be recorded from download and database threads.
+    """
+    kind = None
+    
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+    
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+    
+    def _samples(self):
+        """(suffix, label values, extra labels, value) for each sample"""
+        with self._lock:
+            return [('', key, (), value) for key, value in self._values.items()]
+    
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, key, extra, value in self._samples():
+            lines.append(f"{self.name}{suffix}{_format_labels(self.labelnames, key, extra)} {_format_value(value)}")
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    """Monotonically increasing count"""
+    kind = 'counter'
+    
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """Value that goes up and down, set directly or read from a function when scraped"""
+    kind = 'gauge'
+    
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._functions = {}
+    
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+    
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+    
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+    
+    def set_function(self, function, **labels):
+        """Report function() as the value whenever the metrics are scraped"""
+        key = self._key(labels)
+        with self._lock:
+            self._functions[key] = function
+    
+    def _samples(self):
+        samples = super()._samples()
+        with self._lock:
+            functions = list(self._functions.items())
+        for key, function in functions:
+            try:
+                samples.append(('', key, (), function()))
+            except Exception as e:
+                logger.warning(f"Error reading gauge {self.name}: {e}")
+        return samples
+
+
+class Histogram(Metric):
+    """Distribution of observed values (e.g. latencies) in cumulative buckets"""
+    kind = 'histogram'
+    
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+    
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = {'counts': [0] * len(self.buckets), 'sum': 0.0}
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state['counts'][index] += 1
+                    break
+            state['sum'] += value
+    
+    @contextmanager
+    def time(self, **labels):
+        """Observe the time spent in a with block"""
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - started, **labels)
+    
+    def _samples(self):
+        samples = []
+        with self._lock:
+            items = [(key, list(state['counts']), state['sum']) for key, state in self._values.items()]
+        for key, counts, total in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                samples.append(('_bucket', key, (('le', _format_value(float(bound))),), cumulative))
+            samples.append(('_sum', key, (), total))
+            samples.append(('_count', key, (), cumulative))
+        return samples
+
+
+def render_all():
+    """All registered metrics in the Prometheus text exposition format"""
+    return '\n'.join(metric.render() for metric in REGISTRY) + '\n'
+
+
+# Media extraction and downloads
+MEDIA_INFO_SECONDS = Histogram('bot_media_info_seconds', 'Time to extract media info (cache misses)', ['extractor'])
+DOWNLOAD_SECONDS = Histogram(
+    'bot_download_seconds', 'Time to download and convert media', ['media_type', 'job_class', 'downloader']
+)
+DOWNLOADED_BYTES = Counter('bot_downloaded_bytes_total', 'Bytes downloaded', ['media_type', 'job_class'])
+ERRORS = Counter('bot_errors_total', 'Failed extractions, downloads and uploads', ['extractor', 'stage'])
+CACHE_REQUESTS = Counter('bot_cache_requests_total', 'Cache lookups by cache and result', ['cache', 'result'])
+
+# Uploads to Telegram
+UPLOAD_SECONDS = Histogram('bot_upload_seconds', 'Time to upload media to Telegram', ['media_type'])
+UPLOADED_BYTES = Counter('bot_uploaded_bytes_total', 'Bytes uploaded to Telegram', ['media_type'])
+
+# Download queue
+QUEUE_DEPTH = Gauge('bot_download_queue_depth', 'Download jobs waiting for a worker', ['media_type'])
+RUNNING_JOBS = Gauge('bot_download_jobs_running', 'Download jobs being worked on', ['media_type'])
+
+# Storage
+DB_QUERY_SECONDS = Histogram('bot_db_query_seconds', 'Time spent in each storage method', ['method'])
+DB_ERRORS = Counter('bot_db_errors_total', 'Storage method calls that raised', ['method'])
+
+# Broadcasts
+BROADCAST_MESSAGES = Counter('bot_broadcast_messages_total', 'Broadcast messages by outcome', ['outcome'])
+BROADCAST_SEND_SECONDS = Histogram('bot_broadcast_send_seconds', 'Time to deliver one broadcast message')
+
+
+class MetricsServer:
+    """Serves the metrics on http://<host>:<port>/metrics (localhost only by default)"""
+    def __init__(self, host=METRICS_HOST, port=METRICS_PORT):
+        self.host = host
+        self.port = port
+        self.runner = None
+    
+    async def handle_metrics(self, request):
+        return web.Response(text=render_all(), content_type='text/plain', charset='utf-8')
+    
+    async def start(self):
+        """Start serving, unless the port is 0"""
+        if not self.port:
+            return
+        app = web.Application()
+        app.router.add_get('/metrics', self.handle_metrics)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, self.host, self.port).start()
+        logger.info(f"Serving metrics on http://{self.host}:{self.port}/metrics")
+    
+    async def stop(self):
+        if self.runner:
+            await self.runner.cleanup()
+            self.runner = None
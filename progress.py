@@ -0,0 +1,137 @@
+import asyncio
+import logging
+import threading
+import time
+
+from yt_dlp.utils import DownloadCancelled
+
+from config import PROGRESS_UPDATE_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+
+def format_bytes(num):
+    """Human readable byte count"""
+    for unit in ('B', 'KB', 'MB'):
+        if num < 1024:
+            return f"{num:.1f} {unit}"
+        num /= 1024
+    return f"{num:.1f} GB"
+
+
+def format_eta(seconds):
+    """Human readable ETA"""
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f"{seconds // 3600}h {(seconds % 3600) // 60}m"
+    if seconds >= 60:
+        return f"{seconds // 60}m {seconds % 60}s"
+    return f"{seconds}s"
+
+
+class ProgressReporter:
+    """Relays download/upload progress to a Telegram status message.
+    
+    hook() is a yt-dlp progress hook and may be called from any worker thread;
+    events are handed to the event loop with call_soon_threadsafe. Updates are
+    collapsed so the message is edited at most once every `interval` seconds,
+    which keeps us under Telegram's edit rate limits. reply_markup (e.g. a
+    cancel button) is shown on progress updates; once cancelled, the next hook
+    call aborts yt-dlp.
+    """
+    def __init__(self, loop, status_message, reply_markup=None, interval=PROGRESS_UPDATE_INTERVAL):
+        self.loop = loop
+        self.status_message = status_message
+        self.reply_markup = reply_markup
+        self.interval = interval
+        self.cancelled = threading.Event()
+        
+        self._pending_text = None
+        self._flush_task = None
+        self._last_edit = 0.0
+        self._edit_lock = asyncio.Lock()
+    
+    def cancel(self):
+        """Request cancellation of the running job"""
+        self.cancelled.set()
+    
+    def hook(self, d):
+        """yt-dlp progress hook (runs on the download thread)"""
+        if self.cancelled.is_set():
+            raise DownloadCancelled('Cancelled by user')
+        
+        text = self._render(d)
+        if text:
+            self.loop.call_soon_threadsafe(self.update, text)
+    
+    def upload_hook(self, sent, total, elapsed):
+        """StreamingUploader progress callback (runs on the event loop)"""
+        if self.cancelled.is_set():
+            raise DownloadCancelled('Cancelled by user')
+        
+        speed = sent / elapsed if elapsed else 0
+        self.update(
+            f"📤 Uploading... {sent * 100 // total if total else 0}%\n\n"
+            f"📦 {format_bytes(sent)} / {format_bytes(total)}\n"
+            f"🚀 {format_bytes(speed)}/s"
+        )
+    
+    def _render(self, d):
+        status = d.get('status')
+        if status == 'downloading':
+            downloaded = d.get('downloaded_bytes') or 0
+            total = d.get('total_bytes') or d.get('total_bytes_estimate')
+            lines = []
+            if total:
+                lines.append(f"⬇️ Downloading... {downloaded * 100 / total:.0f}%\n")
+                lines.append(f"📦 {format_bytes(downloaded)} / {format_bytes(total)}")
+            else:
+                lines.append("⬇️ Downloading...\n")
+                lines.append(f"📦 {format_bytes(downloaded)}")
+            if d.get('speed'):
+                lines.append(f"🚀 {format_bytes(d['speed'])}/s")
+            if d.get('eta') is not None:
+                lines.append(f"⏱ ETA: {format_eta(d['eta'])}")
+            return "\n".join(lines)
+        if status == 'finished':
+            return "⚙️ Processing..."
+        if status == 'waiting':
+            return "⏳ Same media is already downloading for someone else, waiting for it..."
+        return None
+    
+    def update(self, text):
+        """Queue a progress text; only the latest one is shown (event loop only)"""
+        self._pending_text = text
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush())
+    
+    async def _flush(self):
+        delay = self._last_edit + self.interval - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        
+        async with self._edit_lock:
+            text, self._pending_text = self._pending_text, None
+            if text is None:
+                return
+            self._last_edit = time.monotonic()
+            try:
+                await self.status_message.edit_text(text, reply_markup=self.reply_markup)
+            except Exception as e:
+                logger.warning(f"Error updating progress: {e}")
+    
+    async def edit_text(self, text, **kwargs):
+        """Replace the status message right away, dropping any queued progress"""
+        if self._flush_task and not self._flush_task.done():
+            self._flush_task.cancel()
+        self._pending_text = None
+        
+        async with self._edit_lock:
+            self._last_edit = time.monotonic()
+            return await self.status_message.edit_text(text, **kwargs)
+    
+    async def close(self):
+        """Drop any queued progress update"""
+        if self._flush_task and not self._flush_task.done():
+            self._flush_task.cancel()
+        self._pending_text = None
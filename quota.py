@@ -0,0 +1,200 @@
+import asyncio
+import logging
+import time
+from datetime import datetime, timedelta, timezone
+
+from config import (
+    QUOTA_DOWNLOADS_PER_HOUR, QUOTA_MB_PER_DAY, QUOTA_GLOBAL_DOWNLOADS_PER_HOUR, QUOTA_ROLLUP_INTERVAL
+)
+from progress import format_bytes, format_eta
+from rate_limit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+HOUR = 3600
+DAY = 24 * HOUR
+
+
+class UserQuota:
+    """In-memory quota state of one user: a token bucket per limit (None = unlimited)"""
+    def __init__(self, downloads_per_hour, bytes_per_day, downloads_used=0, bytes_used=0):
+        self.downloads_per_hour = downloads_per_hour
+        self.bytes_per_day = bytes_per_day
+        self.downloads = None
+        self.bytes = None
+        if downloads_per_hour:
+            self.downloads = TokenBucket(downloads_per_hour / HOUR, downloads_per_hour)
+            self.downloads.consume(downloads_used)
+        if bytes_per_day:
+            self.bytes = TokenBucket(bytes_per_day / DAY, bytes_per_day)
+            self.bytes.consume(bytes_used)
+        self.last_used = time.monotonic()
+
+
+class QuotaManager:
+    """Per-user and global download quotas.
+    
+    Users get downloads_per_hour and bytes_per_day (0 = unlimited), unless an
+    admin set an override for them; admins themselves are not limited. An
+    optional global downloads-per-hour limit caps everyone together.
+    
+    Checks only touch in-memory token buckets. A user's buckets are seeded from
+    the hourly usage rollups the first time they are needed, and a background
+    task folds new downloads into the rollups every rollup_interval seconds.
+    
+    Downloads are charged only once delivered (record_download), so cancelled,
+    failed and rejected jobs cost nothing; a user with several jobs in flight
+    can go briefly into debt. Charges and confirm() go through shared copies of
+    the buckets in storage, updated atomically, so the limits hold across
+    several bot processes; the in-memory buckets are set to the shared level
+    each time.
+    """
+    def __init__(self, db, downloads_per_hour=QUOTA_DOWNLOADS_PER_HOUR, bytes_per_day=QUOTA_MB_PER_DAY * 1024 * 1024,
+                 global_downloads_per_hour=QUOTA_GLOBAL_DOWNLOADS_PER_HOUR, rollup_interval=QUOTA_ROLLUP_INTERVAL):
+        self.db = db
+        self.downloads_per_hour = downloads_per_hour
+        self.bytes_per_day = bytes_per_day
+        self.global_bucket = None
+        if global_downloads_per_hour:
+            self.global_bucket = TokenBucket(global_downloads_per_hour / HOUR, global_downloads_per_hour)
+        self.rollup_interval = rollup_interval
+        # User ID -> UserQuota
+        self.users = {}
+        self.task = None
+    
+    async def start(self):
+        """Start the periodic usage rollup"""
+        self.task = asyncio.create_task(self._rollup_loop())
+    
+    async def stop(self):
+        """Stop the periodic usage rollup"""
+        if self.task:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+    
+    async def _rollup_loop(self):
+        while True:
+            try:
+                rolled = await self.db.rollup_downloads()
+                if rolled:
+                    logger.info(f"Rolled up {rolled} download(s) into hourly usage")
+            except Exception as e:
+                logger.error(f"Error rolling up download usage: {e}")
+            
+            # After a day without downloads a user's buckets are full again, same as freshly seeded
+            idle_since = time.monotonic() - DAY
+            for user_id in [uid for uid, state in self.users.items() if state.last_used < idle_since]:
+                del self.users[user_id]
+            
+            await asyncio.sleep(self.rollup_interval)
+    
+    async def _get(self, user_id):
+        """Get a user's quota state, seeding it from the database if needed"""
+        state = self.users.get(user_id)
+        if state is None:
+            downloads_per_hour, bytes_per_day = self.downloads_per_hour, self.bytes_per_day
+            override = await self.db.get_quota_override(user_id)
+            if override:
+                if override[0] is not None:
+                    downloads_per_hour = override[0]
+                if override[1] is not None:
+                    bytes_per_day = override[1]
+            
+            now = datetime.now(timezone.utc)
+            downloads_used, _ = await self.db.get_download_usage(user_id, now - timedelta(hours=1))
+            _, bytes_used = await self.db.get_download_usage(user_id, now - timedelta(days=1))
+            # Another update of this user may have seeded it meanwhile
+            state = self.users.setdefault(
+                user_id, UserQuota(downloads_per_hour, bytes_per_day, downloads_used, bytes_used)
+            )
+        state.last_used = time.monotonic()
+        return state
+    
+    def _refusal(self, state):
+        if state.downloads and state.downloads.available() < 1:
+            return (
+                f"⏳ You have reached your limit of {state.downloads_per_hour} downloads per hour.\n"
+                f"Try again in {format_eta(state.downloads.wait_time())}."
+            )
+        if state.bytes and state.bytes.available() <= 0:
+            return (
+                f"📦 You have reached your daily limit of {format_bytes(state.bytes_per_day)}.\n"
+                f"Try again in {format_eta(state.bytes.wait_time())}."
+            )
+        if self.global_bucket and self.global_bucket.available() < 1:
+            return (
+                "🚦 The bot is handling too many downloads right now.\n"
+                f"Try again in {format_eta(self.global_bucket.wait_time())}."
+            )
+        return None
+    
+    async def check(self, user_id):
+        """Why the user can't start a download right now, or None if they can"""
+        if await self.db.is_admin(user_id):
+            return None
+        return self._refusal(await self._get(user_id))
+    
+    async def confirm(self, user_id):
+        """Like check(), but against the shared buckets (used right before a job is queued)"""
+        if await self.db.is_admin(user_id):
+            return None
+        state = await self._get(user_id)
+        # Taking nothing refreshes the levels from the shared buckets
+        if state.downloads:
+            await self._take(f"downloads:{user_id}", state.downloads, 0)
+        if self.global_bucket:
+            await self._take('downloads', self.global_bucket, 0)
+        return self._refusal(state)
+    
+    async def _take(self, key, bucket, amount, allow_debt=False):
+        """Take tokens from the shared copy of a bucket and mirror its level. Returns whether they were taken."""
+        taken, tokens = await self.db.take_quota_tokens(
+            key, bucket.rate, bucket.capacity, amount, bucket.available(), allow_debt
+        )
+        bucket.sync(tokens)
+        return taken
+    
+    async def record_download(self, user_id, num_bytes):
+        """Charge a delivered download and its bytes to the user's and the global quota"""
+        if await self.db.is_admin(user_id):
+            return
+        state = await self._get(user_id)
+        if state.downloads:
+            await self._take(f"downloads:{user_id}", state.downloads, 1, allow_debt=True)
+        if self.global_bucket:
+            await self._take('downloads', self.global_bucket, 1, allow_debt=True)
+        if state.bytes and num_bytes:
+            await self._take(f"bytes:{user_id}", state.bytes, num_bytes, allow_debt=True)
+    
+    async def remaining_bytes(self, user_id):
+        """Bytes left in the user's daily quota (None = unlimited)"""
+        if await self.db.is_admin(user_id):
+            return None
+        state = await self._get(user_id)
+        if not state.bytes:
+            return None
+        # Taking nothing refreshes the level from the shared bucket
+        await self._take(f"bytes:{user_id}", state.bytes, 0)
+        return max(0, int(state.bytes.available()))
+    
+    async def set_limits(self, user_id, downloads_per_hour, bytes_per_day):
+        """Override a user's limits (None = default, 0 = unlimited)"""
+        await self.db.set_quota_override(user_id, downloads_per_hour, bytes_per_day)
+        # Reseeded with the new limits on next use
+        self.users.pop(user_id, None)
+    
+    async def describe(self, user_id):
+        """Human readable limits and usage of a user"""
+        state = await self._get(user_id)
+        now = datetime.now(timezone.utc)
+        downloads_used, _ = await self.db.get_download_usage(user_id, now - timedelta(hours=1))
+        _, bytes_used = await self.db.get_download_usage(user_id, now - timedelta(days=1))
+        
+        downloads_limit = state.downloads_per_hour or 'unlimited'
+        bytes_limit = format_bytes(state.bytes_per_day) if state.bytes_per_day else 'unlimited'
+        return (
+            f"📊 <b>Quota for {user_id}</b>\n\n"
+            f"⬇️ Downloads: {downloads_used} this hour (limit {downloads_limit}/hour)\n"
+            f"📦 Data: {format_bytes(bytes_used)} today (limit {bytes_limit}/day)"
+        )
@@ -0,0 +1,146 @@
+import asyncio
+import logging
+import time
+from datetime import timedelta
+
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+
+from config import SEND_RATE_LIMIT, SEND_CONCURRENCY, SEND_PER_CHAT_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """Token bucket refilled at `rate` tokens per second, holding up to `capacity`"""
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+    
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    def try_acquire(self, tokens=1):
+        """Take tokens if available right now"""
+        if time.monotonic() < self.paused_until:
+            return False
+        self._refill()
+        if self.tokens >= tokens:
+            self.tokens -= tokens
+            return True
+        return False
+    
+    def wait_time(self, tokens=1):
+        """Seconds until `tokens` would be available"""
+        now = time.monotonic()
+        if now < self.paused_until:
+            return self.paused_until - now
+        self._refill()
+        if self.tokens >= tokens:
+            return 0.0
+        return (tokens - self.tokens) / self.rate
+    
+    async def acquire(self, tokens=1):
+        """Wait until tokens are available and take them"""
+        while not self.try_acquire(tokens):
+            await asyncio.sleep(self.wait_time(tokens))
+    
+    def consume(self, tokens):
+        """Take tokens now even if that leaves the bucket in debt"""
+        self._refill()
+        self.tokens -= tokens
+    
+    def available(self):
+        """Tokens available right now (negative while in debt)"""
+        self._refill()
+        return self.tokens
+    
+    def sync(self, tokens):
+        """Set the bucket to a level measured elsewhere (e.g. a shared copy of it)"""
+        self.tokens = tokens
+        self.updated = time.monotonic()
+    
+    def pause(self, seconds):
+        """Hand out no tokens for the next `seconds` (e.g. after a 429)"""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+
+def retry_after_seconds(error):
+    """RetryAfter.retry_after as seconds (int in older PTB, timedelta in newer)"""
+    retry_after = error.retry_after
+    if isinstance(retry_after, timedelta):
+        return retry_after.total_seconds()
+    return float(retry_after)
+
+
+class RateLimitedSender:
+    """Sends Bot API requests concurrently within Telegram's rate limits.
+    
+    A global token bucket keeps us under the ~30 messages/second bot limit,
+    each chat gets at most one message per `per_chat_interval` seconds, and a
+    429 RetryAfter pauses the global bucket for the requested time before the
+    request is retried.
+    """
+    def __init__(self, rate=SEND_RATE_LIMIT, concurrency=SEND_CONCURRENCY,
+                 per_chat_interval=SEND_PER_CHAT_INTERVAL, max_retries=3):
+        self.bucket = TokenBucket(rate)
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.per_chat_interval = per_chat_interval
+        self.max_retries = max_retries
+        # chat_id -> earliest monotonic time the next message may go out
+        self._chat_next = {}
+    
+    async def _wait_for_chat(self, chat_id):
+        now = time.monotonic()
+        next_at = self._chat_next.get(chat_id, 0.0)
+        self._chat_next[chat_id] = max(now, next_at) + self.per_chat_interval
+        if next_at > now:
+            await asyncio.sleep(next_at - now)
+        
+        if len(self._chat_next) > 10000:
+            self._chat_next = {cid: t for cid, t in self._chat_next.items() if t > now}
+    
+    async def send(self, chat_id, request):
+        """Run request() (a coroutine factory sending to chat_id) within the limits.
+        
+        Returns 'sent', 'blocked' (the user blocked the bot, was deactivated or
+        the chat is gone) or 'failed'.
+        """
+        async with self.semaphore:
+            for attempt in range(self.max_retries + 1):
+                await self._wait_for_chat(chat_id)
+                await self.bucket.acquire()
+                try:
+                    await request()
+                    return 'sent'
+                except RetryAfter as e:
+                    delay = retry_after_seconds(e)
+                    logger.warning(f"Rate limited sending to {chat_id}, retrying in {delay}s")
+                    self.bucket.pause(delay)
+                except Forbidden as e:
+                    logger.info(f"Chat {chat_id} is unreachable: {e}")
+                    return 'blocked'
+                except BadRequest as e:
+                    if 'chat not found' in str(e).lower():
+                        return 'blocked'
+                    logger.error(f"Failed to send to {chat_id}: {e}")
+                    return 'failed'
+                except NetworkError as e:
+                    logger.warning(f"Network error sending to {chat_id} (attempt {attempt + 1}): {e}")
+                    await asyncio.sleep(2 ** attempt)
+                except Exception as e:
+                    logger.error(f"Failed to send to {chat_id}: {e}")
+                    return 'failed'
+            return 'failed'
+    
+    async def send_many(self, requests):
+        """Send to many chats concurrently. requests is a list of (chat_id, request).
+        
+        Returns the outcomes in the same order.
+        """
+        return await asyncio.gather(*(self.send(chat_id, request) for chat_id, request in requests))
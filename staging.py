@@ -0,0 +1,195 @@
+import asyncio
+import logging
+import os
+import shutil
+import time
+
+from config import (
+    DOWNLOAD_FOLDER, STAGING_MIN_FREE_MB, STAGING_DEFAULT_RESERVE_MB, STAGING_WAIT_TIMEOUT,
+    STAGING_ORPHAN_AGE, STAGING_JANITOR_INTERVAL
+)
+
+logger = logging.getLogger(__name__)
+
+
+def dir_size(path):
+    """Total size in bytes of the files in a directory tree"""
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+def remove_dirs(paths):
+    """Remove directory trees, ignoring errors"""
+    for path in paths:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+class StagingArea:
+    """Per-job download directories with disk space reservations.
+    
+    A job reserves its estimated size before downloading and gets its own
+    directory under <folder>/jobs. Reservations only count for the part not
+    written yet, so free space is never counted twice. When there isn't room
+    for a reservation (keeping min_free_mb free) the job waits for space up
+    to wait_timeout seconds and is then refused.
+    
+    A janitor task removes the directories of finished jobs and anything
+    left behind by crashes (job directories, stray files and yt-dlp .part
+    files) once it is older than orphan_age seconds and no longer in use,
+    and runs the media cache's disk-tier eviction.
+    """
+    def __init__(self, folder=DOWNLOAD_FOLDER, in_use=None, media_cache=None, min_free_mb=STAGING_MIN_FREE_MB,
+                 default_reserve_mb=STAGING_DEFAULT_RESERVE_MB, wait_timeout=STAGING_WAIT_TIMEOUT,
+                 orphan_age=STAGING_ORPHAN_AGE, janitor_interval=STAGING_JANITOR_INTERVAL):
+        self.folder = folder
+        self.jobs_folder = os.path.join(folder, 'jobs')
+        # Returns the set of file paths still held by someone (e.g. a shared download)
+        self.in_use = in_use or set
+        self.media_cache = media_cache
+        self.min_free_bytes = min_free_mb * 1024 * 1024
+        self.default_reserve_bytes = default_reserve_mb * 1024 * 1024
+        self.wait_timeout = wait_timeout
+        self.orphan_age = orphan_age
+        self.janitor_interval = janitor_interval
+        # Job ID -> (job directory, reserved bytes)
+        self.reservations = {}
+        # Directories of finished jobs waiting for their files to be released
+        self.released = set()
+        self.task = None
+        
+        os.makedirs(self.jobs_folder, exist_ok=True)
+    
+    async def start(self):
+        """Start the janitor"""
+        self.task = asyncio.create_task(self._janitor_loop())
+    
+    async def stop(self):
+        """Stop the janitor"""
+        if self.task:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+    
+    def job_dir(self, job_id):
+        return os.path.join(self.jobs_folder, str(job_id))
+    
+    def available_bytes(self, reservations=None):
+        """Free disk space not promised to running jobs, above the min_free_mb floor.
+        
+        Blocks on the filesystem: call it in a thread with a snapshot of
+        self.reservations.values() (see reserve).
+        """
+        if reservations is None:
+            reservations = list(self.reservations.values())
+        free = shutil.disk_usage(self.folder).free
+        outstanding = sum(max(0, reserved - dir_size(path)) for path, reserved in reservations)
+        return free - outstanding - self.min_free_bytes
+    
+    def _room_for(self, path, reservations):
+        """Bytes a job writing into path can still use (its own files count as room)"""
+        return self.available_bytes(reservations) + dir_size(path)
+    
+    async def reserve(self, job_id, size=None, on_wait=None, cancelled=None):
+        """Reserve space for a job and create its directory.
+        
+        size is the estimated download size (default_reserve_mb if unknown).
+        on_wait is awaited once if the job has to wait for space, and the wait
+        ends early once the cancelled event (if given) is set. Returns the job
+        directory, or None if no space became available in time. A job
+        directory left over from before a restart is reused, so yt-dlp can
+        resume its .part files.
+        """
+        size = size or self.default_reserve_bytes
+        path = self.job_dir(job_id)
+        usage = await asyncio.to_thread(shutil.disk_usage, self.folder)
+        if size > usage.total - self.min_free_bytes:
+            return None
+        
+        deadline = time.monotonic() + self.wait_timeout
+        waited = False
+        # Walking the job directories can take a while, so it runs off the event loop
+        while await asyncio.to_thread(self._room_for, path, list(self.reservations.values())) < size:
+            if time.monotonic() >= deadline or (cancelled and cancelled.is_set()):
+                return None
+            if not waited and on_wait:
+                waited = True
+                await on_wait()
+            await asyncio.sleep(min(5, max(0, deadline - time.monotonic())))
+        
+        os.makedirs(path, exist_ok=True)
+        self.released.discard(path)
+        self.reservations[job_id] = (path, size)
+        return path
+    
+    async def release(self, job_id, keep_files=False):
+        """Drop a job's reservation and remove its directory unless a file in it is still in use.
+        
+        With keep_files the directory is left for the job to resume into (or
+        for the janitor once it is orphaned).
+        """
+        reservation = self.reservations.pop(job_id, None)
+        if reservation and not keep_files:
+            self.released.add(reservation[0])
+            await self._remove_released()
+    
+    def _busy(self, path, in_use):
+        return any(used.startswith(path + os.sep) for used in in_use)
+    
+    async def _remove_released(self):
+        in_use = self.in_use()
+        removable = [path for path in self.released if not self._busy(path, in_use)]
+        self.released.difference_update(removable)
+        if removable:
+            # Multi-GB trees take a while to delete
+            await asyncio.to_thread(remove_dirs, removable)
+    
+    def sweep(self, active, in_use):
+        """Remove orphans: anything older than orphan_age that isn't a running job's
+        directory or in use. Returns the bytes freed.
+        """
+        cutoff = time.time() - self.orphan_age
+        freed = 0
+        
+        candidates = [os.path.join(self.jobs_folder, name) for name in os.listdir(self.jobs_folder)]
+        # Files written straight into the download folder (e.g. before job directories)
+        candidates += [
+            os.path.join(self.folder, name) for name in os.listdir(self.folder)
+            if os.path.isfile(os.path.join(self.folder, name))
+        ]
+        for path in candidates:
+            if path in active or path in in_use or self._busy(path, in_use):
+                continue
+            try:
+                if os.path.getmtime(path) > cutoff:
+                    continue
+                if os.path.isdir(path):
+                    size = dir_size(path)
+                    shutil.rmtree(path)
+                else:
+                    size = os.path.getsize(path)
+                    os.remove(path)
+                freed += size
+            except OSError as e:
+                logger.warning(f"Error removing orphaned download {path}: {e}")
+        return freed
+    
+    async def _janitor_loop(self):
+        while True:
+            try:
+                await self._remove_released()
+                active = {path for path, _ in self.reservations.values()}
+                freed = await asyncio.to_thread(self.sweep, active, self.in_use())
+                if freed:
+                    logger.info(f"Janitor removed {freed / (1024 * 1024):.1f} MB of orphaned downloads")
+                if self.media_cache:
+                    await asyncio.to_thread(self.media_cache.evict)
+            except Exception as e:
+                logger.error(f"Error cleaning up downloads: {e}")
+            
+            await asyncio.sleep(self.janitor_interval)
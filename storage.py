@@ -0,0 +1,1053 @@
+import asyncio
+import functools
+import inspect
+import time
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import asyncpg
+except ImportError:  # Only needed for the PostgreSQL backend
+    asyncpg = None
+
+from config import (
+    ADMIN_USER_ID, DATABASE_PATH, DATABASE_URL, STORAGE_BACKEND,
+    DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE, DB_THREADS
+)
+from database import Database
+from metrics import DB_QUERY_SECONDS, DB_ERRORS
+
+
+def _timed(name, method):
+    """Wrap a storage method to record its latency and errors"""
+    @functools.wraps(method)
+    async def wrapper(*args, **kwargs):
+        started = time.monotonic()
+        try:
+            return await method(*args, **kwargs)
+        except Exception:
+            DB_ERRORS.inc(method=name)
+            raise
+        finally:
+            DB_QUERY_SECONDS.observe(time.monotonic() - started, method=name)
+    return wrapper
+
+
+class Storage(ABC):
+    """Async interface to the bot's persistent state.
+    
+    Rows are returned as sequences in table column order, like sqlite3 rows,
+    so callers can index or unpack them whichever backend is in use. Every
+    public method of a backend is timed for the metrics.
+    """
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        for name, method in list(vars(cls).items()):
+            if not name.startswith('_') and name not in ('connect', 'close') and inspect.iscoroutinefunction(method):
+                setattr(cls, name, _timed(name, method))
+    
+    async def connect(self):
+        """Open connections and create the schema"""
+    
+    async def close(self):
+        """Close all connections"""
+    
+    # User Methods
+    @abstractmethod
+    async def add_user(self, user_id, username, first_name, status='pending'):
+        """Add a new user. Returns False if the user already exists."""
+    
+    @abstractmethod
+    async def get_user(self, user_id):
+        """Get user information"""
+    
+    @abstractmethod
+    async def get_user_status(self, user_id):
+        """Get user status (None if unknown)"""
+    
+    @abstractmethod
+    async def update_user_status(self, user_id, status):
+        """Update user status"""
+    
+    @abstractmethod
+    async def remove_user(self, user_id):
+        """Remove a user"""
+    
+    @abstractmethod
+    async def get_all_users(self):
+        """Get all users, newest first"""
+    
+    @abstractmethod
+    async def get_users_page(self, status=None, after=None, limit=5):
+        """Get one page of users after the (created_at, user_id) keyset cursor"""
+    
+    @abstractmethod
+    async def count_users(self, status=None):
+        """Count users (optionally with a given status)"""
+    
+    async def is_user_authorized(self, user_id):
+        """Check if user is authorized (admin or approved)"""
+        return await self.get_user_status(user_id) in ('admin', 'approved')
+    
+    async def is_admin(self, user_id):
+        """Check if user is admin"""
+        return await self.get_user_status(user_id) == 'admin'
+    
+    @abstractmethod
+    async def bulk_approve_users(self, user_ids, request_ids=()):
+        """Approve many users and their requests in one transaction"""
+    
+    @abstractmethod
+    async def bulk_reject_users(self, user_ids, request_ids=(), remove_user_ids=()):
+        """Reject users and their requests, and remove users without one, in one transaction"""
+    
+    # Access Request Methods
+    @abstractmethod
+    async def create_access_request(self, user_id, username, first_name, message):
+        """Create a new access request. Returns True on success."""
+    
+    @abstractmethod
+    async def get_pending_requests(self):
+        """Get all pending access requests"""
+    
+    @abstractmethod
+    async def get_pending_users(self):
+        """Get all users with pending status"""
+    
+    @abstractmethod
+    async def update_request_status(self, request_id, status):
+        """Update access request status"""
+    
+    @abstractmethod
+    async def get_request_by_id(self, request_id):
+        """Get access request by ID"""
+    
+    # Download History Methods
+    @abstractmethod
+    async def add_download(self, user_id, url, title, file_type, file_size):
+        """Add download to history"""
+    
+    @abstractmethod
+    async def get_user_downloads(self, user_id):
+        """Get download history for a user"""
+    
+    # Quota Methods
+    @abstractmethod
+    async def get_quota_override(self, user_id):
+        """Get a user's (downloads_per_hour, bytes_per_day) override, or None"""
+    
+    @abstractmethod
+    async def set_quota_override(self, user_id, downloads_per_hour, bytes_per_day):
+        """Override a user's limits (None = default); removes the override if both are None"""
+    
+    @abstractmethod
+    async def get_download_usage(self, user_id, since):
+        """Get (downloads, bytes) of a user since a UTC datetime"""
+    
+    @abstractmethod
+    async def take_quota_tokens(self, key, rate, capacity, amount, initial, allow_debt=False):
+        """Refill the shared token bucket `key` and take `amount` tokens from it, atomically.
+        
+        A missing bucket starts with `initial` tokens. Unless allow_debt, nothing
+        is taken when fewer than `amount` are available. Returns (taken, tokens left).
+        """
+    
+    @abstractmethod
+    async def rollup_downloads(self):
+        """Fold new downloads into hourly per-user usage. Returns the number rolled up."""
+    
+    # Download Job Queue Methods
+    @abstractmethod
+    async def add_job(self, user_id, chat_id, message_id, url, media_type, owner=None, lease_seconds=0):
+        """Add a download job to the queue and return its ID (leased to owner if given)"""
+    
+    @abstractmethod
+    async def update_job_status(self, job_id, status, error=None):
+        """Update download job status"""
+    
+    @abstractmethod
+    async def claim_jobs(self, owner, lease_seconds, include_own=False):
+        """Atomically lease unfinished jobs nobody holds a live lease on (and owner's own
+        if include_own) to owner, set them back to queued and return them in queue order
+        """
+    
+    @abstractmethod
+    async def renew_job_leases(self, owner, lease_seconds):
+        """Extend the leases of owner's unfinished jobs"""
+    
+    @abstractmethod
+    async def release_jobs(self, owner):
+        """Give up owner's unfinished jobs so any process can claim them right away"""
+    
+    # Job Trace Methods
+    @abstractmethod
+    async def add_job_traces(self, traces):
+        """Save finished job traces, each a JobTrace.row() tuple"""
+    
+    @abstractmethod
+    async def get_job_traces(self, since, limit=10000):
+        """Get (media_type, outcome, extract, queue, download, postprocess, upload, total seconds)
+        of the latest jobs traced since a UTC datetime
+        """
+    
+    # Media Cache Methods
+    @abstractmethod
+    async def get_cached_media(self, cache_key):
+        """Get cached Telegram file for a media cache key"""
+    
+    @abstractmethod
+    async def add_cached_media(self, cache_key, file_id, file_type, title, file_size):
+        """Store the Telegram file_id of sent media"""
+    
+    @abstractmethod
+    async def touch_cached_media(self, cache_key):
+        """Record a cache hit"""
+    
+    @abstractmethod
+    async def remove_cached_media(self, cache_key):
+        """Remove a cache entry"""
+    
+    # Broadcast Methods
+    @abstractmethod
+    async def create_broadcast(self, admin_id, chat_id, message_id, text, user_ids, owner=None, lease_seconds=0):
+        """Create a broadcast with its recipient list and return its ID (leased to owner if given)"""
+    
+    @abstractmethod
+    async def claim_broadcasts(self, owner, lease_seconds, include_own=False):
+        """Atomically lease running broadcasts nobody holds a live lease on (and owner's own
+        if include_own) to owner and return them
+        """
+    
+    @abstractmethod
+    async def renew_broadcast_leases(self, owner, lease_seconds):
+        """Extend the leases of owner's running broadcasts"""
+    
+    @abstractmethod
+    async def release_broadcasts(self, owner):
+        """Give up owner's running broadcasts so any process can claim them right away"""
+    
+    @abstractmethod
+    async def get_broadcast_pending(self, broadcast_id):
+        """Get user IDs a broadcast still has to reach"""
+    
+    @abstractmethod
+    async def get_broadcast_counts(self, broadcast_id):
+        """Get recipient counts by status for a broadcast"""
+    
+    @abstractmethod
+    async def save_broadcast_results(self, broadcast_id, results):
+        """Save delivery results, a list of (user_id, status), in one transaction"""
+    
+    @abstractmethod
+    async def finish_broadcast(self, broadcast_id):
+        """Mark a broadcast as done"""
+    
+    @abstractmethod
+    async def get_blocked_user_ids(self):
+        """Get IDs of users who blocked the bot"""
+    
+    @abstractmethod
+    async def is_user_blocked(self, user_id):
+        """Whether a user blocked the bot"""
+    
+    @abstractmethod
+    async def unblock_user(self, user_id):
+        """Forget that a user blocked the bot"""
+
+
+class SQLiteStorage(Storage):
+    """Storage on a local SQLite file, backed by Database.
+    
+    Nothing touches SQLite on the event loop. Reads run on a small thread pool
+    (WAL lets them proceed while a write is in progress) and cached status
+    lookups are answered without a thread hop. Writes go to Database's writer
+    thread, which commits the writes arriving within a few milliseconds of
+    each other in one transaction.
+    """
+    def __init__(self, path=DATABASE_PATH, threads=DB_THREADS):
+        self.db = Database(path)
+        self.db.start_writer()
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="sqlite")
+    
+    async def _run(self, method, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, method, *args)
+    
+    async def _write(self, method, *args):
+        return await asyncio.wrap_future(self.db.submit_write(method, *args))
+    
+    async def close(self):
+        self.executor.shutdown(wait=True)
+        self.db.close()
+    
+    async def add_user(self, user_id, username, first_name, status='pending'):
+        return await self._write(self.db.add_user, user_id, username, first_name, status)
+    
+    async def get_user(self, user_id):
+        return await self._run(self.db.get_user, user_id)
+    
+    async def get_user_status(self, user_id):
+        try:
+            return self.db.get_cached_user_status(user_id)
+        except KeyError:
+            return await self._run(self.db.get_user_status, user_id)
+    
+    async def update_user_status(self, user_id, status):
+        return await self._write(self.db.update_user_status, user_id, status)
+    
+    async def remove_user(self, user_id):
+        return await self._write(self.db.remove_user, user_id)
+    
+    async def get_all_users(self):
+        return await self._run(self.db.get_all_users)
+    
+    async def get_users_page(self, status=None, after=None, limit=5):
+        return await self._run(self.db.get_users_page, status, after, limit)
+    
+    async def count_users(self, status=None):
+        return await self._run(self.db.count_users, status)
+    
+    async def bulk_approve_users(self, user_ids, request_ids=()):
+        return await self._write(self.db.bulk_approve_users, list(user_ids), list(request_ids))
+    
+    async def bulk_reject_users(self, user_ids, request_ids=(), remove_user_ids=()):
+        return await self._write(self.db.bulk_reject_users, list(user_ids), list(request_ids), list(remove_user_ids))
+    
+    async def create_access_request(self, user_id, username, first_name, message):
+        return await self._write(self.db.create_access_request, user_id, username, first_name, message)
+    
+    async def get_pending_requests(self):
+        return await self._run(self.db.get_pending_requests)
+    
+    async def get_pending_users(self):
+        return await self._run(self.db.get_pending_users)
+    
+    async def update_request_status(self, request_id, status):
+        return await self._write(self.db.update_request_status, request_id, status)
+    
+    async def get_request_by_id(self, request_id):
+        return await self._run(self.db.get_request_by_id, request_id)
+    
+    async def add_download(self, user_id, url, title, file_type, file_size):
+        return await self._write(self.db.add_download, user_id, url, title, file_type, file_size)
+    
+    async def get_user_downloads(self, user_id):
+        return await self._run(self.db.get_user_downloads, user_id)
+    
+    async def get_quota_override(self, user_id):
+        return await self._run(self.db.get_quota_override, user_id)
+    
+    async def set_quota_override(self, user_id, downloads_per_hour, bytes_per_day):
+        return await self._write(self.db.set_quota_override, user_id, downloads_per_hour, bytes_per_day)
+    
+    async def get_download_usage(self, user_id, since):
+        return await self._run(self.db.get_download_usage, user_id, since)
+    
+    async def take_quota_tokens(self, key, rate, capacity, amount, initial, allow_debt=False):
+        return await self._write(self.db.take_quota_tokens, key, rate, capacity, amount, initial, allow_debt)
+    
+    async def rollup_downloads(self):
+        return await self._write(self.db.rollup_downloads)
+    
+    async def add_job(self, user_id, chat_id, message_id, url, media_type, owner=None, lease_seconds=0):
+        return await self._write(self.db.add_job, user_id, chat_id, message_id, url, media_type, owner, lease_seconds)
+    
+    async def update_job_status(self, job_id, status, error=None):
+        return await self._write(self.db.update_job_status, job_id, status, error)
+    
+    async def claim_jobs(self, owner, lease_seconds, include_own=False):
+        return await self._write(self.db.claim_jobs, owner, lease_seconds, include_own)
+    
+    async def renew_job_leases(self, owner, lease_seconds):
+        return await self._write(self.db.renew_job_leases, owner, lease_seconds)
+    
+    async def release_jobs(self, owner):
+        return await self._write(self.db.release_jobs, owner)
+    
+    async def add_job_traces(self, traces):
+        return await self._write(self.db.add_job_traces, traces)
+    
+    async def get_job_traces(self, since, limit=10000):
+        return await self._run(self.db.get_job_traces, since, limit)
+    
+    async def get_cached_media(self, cache_key):
+        return await self._run(self.db.get_cached_media, cache_key)
+    
+    async def add_cached_media(self, cache_key, file_id, file_type, title, file_size):
+        return await self._write(self.db.add_cached_media, cache_key, file_id, file_type, title, file_size)
+    
+    async def touch_cached_media(self, cache_key):
+        return await self._write(self.db.touch_cached_media, cache_key)
+    
+    async def remove_cached_media(self, cache_key):
+        return await self._write(self.db.remove_cached_media, cache_key)
+    
+    async def create_broadcast(self, admin_id, chat_id, message_id, text, user_ids, owner=None, lease_seconds=0):
+        return await self._write(
+            self.db.create_broadcast, admin_id, chat_id, message_id, text, list(user_ids), owner, lease_seconds
+        )
+    
+    async def claim_broadcasts(self, owner, lease_seconds, include_own=False):
+        return await self._write(self.db.claim_broadcasts, owner, lease_seconds, include_own)
+    
+    async def renew_broadcast_leases(self, owner, lease_seconds):
+        return await self._write(self.db.renew_broadcast_leases, owner, lease_seconds)
+    
+    async def release_broadcasts(self, owner):
+        return await self._write(self.db.release_broadcasts, owner)
+    
+    async def get_broadcast_pending(self, broadcast_id):
+        return await self._run(self.db.get_broadcast_pending, broadcast_id)
+    
+    async def get_broadcast_counts(self, broadcast_id):
+        return await self._run(self.db.get_broadcast_counts, broadcast_id)
+    
+    async def save_broadcast_results(self, broadcast_id, results):
+        return await self._write(self.db.save_broadcast_results, broadcast_id, list(results))
+    
+    async def finish_broadcast(self, broadcast_id):
+        return await self._write(self.db.finish_broadcast, broadcast_id)
+    
+    async def get_blocked_user_ids(self):
+        return await self._run(self.db.get_blocked_user_ids)
+    
+    async def is_user_blocked(self, user_id):
+        try:
+            return self.db.is_user_blocked_cached(user_id)
+        except KeyError:
+            return await self._run(self.db.is_user_blocked, user_id)
+    
+    async def unblock_user(self, user_id):
+        return await self._write(self.db.unblock_user, user_id)
+
+
+POSTGRES_SCHEMA = [
+    # Foreign keys are left out on purpose: SQLite never enforced them here,
+    # and removing a user must not fail because of their history rows
+    '''
+    CREATE TABLE IF NOT EXISTS users (
+        user_id BIGINT PRIMARY KEY,
+        username TEXT,
+        first_name TEXT,
+        status TEXT DEFAULT 'pending',
+        created_at TIMESTAMPTZ DEFAULT now(),
+        updated_at TIMESTAMPTZ DEFAULT now()
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS downloads (
+        id BIGSERIAL PRIMARY KEY,
+        user_id BIGINT,
+        url TEXT,
+        title TEXT,
+        file_type TEXT,
+        file_size BIGINT,
+        download_date TIMESTAMPTZ DEFAULT now()
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS access_requests (
+        id BIGSERIAL PRIMARY KEY,
+        user_id BIGINT,
+        username TEXT,
+        first_name TEXT,
+        message TEXT,
+        status TEXT DEFAULT 'pending',
+        created_at TIMESTAMPTZ DEFAULT now(),
+        updated_at TIMESTAMPTZ DEFAULT now()
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS download_jobs (
+        id BIGSERIAL PRIMARY KEY,
+        user_id BIGINT,
+        chat_id BIGINT,
+        message_id BIGINT,
+        url TEXT,
+        media_type TEXT,
+        status TEXT DEFAULT 'queued',
+        error TEXT,
+        owner TEXT,
+        lease_expires_at TIMESTAMPTZ,
+        created_at TIMESTAMPTZ DEFAULT now(),
+        updated_at TIMESTAMPTZ DEFAULT now()
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS media_cache (
+        cache_key TEXT PRIMARY KEY,
+        file_id TEXT,
+        file_type TEXT,
+        title TEXT,
+        file_size BIGINT,
+        hits INTEGER DEFAULT 0,
+        created_at TIMESTAMPTZ DEFAULT now(),
+        last_used_at TIMESTAMPTZ DEFAULT now()
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS broadcasts (
+        id BIGSERIAL PRIMARY KEY,
+        admin_id BIGINT,
+        chat_id BIGINT,
+        message_id BIGINT,
+        text TEXT,
+        status TEXT DEFAULT 'running',
+        owner TEXT,
+        lease_expires_at TIMESTAMPTZ,
+        created_at TIMESTAMPTZ DEFAULT now(),
+        updated_at TIMESTAMPTZ DEFAULT now()
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS broadcast_recipients (
+        broadcast_id BIGINT,
+        user_id BIGINT,
+        status TEXT DEFAULT 'pending',
+        PRIMARY KEY (broadcast_id, user_id)
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS blocked_users (
+        user_id BIGINT PRIMARY KEY,
+        blocked_at TIMESTAMPTZ DEFAULT now()
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS user_quotas (
+        user_id BIGINT PRIMARY KEY,
+        downloads_per_hour INTEGER,
+        bytes_per_day BIGINT,
+        updated_at TIMESTAMPTZ DEFAULT now()
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS download_usage (
+        user_id BIGINT,
+        hour TIMESTAMPTZ,
+        downloads INTEGER DEFAULT 0,
+        bytes BIGINT DEFAULT 0,
+        PRIMARY KEY (user_id, hour)
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS quota_buckets (
+        key TEXT PRIMARY KEY,
+        tokens DOUBLE PRECISION,
+        updated_at TIMESTAMPTZ DEFAULT now()
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS rollup_state (
+        name TEXT PRIMARY KEY,
+        last_id BIGINT
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS job_traces (
+        job_id BIGINT PRIMARY KEY,
+        user_id BIGINT,
+        media_type TEXT,
+        extractor TEXT,
+        format_id TEXT,
+        bytes BIGINT,
+        outcome TEXT,
+        error TEXT,
+        extract_seconds DOUBLE PRECISION,
+        queue_seconds DOUBLE PRECISION,
+        download_seconds DOUBLE PRECISION,
+        postprocess_seconds DOUBLE PRECISION,
+        upload_seconds DOUBLE PRECISION,
+        total_seconds DOUBLE PRECISION,
+        created_at TIMESTAMPTZ DEFAULT now()
+    )
+    ''',
+    # Ownership leases, added after the tables above first shipped
+    'ALTER TABLE download_jobs ADD COLUMN IF NOT EXISTS owner TEXT',
+    'ALTER TABLE download_jobs ADD COLUMN IF NOT EXISTS lease_expires_at TIMESTAMPTZ',
+    'ALTER TABLE broadcasts ADD COLUMN IF NOT EXISTS owner TEXT',
+    'ALTER TABLE broadcasts ADD COLUMN IF NOT EXISTS lease_expires_at TIMESTAMPTZ',
+    'CREATE INDEX IF NOT EXISTS idx_users_status_created ON users (status, created_at)',
+    'CREATE INDEX IF NOT EXISTS idx_users_created ON users (created_at)',
+    'CREATE INDEX IF NOT EXISTS idx_requests_status_created ON access_requests (status, created_at)',
+    'CREATE INDEX IF NOT EXISTS idx_downloads_user_date ON downloads (user_id, download_date)',
+    'CREATE INDEX IF NOT EXISTS idx_job_traces_created ON job_traces (created_at)',
+    "CREATE INDEX IF NOT EXISTS idx_jobs_unfinished ON download_jobs (id) WHERE status IN ('queued', 'running')",
+]
+
+
+class PostgresStorage(Storage):
+    """Storage on a shared PostgreSQL database through an asyncpg pool.
+    
+    Several bot processes can run against the same database. There is no
+    in-process status cache here, since another process may change a user
+    at any time; status lookups are primary key reads on a pooled connection.
+    """
+    def __init__(self, dsn=DATABASE_URL, min_size=DB_POOL_MIN_SIZE, max_size=DB_POOL_MAX_SIZE):
+        self.dsn = dsn
+        self.min_size = min_size
+        self.max_size = max_size
+        self.pool = None
+    
+    async def connect(self):
+        if asyncpg is None:
+            raise RuntimeError("The PostgreSQL backend needs asyncpg (pip install asyncpg)")
+        if not self.dsn:
+            raise RuntimeError("DATABASE_URL must be set for the PostgreSQL backend")
+        
+        self.pool = await asyncpg.create_pool(self.dsn, min_size=self.min_size, max_size=self.max_size)
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                # Serialize schema creation between processes starting together
+                await conn.execute('SELECT pg_advisory_xact_lock(hashtext($1))', 'bot_schema')
+                for statement in POSTGRES_SCHEMA:
+                    await conn.execute(statement)
+        await self.ensure_admin_exists()
+    
+    async def close(self):
+        if self.pool is not None:
+            await self.pool.close()
+            self.pool = None
+    
+    async def ensure_admin_exists(self):
+        """Ensure admin user exists in database"""
+        if ADMIN_USER_ID:
+            await self.pool.execute('''
+                INSERT INTO users (user_id, username, first_name, status)
+                VALUES ($1, 'Admin', 'Admin', 'admin')
+                ON CONFLICT (user_id) DO UPDATE SET status = 'admin', updated_at = now()
+            ''', ADMIN_USER_ID)
+    
+    @staticmethod
+    def _affected(result):
+        """Row count from a command status such as 'UPDATE 1'"""
+        return int(result.split()[-1])
+    
+    async def add_user(self, user_id, username, first_name, status='pending'):
+        result = await self.pool.execute('''
+            INSERT INTO users (user_id, username, first_name, status)
+            VALUES ($1, $2, $3, $4)
+            ON CONFLICT (user_id) DO NOTHING
+        ''', user_id, username, first_name, status)
+        return self._affected(result) > 0
+    
+    async def get_user(self, user_id):
+        return await self.pool.fetchrow('SELECT * FROM users WHERE user_id = $1', user_id)
+    
+    async def get_user_status(self, user_id):
+        return await self.pool.fetchval('SELECT status FROM users WHERE user_id = $1', user_id)
+    
+    async def update_user_status(self, user_id, status):
+        await self.pool.execute('''
+            UPDATE users
+            SET status = $1, updated_at = now()
+            WHERE user_id = $2
+        ''', status, user_id)
+    
+    async def remove_user(self, user_id):
+        await self.pool.execute('DELETE FROM users WHERE user_id = $1', user_id)
+    
+    async def get_all_users(self):
+        return await self.pool.fetch('SELECT * FROM users ORDER BY created_at DESC')
+    
+    async def get_users_page(self, status=None, after=None, limit=5):
+        conditions = []
+        params = []
+        if status is not None:
+            params.append(status)
+            conditions.append(f'status = ${len(params)}')
+        if after is not None:
+            params.extend(after)
+            conditions.append(f'(created_at, user_id) < (${len(params) - 1}, ${len(params)})')
+        params.append(limit)
+        
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+        return await self.pool.fetch(f'''
+            SELECT * FROM users
+            {where}
+            ORDER BY created_at DESC, user_id DESC
+            LIMIT ${len(params)}
+        ''', *params)
+    
+    async def count_users(self, status=None):
+        if status is None:
+            return await self.pool.fetchval('SELECT COUNT(*) FROM users')
+        return await self.pool.fetchval('SELECT COUNT(*) FROM users WHERE status = $1', status)
+    
+    async def bulk_approve_users(self, user_ids, request_ids=()):
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.executemany('''
+                    INSERT INTO users (user_id, username, first_name, status)
+                    VALUES ($1, 'Unknown', 'Unknown', 'approved')
+                    ON CONFLICT (user_id) DO NOTHING
+                ''', [(user_id,) for user_id in user_ids])
+                await conn.executemany('''
+                    UPDATE users
+                    SET status = 'approved', updated_at = now()
+                    WHERE user_id = $1 AND status != 'admin'
+                ''', [(user_id,) for user_id in user_ids])
+                await conn.executemany('''
+                    UPDATE access_requests
+                    SET status = 'approved', updated_at = now()
+                    WHERE id = $1
+                ''', [(request_id,) for request_id in request_ids])
+    
+    async def bulk_reject_users(self, user_ids, request_ids=(), remove_user_ids=()):
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.executemany('''
+                    UPDATE users
+                    SET status = 'rejected', updated_at = now()
+                    WHERE user_id = $1 AND status != 'admin'
+                ''', [(user_id,) for user_id in user_ids])
+                await conn.executemany('''
+                    UPDATE access_requests
+                    SET status = 'rejected', updated_at = now()
+                    WHERE id = $1
+                ''', [(request_id,) for request_id in request_ids])
+                await conn.executemany(
+                    "DELETE FROM users WHERE user_id = $1 AND status != 'admin'",
+                    [(user_id,) for user_id in remove_user_ids]
+                )
+    
+    async def create_access_request(self, user_id, username, first_name, message):
+        try:
+            await self.pool.execute('''
+                INSERT INTO access_requests (user_id, username, first_name, message)
+                VALUES ($1, $2, $3, $4)
+            ''', user_id, username, first_name, message)
+            return True
+        except Exception as e:
+            print(f"Error creating access request: {e}")
+            return False
+    
+    async def get_pending_requests(self):
+        return await self.pool.fetch('''
+            SELECT * FROM access_requests
+            WHERE status = 'pending'
+            ORDER BY created_at DESC
+        ''')
+    
+    async def get_pending_users(self):
+        return await self.pool.fetch("SELECT * FROM users WHERE status = 'pending'")
+    
+    async def update_request_status(self, request_id, status):
+        await self.pool.execute('''
+            UPDATE access_requests
+            SET status = $1, updated_at = now()
+            WHERE id = $2
+        ''', status, request_id)
+    
+    async def get_request_by_id(self, request_id):
+        return await self.pool.fetchrow('SELECT * FROM access_requests WHERE id = $1', request_id)
+    
+    async def add_download(self, user_id, url, title, file_type, file_size):
+        await self.pool.execute('''
+            INSERT INTO downloads (user_id, url, title, file_type, file_size)
+            VALUES ($1, $2, $3, $4, $5)
+        ''', user_id, url, title, file_type, file_size)
+    
+    async def get_user_downloads(self, user_id):
+        return await self.pool.fetch('''
+            SELECT * FROM downloads
+            WHERE user_id = $1
+            ORDER BY download_date DESC
+        ''', user_id)
+    
+    async def get_quota_override(self, user_id):
+        return await self.pool.fetchrow(
+            'SELECT downloads_per_hour, bytes_per_day FROM user_quotas WHERE user_id = $1',
+            user_id
+        )
+    
+    async def set_quota_override(self, user_id, downloads_per_hour, bytes_per_day):
+        if downloads_per_hour is None and bytes_per_day is None:
+            await self.pool.execute('DELETE FROM user_quotas WHERE user_id = $1', user_id)
+            return
+        await self.pool.execute('''
+            INSERT INTO user_quotas (user_id, downloads_per_hour, bytes_per_day)
+            VALUES ($1, $2, $3)
+            ON CONFLICT (user_id) DO UPDATE SET
+                downloads_per_hour = EXCLUDED.downloads_per_hour,
+                bytes_per_day = EXCLUDED.bytes_per_day,
+                updated_at = now()
+        ''', user_id, downloads_per_hour, bytes_per_day)
+    
+    async def get_download_usage(self, user_id, since):
+        since = since.replace(minute=0, second=0, microsecond=0)
+        rolled = await self.pool.fetchrow('''
+            SELECT COALESCE(SUM(downloads), 0)::bigint, COALESCE(SUM(bytes), 0)::bigint FROM download_usage
+            WHERE user_id = $1 AND hour >= $2
+        ''', user_id, since)
+        recent = await self.pool.fetchrow('''
+            SELECT COUNT(*), COALESCE(SUM(file_size), 0)::bigint FROM downloads
+            WHERE user_id = $1 AND download_date >= $2
+            AND id > COALESCE((SELECT last_id FROM rollup_state WHERE name = 'downloads'), 0)
+        ''', user_id, since)
+        return rolled[0] + recent[0], rolled[1] + recent[1]
+    
+    async def take_quota_tokens(self, key, rate, capacity, amount, initial, allow_debt=False):
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute('''
+                    INSERT INTO quota_buckets (key, tokens) VALUES ($1, $2)
+                    ON CONFLICT DO NOTHING
+                ''', key, initial)
+                # The row lock taken by the CTE serializes processes drawing on the same bucket
+                taken, tokens = await conn.fetchrow('''
+                    WITH refilled AS (
+                        SELECT key, LEAST(
+                            $2::float8,
+                            tokens + GREATEST(0, EXTRACT(EPOCH FROM now() - updated_at)::float8) * $3::float8
+                        ) AS tokens
+                        FROM quota_buckets
+                        WHERE key = $1
+                        FOR UPDATE
+                    )
+                    UPDATE quota_buckets b
+                    SET tokens = r.tokens - CASE WHEN $5 OR r.tokens >= $4 THEN $4 ELSE 0 END, updated_at = now()
+                    FROM refilled r
+                    WHERE b.key = r.key
+                    RETURNING $5 OR r.tokens >= $4, b.tokens
+                ''', key, capacity, rate, amount, allow_debt)
+        return taken, tokens
+    
+    async def rollup_downloads(self, keep_hours=48):
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                # Row lock on the rollup state keeps concurrent bot processes from rolling up twice
+                await conn.execute('''
+                    INSERT INTO rollup_state (name, last_id) VALUES ('downloads', 0)
+                    ON CONFLICT DO NOTHING
+                ''')
+                last_id = await conn.fetchval(
+                    "SELECT last_id FROM rollup_state WHERE name = 'downloads' FOR UPDATE"
+                )
+                # Leave the last minute alone: IDs are handed out before commit, so a
+                # lower ID may still become visible after a higher one
+                max_id = await conn.fetchval(
+                    "SELECT MAX(id) FROM downloads WHERE download_date < now() - interval '1 minute'"
+                ) or 0
+                if max_id <= last_id:
+                    return 0
+                
+                await conn.execute('''
+                    INSERT INTO download_usage (user_id, hour, downloads, bytes)
+                    SELECT user_id, date_trunc('hour', download_date), COUNT(*), COALESCE(SUM(file_size), 0)
+                    FROM downloads
+                    WHERE id > $1 AND id <= $2
+                    GROUP BY 1, 2
+                    ON CONFLICT (user_id, hour) DO UPDATE SET
+                        downloads = download_usage.downloads + EXCLUDED.downloads,
+                        bytes = download_usage.bytes + EXCLUDED.bytes
+                ''', last_id, max_id)
+                await conn.execute(
+                    "UPDATE rollup_state SET last_id = $1 WHERE name = 'downloads'",
+                    max_id
+                )
+                await conn.execute(
+                    "DELETE FROM download_usage WHERE hour < now() - make_interval(hours => $1)",
+                    keep_hours
+                )
+                # Untouched for a day, a bucket has refilled completely
+                await conn.execute("DELETE FROM quota_buckets WHERE updated_at < now() - interval '1 day'")
+        return max_id - last_id
+    
+    async def add_job(self, user_id, chat_id, message_id, url, media_type, owner=None, lease_seconds=0):
+        return await self.pool.fetchval('''
+            INSERT INTO download_jobs (user_id, chat_id, message_id, url, media_type, owner, lease_expires_at)
+            VALUES ($1, $2, $3, $4, $5, $6, now() + make_interval(secs => $7))
+            RETURNING id
+        ''', user_id, chat_id, message_id, url, media_type, owner, lease_seconds)
+    
+    async def update_job_status(self, job_id, status, error=None):
+        await self.pool.execute('''
+            UPDATE download_jobs
+            SET status = $1, error = $2, updated_at = now()
+            WHERE id = $3
+        ''', status, error, job_id)
+    
+    async def claim_jobs(self, owner, lease_seconds, include_own=False):
+        # SKIP LOCKED: rows another process is claiming right now are left to it
+        rows = await self.pool.fetch('''
+            UPDATE download_jobs
+            SET status = 'queued', owner = $1, lease_expires_at = now() + make_interval(secs => $2), updated_at = now()
+            WHERE id IN (
+                SELECT id FROM download_jobs
+                WHERE status IN ('queued', 'running')
+                AND (owner IS NULL OR lease_expires_at < now() OR (owner = $1 AND $3))
+                ORDER BY id
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING id, user_id, chat_id, message_id, url, media_type
+        ''', owner, lease_seconds, include_own)
+        return sorted(rows, key=lambda row: row[0])
+    
+    async def renew_job_leases(self, owner, lease_seconds):
+        await self.pool.execute('''
+            UPDATE download_jobs
+            SET lease_expires_at = now() + make_interval(secs => $2)
+            WHERE owner = $1 AND status IN ('queued', 'running')
+        ''', owner, lease_seconds)
+    
+    async def release_jobs(self, owner):
+        await self.pool.execute('''
+            UPDATE download_jobs
+            SET owner = NULL, lease_expires_at = NULL
+            WHERE owner = $1 AND status IN ('queued', 'running')
+        ''', owner)
+    
+    async def add_job_traces(self, traces):
+        await self.pool.executemany('''
+            INSERT INTO job_traces (
+                job_id, user_id, media_type, extractor, format_id, bytes, outcome, error,
+                extract_seconds, queue_seconds, download_seconds, postprocess_seconds, upload_seconds, total_seconds
+            )
+            VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, $12, $13, $14)
+            ON CONFLICT (job_id) DO UPDATE SET
+                user_id = EXCLUDED.user_id, media_type = EXCLUDED.media_type, extractor = EXCLUDED.extractor,
+                format_id = EXCLUDED.format_id, bytes = EXCLUDED.bytes, outcome = EXCLUDED.outcome,
+                error = EXCLUDED.error, extract_seconds = EXCLUDED.extract_seconds,
+                queue_seconds = EXCLUDED.queue_seconds, download_seconds = EXCLUDED.download_seconds,
+                postprocess_seconds = EXCLUDED.postprocess_seconds, upload_seconds = EXCLUDED.upload_seconds,
+                total_seconds = EXCLUDED.total_seconds, created_at = now()
+        ''', traces)
+    
+    async def get_job_traces(self, since, limit=10000):
+        return await self.pool.fetch('''
+            SELECT media_type, outcome, extract_seconds, queue_seconds, download_seconds,
+                postprocess_seconds, upload_seconds, total_seconds
+            FROM job_traces
+            WHERE created_at >= $1
+            ORDER BY created_at DESC
+            LIMIT $2
+        ''', since, limit)
+    
+    async def get_cached_media(self, cache_key):
+        return await self.pool.fetchrow('''
+            SELECT cache_key, file_id, file_type, title, file_size FROM media_cache
+            WHERE cache_key = $1
+        ''', cache_key)
+    
+    async def add_cached_media(self, cache_key, file_id, file_type, title, file_size):
+        await self.pool.execute('''
+            INSERT INTO media_cache (cache_key, file_id, file_type, title, file_size)
+            VALUES ($1, $2, $3, $4, $5)
+            ON CONFLICT (cache_key) DO UPDATE SET
+                file_id = EXCLUDED.file_id,
+                file_type = EXCLUDED.file_type,
+                title = EXCLUDED.title,
+                file_size = EXCLUDED.file_size,
+                hits = 0,
+                created_at = now(),
+                last_used_at = now()
+        ''', cache_key, file_id, file_type, title, file_size)
+    
+    async def touch_cached_media(self, cache_key):
+        await self.pool.execute('''
+            UPDATE media_cache
+            SET hits = hits + 1, last_used_at = now()
+            WHERE cache_key = $1
+        ''', cache_key)
+    
+    async def remove_cached_media(self, cache_key):
+        await self.pool.execute('DELETE FROM media_cache WHERE cache_key = $1', cache_key)
+    
+    async def create_broadcast(self, admin_id, chat_id, message_id, text, user_ids, owner=None, lease_seconds=0):
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                broadcast_id = await conn.fetchval('''
+                    INSERT INTO broadcasts (admin_id, chat_id, message_id, text, owner, lease_expires_at)
+                    VALUES ($1, $2, $3, $4, $5, now() + make_interval(secs => $6))
+                    RETURNING id
+                ''', admin_id, chat_id, message_id, text, owner, lease_seconds)
+                await conn.executemany('''
+                    INSERT INTO broadcast_recipients (broadcast_id, user_id)
+                    VALUES ($1, $2)
+                    ON CONFLICT DO NOTHING
+                ''', [(broadcast_id, user_id) for user_id in user_ids])
+        return broadcast_id
+    
+    async def claim_broadcasts(self, owner, lease_seconds, include_own=False):
+        rows = await self.pool.fetch('''
+            UPDATE broadcasts
+            SET owner = $1, lease_expires_at = now() + make_interval(secs => $2), updated_at = now()
+            WHERE id IN (
+                SELECT id FROM broadcasts
+                WHERE status = 'running'
+                AND (owner IS NULL OR lease_expires_at < now() OR (owner = $1 AND $3))
+                ORDER BY id
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING id, chat_id, message_id, text
+        ''', owner, lease_seconds, include_own)
+        return sorted(rows, key=lambda row: row[0])
+    
+    async def renew_broadcast_leases(self, owner, lease_seconds):
+        await self.pool.execute('''
+            UPDATE broadcasts
+            SET lease_expires_at = now() + make_interval(secs => $2)
+            WHERE owner = $1 AND status = 'running'
+        ''', owner, lease_seconds)
+    
+    async def release_broadcasts(self, owner):
+        await self.pool.execute('''
+            UPDATE broadcasts
+            SET owner = NULL, lease_expires_at = NULL
+            WHERE owner = $1 AND status = 'running'
+        ''', owner)
+    
+    async def get_broadcast_pending(self, broadcast_id):
+        rows = await self.pool.fetch('''
+            SELECT user_id FROM broadcast_recipients
+            WHERE broadcast_id = $1 AND status = 'pending'
+        ''', broadcast_id)
+        return [row[0] for row in rows]
+    
+    async def get_broadcast_counts(self, broadcast_id):
+        rows = await self.pool.fetch('''
+            SELECT status, COUNT(*) FROM broadcast_recipients
+            WHERE broadcast_id = $1
+            GROUP BY status
+        ''', broadcast_id)
+        return {row[0]: row[1] for row in rows}
+    
+    async def save_broadcast_results(self, broadcast_id, results):
+        blocked = [(user_id,) for user_id, status in results if status == 'blocked']
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.executemany('''
+                    UPDATE broadcast_recipients
+                    SET status = $1
+                    WHERE broadcast_id = $2 AND user_id = $3
+                ''', [(status, broadcast_id, user_id) for user_id, status in results])
+                if blocked:
+                    await conn.executemany(
+                        'INSERT INTO blocked_users (user_id) VALUES ($1) ON CONFLICT DO NOTHING',
+                        blocked
+                    )
+    
+    async def finish_broadcast(self, broadcast_id):
+        await self.pool.execute('''
+            UPDATE broadcasts
+            SET status = 'done', updated_at = now()
+            WHERE id = $1
+        ''', broadcast_id)
+    
+    async def get_blocked_user_ids(self):
+        return {row[0] for row in await self.pool.fetch('SELECT user_id FROM blocked_users')}
+    
+    async def is_user_blocked(self, user_id):
+        return await self.pool.fetchval('SELECT EXISTS (SELECT 1 FROM blocked_users WHERE user_id = $1)', user_id)
+    
+    async def unblock_user(self, user_id):
+        await self.pool.execute('DELETE FROM blocked_users WHERE user_id = $1', user_id)
+
+
+def create_storage(backend=STORAGE_BACKEND):
+    """Create the configured storage backend ('sqlite' or 'postgres')"""
+    if backend == 'sqlite':
+        return SQLiteStorage()
+    if backend in ('postgres', 'postgresql'):
+        return PostgresStorage()
+    raise ValueError(f"Unknown storage backend: {backend}")
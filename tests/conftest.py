@@ -0,0 +1,21 @@
+"""PostgreSQL tests run against TEST_DATABASE_URL, or a throwaway server from
+pgserver if it is installed; they are skipped otherwise. The tables they use
+are emptied first.
+"""
+import os
+import tempfile
+
+import pytest
+
+from storage import asyncpg
+
+
+@pytest.fixture(scope='session')
+def dsn():
+    if asyncpg is None:
+        pytest.skip("asyncpg is not installed")
+    url = os.getenv('TEST_DATABASE_URL')
+    if url:
+        return url
+    pgserver = pytest.importorskip('pgserver', reason="set TEST_DATABASE_URL or install pgserver")
+    return pgserver.get_server(tempfile.mkdtemp(), cleanup_mode='stop').get_uri()
@@ -0,0 +1,92 @@
+"""Job and broadcast leases on PostgreSQL (several processes sharing one database)"""
+import asyncio
+
+from storage import PostgresStorage
+
+
+def run(dsn, scenario):
+    """Run scenario(storage_a, storage_b), two storages standing in for two bot processes"""
+    async def main():
+        a, b = PostgresStorage(dsn, min_size=1, max_size=4), PostgresStorage(dsn, min_size=1, max_size=4)
+        await a.connect()
+        await b.connect()
+        await a.pool.execute('TRUNCATE download_jobs, broadcasts, broadcast_recipients')
+        try:
+            await scenario(a, b)
+        finally:
+            await a.close()
+            await b.close()
+    asyncio.run(main())
+
+
+async def add_jobs(db, count, owner=None, lease_seconds=0):
+    return [await db.add_job(1, 1, n, f'https://example.com/{n}', 'video', owner, lease_seconds) for n in range(count)]
+
+
+def test_concurrent_claims_are_disjoint(dsn):
+    async def scenario(a, b):
+        job_ids = await add_jobs(a, 50)
+        claims = await asyncio.gather(*(
+            db.claim_jobs(owner, 60) for _ in range(5) for db, owner in ((a, 'a'), (b, 'b'))
+        ))
+        claimed = [row[0] for rows in claims for row in rows]
+        assert sorted(claimed) == job_ids
+    run(dsn, scenario)
+
+
+def test_live_leases_are_not_taken_over(dsn):
+    async def scenario(a, b):
+        job_ids = await add_jobs(a, 3, owner='a', lease_seconds=60)
+        assert await b.claim_jobs('b', 60) == []
+        # A restarted process with the same owner resumes its own jobs
+        assert [row[0] for row in await a.claim_jobs('a', 60, include_own=True)] == job_ids
+        assert await a.claim_jobs('a', 60) == []
+    run(dsn, scenario)
+
+
+def test_expired_and_released_jobs_are_claimable(dsn):
+    async def scenario(a, b):
+        expired = await add_jobs(a, 2, owner='a', lease_seconds=0)
+        released = await add_jobs(a, 2, owner='a', lease_seconds=60)
+        finished = await add_jobs(a, 1, owner='a', lease_seconds=0)
+        await a.update_job_status(finished[0], 'done')
+        
+        assert [row[0] for row in await b.claim_jobs('b', 60)] == expired
+        
+        await a.renew_job_leases('a', 60)
+        assert await b.claim_jobs('b', 60) == []
+        await a.release_jobs('a')
+        assert [row[0] for row in await b.claim_jobs('b', 60)] == released
+        
+        rows = await a.pool.fetch('SELECT status, owner FROM download_jobs WHERE id = ANY($1)', expired + released)
+        assert {tuple(row) for row in rows} == {('queued', 'b')}
+    run(dsn, scenario)
+
+
+def test_running_jobs_are_requeued_by_claim(dsn):
+    async def scenario(a, b):
+        job_id, = await add_jobs(a, 1)
+        await a.update_job_status(job_id, 'running')
+        rows = await b.claim_jobs('b', 60)
+        assert [row[0] for row in rows] == [job_id]
+        assert await a.pool.fetchval('SELECT status FROM download_jobs WHERE id = $1', job_id) == 'queued'
+    run(dsn, scenario)
+
+
+def test_broadcast_leases(dsn):
+    async def scenario(a, b):
+        owned = await a.create_broadcast(1, 1, 1, 'owned', [1, 2], 'a', 60)
+        unowned = await a.create_broadcast(1, 1, 2, 'unowned', [1, 2])
+        done = await a.create_broadcast(1, 1, 3, 'done', [1, 2])
+        await a.finish_broadcast(done)
+        
+        claims = await asyncio.gather(b.claim_broadcasts('b', 60), a.claim_broadcasts('c', 60))
+        assert sorted(row[0] for rows in claims for row in rows) == [unowned]
+        
+        assert [tuple(row) for row in await a.claim_broadcasts('a', 60, include_own=True)] == [(owned, 1, 1, 'owned')]
+        await a.release_broadcasts('a')
+        # Whichever of b and c won the unowned broadcast stops renewing in time
+        await b.renew_broadcast_leases('b', 0)
+        await a.renew_broadcast_leases('c', 0)
+        assert sorted(row[0] for row in await a.claim_broadcasts('a', 60)) == [owned, unowned]
+    run(dsn, scenario)
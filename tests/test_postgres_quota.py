@@ -0,0 +1,57 @@
+"""Download quotas shared by several bot processes on PostgreSQL"""
+import asyncio
+
+from quota import QuotaManager
+from storage import PostgresStorage
+
+
+def run(dsn, scenario):
+    """Run scenario(storage_a, storage_b), two storages standing in for two bot processes"""
+    async def main():
+        a, b = PostgresStorage(dsn, min_size=1, max_size=4), PostgresStorage(dsn, min_size=1, max_size=4)
+        await a.connect()
+        await b.connect()
+        await a.pool.execute('TRUNCATE quota_buckets, user_quotas, download_usage')
+        try:
+            await scenario(a, b)
+        finally:
+            await a.close()
+            await b.close()
+    asyncio.run(main())
+
+
+def test_download_quota_holds_across_processes(dsn):
+    async def scenario(a, b):
+        managers = [QuotaManager(a, downloads_per_hour=3), QuotaManager(b, downloads_per_hour=3)]
+        assert await managers[0].confirm(42) is None
+        await asyncio.gather(*(manager.record_download(42, 0) for manager in managers))
+        assert await managers[1].confirm(42) is None
+        await managers[1].record_download(42, 0)
+        # Both processes see the shared bucket is empty
+        assert all(await asyncio.gather(*(manager.confirm(42) for manager in managers)))
+    run(dsn, scenario)
+
+
+def test_only_delivered_downloads_are_charged(dsn):
+    async def scenario(a, b):
+        first = QuotaManager(a, downloads_per_hour=1, global_downloads_per_hour=1)
+        second = QuotaManager(b, downloads_per_hour=1, global_downloads_per_hour=1)
+        # Confirming (a job that then fails or is cancelled) takes nothing
+        for _ in range(3):
+            assert await first.confirm(1) is None
+        await second.record_download(2, 0)
+        assert 'too many downloads' in await first.confirm(1)
+        tokens = await a.pool.fetchval("SELECT tokens FROM quota_buckets WHERE key = 'downloads:1'")
+        assert round(tokens) == 1
+    run(dsn, scenario)
+
+
+def test_bytes_are_charged_to_the_shared_bucket(dsn):
+    async def scenario(a, b):
+        first = QuotaManager(a, bytes_per_day=1000)
+        second = QuotaManager(b, bytes_per_day=1000)
+        await first.record_download(7, 600)
+        await second.record_download(7, 600)
+        assert await first.remaining_bytes(7) == 0
+        assert 'daily limit' in await first.confirm(7)
+    run(dsn, scenario)
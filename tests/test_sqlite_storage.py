@@ -0,0 +1,110 @@
+"""SQLiteStorage, the default backend: job leases, quota buckets, user pages and bulk decisions"""
+import asyncio
+
+from storage import SQLiteStorage
+
+
+def run(tmp_path, scenario):
+    """Run scenario(storage) on a fresh database file"""
+    async def main():
+        db = SQLiteStorage(str(tmp_path / 'bot.db'))
+        try:
+            await scenario(db)
+        finally:
+            await db.close()
+    asyncio.run(main())
+
+
+async def add_jobs(db, count, owner=None, lease_seconds=0):
+    return [await db.add_job(1, 1, n, f'https://example.com/{n}', 'video', owner, lease_seconds) for n in range(count)]
+
+
+def expire_leases(db, owner):
+    db.db._execute("UPDATE download_jobs SET lease_expires_at = datetime('now', '-1 minute') WHERE owner = ?", (owner,))
+
+
+def test_claim_renew_release_jobs(tmp_path):
+    async def scenario(db):
+        unowned = await add_jobs(db, 2)
+        owned = await add_jobs(db, 2, owner='a', lease_seconds=60)
+        
+        claims = await asyncio.gather(db.claim_jobs('b', 60), db.claim_jobs('c', 60))
+        assert sorted(row[0] for rows in claims for row in rows) == unowned
+        assert await db.claim_jobs('b', 60) == []
+        # A restarted process with the same owner resumes its own jobs
+        assert [row[0] for row in await db.claim_jobs('a', 60, include_own=True)] == owned
+        
+        expire_leases(db, 'a')
+        await db.renew_job_leases('a', 60)
+        assert await db.claim_jobs('b', 60) == []
+        
+        expire_leases(db, 'a')
+        assert [row[0] for row in await db.claim_jobs('b', 60)] == owned
+        
+        await db.release_jobs('b')
+        await db.release_jobs('c')
+        assert len(await db.claim_jobs('d', 60)) == 4
+    run(tmp_path, scenario)
+
+
+def test_claim_requeues_running_jobs_and_skips_finished_ones(tmp_path):
+    async def scenario(db):
+        running, done = await add_jobs(db, 2)
+        await db.update_job_status(running, 'running')
+        await db.update_job_status(done, 'done')
+        assert [row[0] for row in await db.claim_jobs('a', 60)] == [running]
+        assert db.db._fetchone('SELECT status FROM download_jobs WHERE id = ?', (running,))[0] == 'queued'
+    run(tmp_path, scenario)
+
+
+def test_take_quota_tokens(tmp_path):
+    async def scenario(db):
+        assert await db.take_quota_tokens('downloads:1', 0.001, 3, 1, 2) == (True, 1)
+        taken, tokens = await db.take_quota_tokens('downloads:1', 0.001, 3, 1, 3)
+        assert taken and 0 <= tokens < 0.1
+        # Nothing is taken without enough tokens, unless going into debt is allowed
+        taken, tokens = await db.take_quota_tokens('downloads:1', 0.001, 3, 1, 3)
+        assert not taken and 0 <= tokens < 0.1
+        taken, tokens = await db.take_quota_tokens('downloads:1', 0.001, 3, 1, 3, allow_debt=True)
+        assert taken and -1 <= tokens < -0.9
+        # Refills are capped at the capacity
+        taken, tokens = await db.take_quota_tokens('bytes:1', 1000, 10, 0, 10)
+        assert taken and tokens == 10
+    run(tmp_path, scenario)
+
+
+def test_users_page_keyset(tmp_path):
+    async def scenario(db):
+        for user_id in range(1, 13):
+            await db.add_user(user_id, f'user{user_id}', 'Test', status='approved' if user_id % 3 else 'pending')
+        
+        for status in (None, 'approved', 'pending'):
+            expected = [row[0] for row in await db.get_all_users() if status is None or row[3] == status]
+            seen = []
+            after = None
+            while True:
+                page = await db.get_users_page(status, after, limit=5)
+                if not page:
+                    break
+                seen += [row[0] for row in page]
+                after = (page[-1][4], page[-1][0])
+            assert seen == expected
+            assert await db.count_users(status) == len(expected)
+    run(tmp_path, scenario)
+
+
+def test_bulk_approve_and_reject(tmp_path):
+    async def scenario(db):
+        for user_id in (1, 2, 3):
+            await db.add_user(user_id, f'user{user_id}', 'Test')
+            await db.create_access_request(user_id, f'user{user_id}', 'Test', 'please')
+        requests = {row[1]: row[0] for row in await db.get_pending_requests()}
+        await db.add_user(4, 'boss', 'Test', status='admin')
+        
+        await db.bulk_approve_users([1, 4, 5], [requests[1]])
+        assert [await db.get_user_status(user_id) for user_id in (1, 4, 5)] == ['approved', 'admin', 'approved']
+        
+        await db.bulk_reject_users([2, 4], [requests[2]], remove_user_ids=[3, 4])
+        assert [await db.get_user_status(user_id) for user_id in (2, 3, 4)] == ['rejected', None, 'admin']
+        assert [row[1] for row in await db.get_pending_requests()] == [3]
+    run(tmp_path, scenario)
@@ -0,0 +1,163 @@
+import asyncio
+import logging
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+from datetime import datetime, timedelta, timezone
+
+from config import TRACE_BATCH_SIZE, TRACE_FLUSH_INTERVAL
+
+logger = logging.getLogger(__name__)
+
+# Job phases in the order they happen
+PHASES = ('extract', 'queue', 'download', 'postprocess', 'upload')
+
+
+class JobTrace:
+    """Phase timings and outcome of one download job.
+    
+    Created when a link arrives (handle_message), handed to the scheduler with
+    the job and filled in by download_and_send and MediaDownloader, which may
+    record phases from its download threads. Saved by a TraceWriter when the
+    job ends.
+    """
+    def __init__(self, user_id, url, media_type=None):
+        self.user_id = user_id
+        self.url = url
+        self.media_type = media_type
+        self.job_id = None
+        self.extractor = None
+        self.format_id = None
+        self.bytes = None
+        self.outcome = None
+        self.error = None
+        # Phase -> seconds spent in it
+        self.timings = {}
+        self._started = {}
+        self._created = time.monotonic()
+        self._submitted = None
+        self._lock = threading.Lock()
+    
+    def start(self, phase):
+        with self._lock:
+            self._started[phase] = time.monotonic()
+    
+    def stop(self, phase):
+        """End a phase started with start(); time spent in a phase more than once adds up"""
+        with self._lock:
+            started = self._started.pop(phase, None)
+            if started is not None:
+                self.timings[phase] = self.timings.get(phase, 0.0) + time.monotonic() - started
+    
+    def submit(self):
+        """Mark the job as queued. The time the user took to pick a format doesn't count."""
+        self._submitted = time.monotonic()
+        self.start('queue')
+    
+    @contextmanager
+    def phase(self, phase):
+        """Time a with block as a phase"""
+        self.start(phase)
+        try:
+            yield
+        finally:
+            self.stop(phase)
+    
+    def finish(self, outcome, error=None):
+        """Record the outcome (the first one set wins)"""
+        if self.outcome is None:
+            self.outcome = outcome
+            self.error = error
+    
+    def row(self):
+        """The trace as a job_traces row"""
+        return (
+            self.job_id, self.user_id, self.media_type, self.extractor, self.format_id, self.bytes,
+            self.outcome or 'unknown', self.error,
+            *(self.timings.get(phase) for phase in PHASES),
+            self.total()
+        )
+    
+    def total(self):
+        """Seconds from the link arriving to now, less the wait for the user's choice"""
+        if self._submitted is None:
+            return time.monotonic() - self._created
+        return self.timings.get('extract', 0.0) + time.monotonic() - self._submitted
+
+
+def trace_phase(trace, phase):
+    """trace.phase(phase), or a no-op when there is no trace"""
+    return trace.phase(phase) if trace else nullcontext()
+
+
+class TraceWriter:
+    """Saves finished job traces in batches.
+    
+    Traces are written once batch_size of them are waiting or every
+    flush_interval seconds, whichever comes first, and on stop().
+    """
+    def __init__(self, db, batch_size=TRACE_BATCH_SIZE, flush_interval=TRACE_FLUSH_INTERVAL):
+        self.db = db
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.pending = []
+        self.task = None
+    
+    async def start(self):
+        self.task = asyncio.create_task(self._flush_loop())
+    
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+        await self.flush()
+    
+    def record(self, trace):
+        """Queue a finished trace for saving"""
+        if trace.job_id is None:
+            return
+        self.pending.append(trace.row())
+        if len(self.pending) >= self.batch_size:
+            asyncio.create_task(self.flush())
+    
+    async def flush(self):
+        batch, self.pending = self.pending, []
+        if not batch:
+            return
+        try:
+            await self.db.add_job_traces(batch)
+        except Exception as e:
+            logger.error(f"Error saving {len(batch)} job trace(s): {e}")
+    
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+
+def percentile(values, p):
+    """p-th percentile (0-100) of values by nearest rank, or None if empty"""
+    if not values:
+        return None
+    values = sorted(values)
+    rank = max(1, -(-len(values) * p // 100))
+    return values[int(rank) - 1]
+
+
+async def phase_stats(db, hours=24):
+    """Summarize the jobs traced in the last `hours`.
+    
+    Returns (jobs, outcome counts, {phase: (count, p50, p95)}), including a
+    'total' pseudo-phase.
+    """
+    rows = await db.get_job_traces(datetime.now(timezone.utc) - timedelta(hours=hours))
+    outcomes = {}
+    for row in rows:
+        outcomes[row[1]] = outcomes.get(row[1], 0) + 1
+    
+    stats = {}
+    for index, phase in enumerate(PHASES + ('total',)):
+        values = [row[2 + index] for row in rows if row[2 + index] is not None]
+        stats[phase] = (len(values), percentile(values, 50), percentile(values, 95))
+    return len(rows), outcomes, stats
@@ -0,0 +1,57 @@
+import asyncio
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+from config import CONCURRENT_UPDATES, MAX_PENDING_UPDATES
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Processes updates concurrently while keeping each user's updates in order.
+    
+    Updates of different users run in parallel, up to max_concurrent_updates at
+    once; updates of the same user (or chat, when there is no user) run one at
+    a time in arrival order. An update waiting for its user's turn does not
+    hold one of the running slots, so a user with a slow handler or a burst of
+    messages does not delay anyone else. The base class semaphore only bounds
+    the updates admitted (running or waiting), at max_pending_updates.
+    """
+    def __init__(self, max_concurrent_updates=CONCURRENT_UPDATES, max_pending_updates=MAX_PENDING_UPDATES):
+        super().__init__(max(max_pending_updates, max_concurrent_updates))
+        self.running = asyncio.Semaphore(max_concurrent_updates)
+        # Key -> [lock, number of updates holding or waiting for it]
+        self._locks = {}
+    
+    @staticmethod
+    def _key(update):
+        if isinstance(update, Update):
+            if update.effective_user:
+                return ('user', update.effective_user.id)
+            if update.effective_chat:
+                return ('chat', update.effective_chat.id)
+        return None
+    
+    async def do_process_update(self, update, coroutine):
+        key = self._key(update)
+        if key is None:
+            async with self.running:
+                await coroutine
+            return
+        
+        entry = self._locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            # asyncio.Lock wakes waiters first come first served, i.e. in update order
+            async with entry[0]:
+                async with self.running:
+                    await coroutine
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[key]
+    
+    async def initialize(self):
+        pass
+    
+    async def shutdown(self):
+        pass
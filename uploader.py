@@ -0,0 +1,112 @@
+import asyncio
+import json
+import mimetypes
+import os
+import time
+import uuid
+
+import httpx
+from telegram import Message
+from telegram.error import BadRequest, Forbidden, RetryAfter, TelegramError
+
+from config import UPLOAD_CHUNK_SIZE_KB, UPLOAD_TIMEOUT
+
+
+class StreamingUploader:
+    """Uploads files to the Bot API as a streamed multipart body.
+    
+    python-telegram-bot reads a whole file handle into memory before sending it.
+    Here the file is read in fixed-size chunks in the default executor while the
+    request body is being sent, so memory stays bounded whatever the file size
+    and the event loop never blocks on disk reads.
+    """
+    def __init__(self, chunk_size=UPLOAD_CHUNK_SIZE_KB * 1024, timeout=UPLOAD_TIMEOUT):
+        self.chunk_size = chunk_size
+        self.timeout = timeout
+        self.client = None
+    
+    def _get_client(self):
+        if self.client is None:
+            self.client = httpx.AsyncClient(timeout=httpx.Timeout(self.timeout))
+        return self.client
+    
+    async def close(self):
+        """Close the HTTP client"""
+        if self.client is not None:
+            await self.client.aclose()
+            self.client = None
+    
+    async def send_file(self, bot, method, field, file_path, params, progress_callback=None):
+        """Call a Bot API send method (e.g. sendVideo) uploading file_path as field.
+        
+        progress_callback(sent_bytes, total_bytes, elapsed_seconds) is called after
+        every chunk. Returns the sent telegram.Message.
+        """
+        boundary = uuid.uuid4().hex
+        filename = os.path.basename(file_path).replace('"', "'")
+        mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        file_size = os.path.getsize(file_path)
+        
+        head = b''
+        for name, value in params.items():
+            if value is None:
+                continue
+            if isinstance(value, bool):
+                value = 'true' if value else 'false'
+            head += (
+                f'--{boundary}\r\n'
+                f'Content-Disposition: form-data; name="{name}"\r\n\r\n'
+                f'{value}\r\n'
+            ).encode('utf-8')
+        head += (
+            f'--{boundary}\r\n'
+            f'Content-Disposition: form-data; name="{field}"; filename="{filename}"\r\n'
+            f'Content-Type: {mimetype}\r\n\r\n'
+        ).encode('utf-8')
+        tail = f'\r\n--{boundary}--\r\n'.encode('utf-8')
+        
+        async def body():
+            loop = asyncio.get_running_loop()
+            started = time.monotonic()
+            sent = 0
+            yield head
+            f = await loop.run_in_executor(None, open, file_path, 'rb')
+            try:
+                while True:
+                    chunk = await loop.run_in_executor(None, f.read, self.chunk_size)
+                    if not chunk:
+                        break
+                    yield chunk
+                    sent += len(chunk)
+                    if progress_callback:
+                        progress_callback(sent, file_size, time.monotonic() - started)
+            finally:
+                await loop.run_in_executor(None, f.close)
+            yield tail
+        
+        response = await self._get_client().post(
+            f"{bot.base_url}/{method}",
+            content=body(),
+            headers={
+                'Content-Type': f'multipart/form-data; boundary={boundary}',
+                'Content-Length': str(len(head) + file_size + len(tail)),
+            },
+        )
+        
+        try:
+            data = response.json()
+        except json.JSONDecodeError:
+            raise TelegramError(f"Invalid server response ({response.status_code})")
+        
+        if not data.get('ok'):
+            description = data.get('description', 'Unknown error')
+            retry_after = (data.get('parameters') or {}).get('retry_after')
+            if retry_after:
+                raise RetryAfter(retry_after)
+            if response.status_code == 403:
+                raise Forbidden(description)
+            if response.status_code == 400:
+                raise BadRequest(description)
+            raise TelegramError(description)
+        
+        return Message.de_json(data['result'], bot)
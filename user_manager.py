@@ -1,16 +1,15 @@
-from database import Database
+from storage import Storage
 
 class UserManager:
-    def __init__(self, db: Database):
+    def __init__(self, db: Storage):
         self.db = db
     
-    def request_access(self, user_id, username, first_name, message=""):
+    async def request_access(self, user_id, username, first_name, message=""):
         """User requests access to the bot"""
         # Check if user already exists
-        user = self.db.get_user(user_id)
+        status = await self.db.get_user_status(user_id)
         
-        if user:
-            status = user[3]
+        if status:
             if status == 'approved' or status == 'admin':
                 return {
                     'success': False,
@@ -23,10 +22,10 @@ class UserManager:
                 }
         else:
             # Add user with pending status
-            self.db.add_user(user_id, username, first_name, status='pending')
+            await self.db.add_user(user_id, username, first_name, status='pending')
         
         # Create access request
-        success = self.db.create_access_request(user_id, username, first_name, message)
+        success = await self.db.create_access_request(user_id, username, first_name, message)
         
         if success:
             return {
@@ -39,9 +38,9 @@ class UserManager:
                 'message': 'Error sending request. Please try again.'
             }
     
-    def approve_request(self, request_id):
+    async def approve_request(self, request_id):
         """Admin approves an access request"""
-        request = self.db.get_request(request_id)
+        request = await self.db.get_request_by_id(request_id)
         
         if not request:
             return {
@@ -52,10 +51,10 @@ class UserManager:
         user_id = request[1]  # user_id column
         
         # Update user status to approved
-        self.db.update_user_status(user_id, 'approved')
+        await self.db.update_user_status(user_id, 'approved')
         
         # Update request status
-        self.db.update_request_status(request_id, 'approved')
+        await self.db.update_request_status(request_id, 'approved')
         
         return {
             'success': True,
@@ -63,9 +62,9 @@ class UserManager:
             'message': f'User {user_id} has been approved.'
         }
     
-    def reject_request(self, request_id):
+    async def reject_request(self, request_id):
         """Admin rejects an access request"""
-        request = self.db.get_request(request_id)
+        request = await self.db.get_request_by_id(request_id)
         
         if not request:
             return {
@@ -76,10 +75,10 @@ class UserManager:
         user_id = request[1]  # user_id column
         
         # Update user status to rejected
-        self.db.update_user_status(user_id, 'rejected')
+        await self.db.update_user_status(user_id, 'rejected')
         
         # Update request status
-        self.db.update_request_status(request_id, 'rejected')
+        await self.db.update_request_status(request_id, 'rejected')
         
         return {
             'success': True,
@@ -87,56 +86,97 @@ class UserManager:
             'message': f'User {user_id} has been rejected.'
         }
     
-    def add_user_directly(self, user_id):
+    async def add_user_directly(self, user_id):
         """Admin adds a user directly without request"""
-        user = self.db.get_user(user_id)
-        
-        if user:
+        if await self.db.get_user_status(user_id):
             # Update to approved if exists
-            self.db.update_user_status(user_id, 'approved')
+            await self.db.update_user_status(user_id, 'approved')
             return {
                 'success': True,
                 'message': f'User {user_id} added/approved successfully.'
             }
         else:
             # Add new user as approved
-            self.db.add_user(user_id, 'Unknown', 'Unknown', status='approved')
+            await self.db.add_user(user_id, 'Unknown', 'Unknown', status='approved')
             return {
                 'success': True,
                 'message': f'User {user_id} added and approved.'
             }
     
-    def remove_user(self, user_id):
+    async def remove_user(self, user_id):
         """Admin removes a user"""
-        user = self.db.get_user(user_id)
+        status = await self.db.get_user_status(user_id)
         
-        if not user:
+        if not status:
             return {
                 'success': False,
                 'message': f'User {user_id} not found.'
             }
         
-        if self.db.is_admin(user_id):
+        if status == 'admin':
             return {
                 'success': False,
                 'message': 'Cannot remove admin user.'
             }
         
-        self.db.remove_user(user_id)
+        await self.db.remove_user(user_id)
         
         return {
             'success': True,
             'message': f'User {user_id} has been removed.'
         }
     
-    def get_all_users_formatted(self):
-        """Get formatted list of all users"""
-        users = self.db.get_all_users()
+    async def _pending_request_ids(self, user_ids):
+        """Map each of user_ids that has pending requests to their request IDs"""
+        wanted = set(user_ids)
+        request_ids = {}
+        for req in await self.db.get_pending_requests():
+            if req[1] in wanted:  # user_id column
+                request_ids.setdefault(req[1], []).append(req[0])
+        return request_ids
+    
+    async def bulk_approve(self, user_ids):
+        """Admin approves many users at once (via their requests where they have one)"""
+        user_ids = list(user_ids)
+        request_ids = await self._pending_request_ids(user_ids)
+        
+        await self.db.bulk_approve_users(user_ids, [rid for rids in request_ids.values() for rid in rids])
+        
+        return {
+            'success': True,
+            'user_ids': user_ids,
+            'message': f'{len(user_ids)} users have been approved.'
+        }
+    
+    async def bulk_reject(self, user_ids):
+        """Admin rejects many users at once; users without a request are removed"""
+        user_ids = [user_id for user_id in user_ids if not await self.db.is_admin(user_id)]
+        request_ids = await self._pending_request_ids(user_ids)
+        remove_user_ids = [user_id for user_id in user_ids if user_id not in request_ids]
+        
+        await self.db.bulk_reject_users(
+            list(request_ids),
+            [rid for rids in request_ids.values() for rid in rids],
+            remove_user_ids
+        )
+        
+        return {
+            'success': True,
+            'user_ids': user_ids,
+            'message': f'{len(user_ids)} users have been rejected.'
+        }
+    
+    async def get_all_users_formatted(self, users=None, page=0, pages=1):
+        """Get formatted list of all users, or of one page of them"""
+        if users is None:
+            users = await self.db.get_all_users()
         
         if not users:
             return "No users found."
         
         message = "📋 <b>All Users List:</b>\n\n"
+        if pages > 1:
+            message = f"📋 <b>All Users List</b> (page {page + 1}/{pages}):\n\n"
         
         for user in users:
             user_id, username, first_name, status, created_at, _ = user
@@ -154,10 +194,10 @@ class UserManager:
         
         return message
     
-    def get_pending_requests_formatted(self):
+    async def get_pending_requests_formatted(self):
         """Get formatted list of pending requests and users"""
-        requests = self.db.get_pending_requests()
-        pending_users = self.db.get_pending_users()
+        requests = await self.db.get_pending_requests()
+        pending_users = await self.db.get_pending_users()
         
         if not requests and not pending_users:
             return "No pending requests."
@@ -0,0 +1,104 @@
+import asyncio
+import hmac
+import json
+import logging
+import signal
+
+from aiohttp import web
+from telegram import Update
+
+from config import (
+    ALLOWED_UPDATES, WEBHOOK_URL, WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_PATH,
+    WEBHOOK_SECRET, WEBHOOK_MAX_CONNECTIONS
+)
+
+logger = logging.getLogger(__name__)
+
+
+class WebhookServer:
+    """aiohttp server receiving updates from Telegram and queueing them for the Application.
+    
+    Updates are acknowledged as soon as they are queued, so Telegram never
+    waits on a download or a slow handler. Requests without the configured
+    secret token are refused.
+    """
+    def __init__(self, application, listen=WEBHOOK_LISTEN, port=WEBHOOK_PORT, path=WEBHOOK_PATH, secret_token=WEBHOOK_SECRET):
+        self.application = application
+        self.listen = listen
+        self.port = port
+        self.path = path
+        self.secret_token = secret_token
+        self.runner = None
+    
+    async def handle_update(self, request):
+        """Handle a POSTed update"""
+        if self.secret_token:
+            received = request.headers.get('X-Telegram-Bot-Api-Secret-Token', '')
+            if not hmac.compare_digest(received, self.secret_token):
+                return web.Response(status=403)
+        
+        try:
+            data = await request.json()
+            update = Update.de_json(data, self.application.bot)
+        except (json.JSONDecodeError, TypeError, ValueError, KeyError) as e:
+            logger.warning(f"Invalid webhook update: {e}")
+            return web.Response(status=400)
+        
+        await self.application.update_queue.put(update)
+        return web.Response()
+    
+    async def start(self):
+        """Start listening"""
+        app = web.Application()
+        app.router.add_post(self.path, self.handle_update)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, self.listen, self.port).start()
+        logger.info(f"Webhook server listening on {self.listen}:{self.port}{self.path}")
+    
+    async def stop(self):
+        """Stop listening"""
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+
+async def run_webhook(application, url=WEBHOOK_URL, allowed_updates=ALLOWED_UPDATES):
+    """Run the bot on the webhook server until SIGINT/SIGTERM (the webhook counterpart of run_polling).
+    
+    The Application should be built with updater(None). If url is set the
+    webhook is registered with Telegram; otherwise updates are only accepted
+    from whatever posts to the local server.
+    """
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    
+    server = WebhookServer(application)
+    
+    # Same lifecycle order as run_polling
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    await application.start()
+    try:
+        await server.start()
+        if url:
+            await application.bot.set_webhook(
+                url=url,
+                secret_token=server.secret_token,
+                allowed_updates=allowed_updates,
+                max_connections=WEBHOOK_MAX_CONNECTIONS
+            )
+            logger.info(f"Webhook registered at {url}")
+        await stop.wait()
+    finally:
+        # Keep the webhook registered: Telegram holds updates until we are back
+        await server.stop()
+        await application.stop()
+        if application.post_stop:
+            await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)